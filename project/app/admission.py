@@ -0,0 +1,173 @@
+"""
+Admission control for the API routes.
+
+Forecasting in /future_budget and building figures in /spending and
+/moneyflow are CPU bound. Run on the event loop, a few of them at once
+stall every other request the worker is handling, including the cheap
+/dashboard and /current_month_spending calls.
+
+Routes are split into lanes. Each lane runs at most `limit` requests at a
+time and queues at most `queue_size` more; requests arriving to a full
+queue are rejected right away with a 503 and a Retry-After header instead
+of piling up. The CPU-heavy work of a request runs in the threadpool, so
+the lightweight routes, which have their own lane, keep being served while
+the heavy lanes are busy.
+
+Lane limits are set with environment variables, for example
+SAVER_FORECAST_CONCURRENCY=2 and SAVER_FORECAST_QUEUE=8.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import numpy as np
+from fastapi import HTTPException
+
+# number of recent queue waits kept for the percentiles in stats()
+WAIT_SAMPLES = 1000
+
+
+class AdmissionLane():
+    """
+    Class used to limit how many requests of a kind run at once.
+
+    Attributes:
+        name (str): name used when reporting stats
+        limit (int): number of requests allowed to run at once
+        queue_size (int): number of requests allowed to wait for a slot
+        active (int): number of requests running
+        waiting (int): number of requests waiting for a slot
+        admitted (int): number of requests that got a slot
+        rejected (int): number of requests turned away with a 503
+        waits (deque): seconds the most recent requests waited for a slot
+        durations (deque): seconds the most recent requests held a slot
+    """
+
+    def __init__(self, name, limit, queue_size):
+        """
+        Constructor for the AdmissionLane class.
+
+        Parameters:
+            name (str): name used when reporting stats
+            limit (int): number of requests allowed to run at once
+            queue_size (int): number of requests allowed to wait for a slot
+        """
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.semaphore = None
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        self.durations = deque(maxlen=WAIT_SAMPLES)
+
+    def retry_after(self):
+        """
+        Estimate how many seconds a rejected request should wait before
+        retrying: the time for the running and queued requests to finish at
+        the lane's recent pace, at least one second.
+        """
+        if not self.durations:
+            return 1
+        mean = sum(self.durations) / len(self.durations)
+        return max(1, math.ceil(mean * (self.waiting + self.active) /
+                                self.limit))
+
+    @asynccontextmanager
+    async def admit(self):
+        """
+        Hold a slot in the lane for the body of an `async with` block.
+
+        Raises:
+            HTTPException: 503 with a Retry-After header when every slot is
+                taken and the queue is full
+        """
+        # created lazily so it belongs to the running event loop
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.limit)
+
+        if self.active >= self.limit and self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail=f'Too many {self.name} requests, please retry later',
+                headers={'Retry-After': str(self.retry_after())})
+
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        admitted = time.perf_counter()
+        self.waits.append(admitted - start)
+        self.admitted += 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.durations.append(time.perf_counter() - admitted)
+            self.semaphore.release()
+
+    def stats(self):
+        """
+        Returns a dictionary of the lane's limits, counters and recent queue
+        wait percentiles in milliseconds.
+        """
+        waits = np.array(self.waits) * 1000
+        if len(waits):
+            p50, p95, p99 = np.percentile(waits, [50, 95, 99])
+            wait_ms = {'p50': round(p50, 2), 'p95': round(p95, 2),
+                       'p99': round(p99, 2), 'max': round(waits.max(), 2)}
+        else:
+            wait_ms = None
+
+        return {
+            'limit': self.limit,
+            'queue_size': self.queue_size,
+            'active': self.active,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'wait_ms': wait_ms,
+        }
+
+
+def lane_from_env(name, limit, queue_size):
+    """
+    Create an AdmissionLane whose limits can be overridden with the
+    SAVER_<NAME>_CONCURRENCY and SAVER_<NAME>_QUEUE environment variables.
+    """
+    prefix = f'SAVER_{name.upper()}'
+    return AdmissionLane(
+        name,
+        int(os.environ.get(f'{prefix}_CONCURRENCY', limit)),
+        int(os.environ.get(f'{prefix}_QUEUE', queue_size)))
+
+
+# budget forecasts
+forecast_lane = lane_from_env('forecast', 2, 8)
+# spending and money flow figures
+charts_lane = lane_from_env('charts', 4, 16)
+# priority lane for /dashboard and /current_month_spending, kept apart from
+# the CPU-heavy lanes
+light_lane = lane_from_env('light', 16, 64)
+# transaction exports, each holding a database connection outside the pool
+# until its download ends
+export_lane = lane_from_env('export', 2, 8)
+
+
+def admission_stats():
+    """
+    Returns the stats of every lane in this module.
+    """
+    return {lane.name: lane.stats()
+            for lane in (forecast_lane, charts_lane, light_lane,
+                         export_lane)}
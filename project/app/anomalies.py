@@ -0,0 +1,519 @@
+"""
+Streaming per-category spending anomaly alerts.
+
+Flags purchases that are far above a user's usual spending in their
+category ("this Food purchase is 3.2σ above your usual $24.10") as
+transactions arrive, without rerunning monthly_spending_totals() or
+rescanning the account's history.
+
+Each bank account keeps, for every category, the running count, weight,
+mean and sum of squared deviations (M2) of its purchase amounts, updated
+with Welford's algorithm in O(1) per transaction. With
+SAVER_ANOMALY_HALF_LIFE set, older purchases are exponentially decayed so
+that the norm follows the user's recent spending: before each update the
+weight and M2 are multiplied by a decay factor, which gives every past
+purchase a weight halving every half life (in purchases of the category).
+The variance is M2 divided by the weight.
+
+A purchase is an anomaly when its category has at least
+ANOMALY_MIN_COUNT earlier purchases and the amount is at least
+SAVER_ANOMALY_THRESHOLD standard deviations above their mean.
+
+An account's statistics are bootstrapped from its history in one
+vectorized pass, grouped expanding (or exponentially weighted) means and
+variances giving the same statistics as applying the purchases one by
+one. They are then caught up with the account's transactions whose id is
+above the latest applied, one small query, so that transactions are applied
+in id order on every worker:
+- before serving the statistics. They are served without that check for
+  SAVER_ANOMALY_MAX_AGE seconds after the last one, unless the account was
+  bumped in the meantime (see app/invalidation.py)
+- when transactions are sent to /ingest_transactions or announced by
+  Postgres notifications (see app/month_to_date.py)
+
+With SAVER_ANOMALY_STATE_DIR set, they are saved as one small JSON file per
+account, so a restarted worker doesn't need to bootstrap again. Workers
+sharing the directory don't replace a file that has applied more
+transactions than they have.
+"""
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.helpers import bank_account_exists, load_transaction_rows
+from app.invalidation import account_versions
+from app.singleflight import BlockingSingleFlight
+
+# directory the statistics are saved in. Unset keeps them in memory only
+ANOMALY_STATE_DIR = os.environ.get("SAVER_ANOMALY_STATE_DIR", "")
+
+# purchases of a category after which their weight has halved. 0 turns the
+# decay off
+ANOMALY_HALF_LIFE = float(os.environ.get("SAVER_ANOMALY_HALF_LIFE", 0))
+
+# standard deviations above the mean a purchase is an anomaly at
+ANOMALY_THRESHOLD = float(os.environ.get("SAVER_ANOMALY_THRESHOLD", 3))
+
+# earlier purchases a category needs before its purchases are checked
+ANOMALY_MIN_COUNT = 10
+
+# number of recent anomalies kept per account
+ANOMALY_RECENT = 50
+
+# category column the statistics are kept by
+ANOMALY_CATEGORY = 'grandparent_category_name'
+
+# seconds an account's statistics are served before checking the database
+# for new transactions again. 0 checks on every request
+ANOMALY_MAX_AGE = float(os.environ.get("SAVER_ANOMALY_MAX_AGE", 0))
+
+
+def decay_factor(half_life=ANOMALY_HALF_LIFE):
+    """
+    Return the factor past weights are multiplied by at each purchase, 1
+    without decay.
+    """
+    return 0.5 ** (1 / half_life) if half_life else 1.0
+
+
+def purchases(rows):
+    """
+    Return the purchases among rows returned by query.sql: expenses that
+    aren't transfers, in the order they were added.
+    """
+    rows = rows[(rows['grandparent_category_name'] != 'Transfers') &
+                (rows['amount_cents'] > 0)]
+    return rows.sort_values(by=['id']).drop_duplicates(subset='id')
+
+
+def alert(row, category, amount, mean, std):
+    """
+    Return the anomaly alert of a purchase.
+    """
+    z_score = (amount - mean) / std
+    return {
+        'transaction_id': int(row['id']),
+        'date': pd.Timestamp(row['date']).date().isoformat(),
+        'category': category,
+        'amount_dollars': round(amount, 2),
+        'usual_dollars': round(float(mean), 2),
+        'std_dollars': round(float(std), 2),
+        'z_score': round(float(z_score), 2),
+        'message': f"This {category} purchase of ${amount:.2f} is "
+                   f"{z_score:.1f}σ above your usual ${mean:.2f}",
+    }
+
+
+class SpendingStats():
+    """
+    Class used to keep the running purchase statistics of a bank account.
+
+    Attributes:
+        bank_id (int): bank account id
+        decay (float): factor past weights are multiplied by at each
+            purchase
+        categories (dict): position of each category in the arrays
+        counts (array): number of purchases of each category
+        weights (array): decayed number of purchases of each category
+        means (array): weighted mean purchase amount of each category
+        m2s (array): weighted sum of squared deviations from the mean
+        max_id (int): id of the latest transaction applied
+        alerts (list): most recent anomalies, oldest first
+        checked_at (float): time.monotonic() of the last check for new
+            transactions, None when the next request must check
+    """
+
+    def __init__(self, bank_id, decay=None):
+        """
+        Constructor for the SpendingStats class.
+
+        Parameters:
+            bank_id (int): bank account id
+            decay (float): factor past weights are multiplied by at each
+                purchase, from ANOMALY_HALF_LIFE by default
+        """
+        self.bank_id = int(bank_id)
+        self.decay = decay_factor() if decay is None else decay
+        self.categories = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.weights = np.zeros(0)
+        self.means = np.zeros(0)
+        self.m2s = np.zeros(0)
+        self.max_id = 0
+        self.alerts = []
+        self.checked_at = None
+
+    def add_categories(self, categories):
+        """
+        Add categories without purchases to the arrays.
+        """
+        new = [category for category in categories
+               if category not in self.categories]
+        for category in new:
+            self.categories[category] = len(self.categories)
+        self.counts = np.append(self.counts, np.zeros(len(new), np.int64))
+        for name in ('weights', 'means', 'm2s'):
+            setattr(self, name, np.append(getattr(self, name),
+                                          np.zeros(len(new))))
+
+    def std(self, i):
+        """
+        Returns the weighted standard deviation of category i.
+        """
+        return np.sqrt(self.m2s[i] / self.weights[i])
+
+    def update(self, category, amount):
+        """
+        Check a purchase against its category's statistics, then add it.
+
+        Returns:
+            the mean and standard deviation of the earlier purchases when
+            the purchase is an anomaly, otherwise None
+        """
+        if category not in self.categories:
+            self.add_categories([category])
+        i = self.categories[category]
+
+        anomaly = None
+        if self.counts[i] >= ANOMALY_MIN_COUNT:
+            std = self.std(i)
+            if std > 0 and amount - self.means[i] >= ANOMALY_THRESHOLD * std:
+                anomaly = (self.means[i], std)
+
+        self.counts[i] += 1
+        self.weights[i] = self.decay * self.weights[i] + 1
+        delta = amount - self.means[i]
+        self.means[i] += delta / self.weights[i]
+        self.m2s[i] = self.decay * self.m2s[i] + \
+            delta * (amount - self.means[i])
+        return anomaly
+
+    def apply(self, rows):
+        """
+        Add new transactions to the statistics. Transactions that were
+        already applied are ignored.
+
+        Parameters:
+            rows (dataframe): rows returned by query.sql, including the id
+
+        Returns:
+            list of the new anomalies
+        """
+        new_alerts = []
+        for _, row in purchases(rows[rows['id'] > self.max_id]).iterrows():
+            category = row[ANOMALY_CATEGORY]
+            amount = row['amount_cents'] / 100
+            anomaly = self.update(category, amount)
+            if anomaly is not None:
+                new_alerts.append(alert(row, category, amount, *anomaly))
+
+        if len(rows):
+            self.max_id = max(self.max_id, int(rows['id'].max()))
+        self.alerts = (self.alerts + new_alerts)[-ANOMALY_RECENT:]
+        return new_alerts
+
+    @classmethod
+    def bootstrap(cls, bank_id, rows, decay=None):
+        """
+        Build the statistics of a bank account's history in one vectorized
+        pass, with the anomalies among its latest purchases.
+
+        Parameters:
+            bank_id (int): bank account id
+            rows (dataframe): every row returned by query.sql for the account
+            decay (float): factor past weights are multiplied by at each
+                purchase
+
+        Returns:
+            SpendingStats
+        """
+        stats = cls(bank_id, decay)
+        history = purchases(rows).reset_index(drop=True)
+        if len(history) == 0:
+            return stats
+
+        amounts = history['amount_cents'] / 100
+        grouped = amounts.groupby(history[ANOMALY_CATEGORY], sort=False)
+        counts = grouped.cumcount() + 1
+
+        # mean and variance of each category after each purchase
+        if stats.decay == 1:
+            running = grouped.expanding()
+            variances = running.var(ddof=0)
+            weights = counts.astype(float)
+        else:
+            running = grouped.ewm(alpha=1 - stats.decay, adjust=True)
+            variances = running.var(bias=True)
+            weights = (1 - stats.decay ** counts) / (1 - stats.decay)
+        means = running.mean().reset_index(level=0, drop=True).sort_index()
+        variances = variances.reset_index(level=0, drop=True).sort_index() \
+            .fillna(0)
+
+        # each purchase is checked against the statistics before it
+        prior_means = means.groupby(history[ANOMALY_CATEGORY]).shift()
+        prior_stds = np.sqrt(
+            variances.groupby(history[ANOMALY_CATEGORY]).shift())
+        anomalies = (counts - 1 >= ANOMALY_MIN_COUNT) & (prior_stds > 0) & \
+            (amounts - prior_means >= ANOMALY_THRESHOLD * prior_stds)
+        for i in np.flatnonzero(anomalies.values)[-ANOMALY_RECENT:]:
+            stats.alerts.append(alert(history.iloc[i],
+                                      history[ANOMALY_CATEGORY].iloc[i],
+                                      amounts.iloc[i], prior_means.iloc[i],
+                                      prior_stds.iloc[i]))
+
+        last = history.groupby(ANOMALY_CATEGORY, sort=False).tail(1).index
+        stats.add_categories(history.loc[last, ANOMALY_CATEGORY])
+        stats.counts = counts[last].values.astype(np.int64)
+        stats.weights = weights[last].values
+        stats.means = means[last].values
+        stats.m2s = variances[last].values * stats.weights
+        stats.max_id = int(rows['id'].max())
+        return stats
+
+    def to_dict(self):
+        """
+        Returns the statistics as a JSON serializable dictionary.
+        """
+        return {'bank_id': self.bank_id, 'decay': self.decay,
+                'categories': list(self.categories),
+                'counts': self.counts.tolist(),
+                'weights': self.weights.tolist(),
+                'means': self.means.tolist(), 'm2s': self.m2s.tolist(),
+                'max_id': self.max_id, 'alerts': self.alerts}
+
+    @classmethod
+    def from_dict(cls, saved):
+        """
+        Returns the statistics saved with to_dict().
+        """
+        stats = cls(saved['bank_id'], saved['decay'])
+        stats.categories = {category: i for i, category
+                            in enumerate(saved['categories'])}
+        stats.counts = np.array(saved['counts'], dtype=np.int64)
+        stats.weights = np.array(saved['weights'], dtype=float)
+        stats.means = np.array(saved['means'], dtype=float)
+        stats.m2s = np.array(saved['m2s'], dtype=float)
+        stats.max_id = saved['max_id']
+        stats.alerts = saved['alerts']
+        return stats
+
+
+class AnomalyStore():
+    """
+    Class used to hold the SpendingStats of every bank account seen by this
+    worker.
+
+    Attributes:
+        directory (str): directory the statistics are saved in, empty to
+            keep them in memory only
+        decay (float): factor past weights are multiplied by at each
+            purchase
+        accounts (dict): SpendingStats for each bank account id
+        seeding (dict): for each account being bootstrapped, whether
+            transactions were ingested meanwhile
+        seeds (BlockingSingleFlight): runs one seed at a time per account
+        lock (Lock): guards accounts, seeding and the statistics, which are
+            shared with the notification listener thread
+    """
+
+    def __init__(self, directory=ANOMALY_STATE_DIR, decay=None):
+        """
+        Constructor for the AnomalyStore class.
+
+        Parameters:
+            directory (str): directory the statistics are saved in
+            decay (float): factor past weights are multiplied by at each
+                purchase, from ANOMALY_HALF_LIFE by default
+        """
+        self.directory = directory
+        self.decay = decay_factor() if decay is None else decay
+        self.accounts = {}
+        self.seeding = {}
+        self.seeds = BlockingSingleFlight()
+        self.lock = threading.Lock()
+
+    def path(self, bank_id):
+        """
+        Returns the file a bank account's statistics are saved in.
+        """
+        return os.path.join(self.directory, f'{int(bank_id)}.json')
+
+    def load(self, bank_id):
+        """
+        Returns the saved statistics of a bank account, or None if there are
+        none or they were built with another decay.
+        """
+        if not self.directory:
+            return None
+        try:
+            with open(self.path(bank_id)) as f:
+                stats = SpendingStats.from_dict(json.load(f))
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+        return stats if stats.decay == self.decay else None
+
+    def save(self, stats):
+        """
+        Write a bank account's statistics to its file, unless the file holds
+        statistics that applied later transactions, saved by another worker.
+        """
+        if not self.directory:
+            return
+        with self.lock:
+            saved = stats.to_dict()
+        current = self.load(stats.bank_id)
+        if current is not None and current.max_id > saved['max_id']:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(stats.bank_id)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp_path, path)
+
+    def seed(self, bank_id):
+        """
+        Load a bank account's statistics, bootstrapping them from its
+        history if they weren't saved. Concurrent requests for an account
+        being seeded wait for that seed.
+
+        Returns:
+            SpendingStats, or None if the bank account doesn't exist
+        """
+        return self.seeds.do(bank_id, self.fetch_seed, bank_id)
+
+    def fetch_seed(self, bank_id):
+        """
+        Load or bootstrap a bank account's statistics. Only called through
+        seed().
+
+        Returns:
+            SpendingStats, or None if the bank account doesn't exist
+        """
+        with self.lock:
+            self.seeding[bank_id] = False
+
+        try:
+            checked_at = time.monotonic()
+            stats = self.load(bank_id)
+            if stats is not None:
+                # catch up with the transactions added since the save
+                stats.apply(load_transaction_rows(bank_id,
+                                                  after_id=stats.max_id))
+            elif bank_account_exists(bank_id):
+                stats = SpendingStats.bootstrap(
+                    bank_id, load_transaction_rows(bank_id), self.decay)
+        except Exception:
+            with self.lock:
+                self.seeding.pop(bank_id, None)
+            raise
+
+        with self.lock:
+            ingested = self.seeding.pop(bank_id)
+            if stats is not None:
+                # transactions ingested while the history was loading are
+                # caught up on the next request
+                stats.checked_at = None if ingested else checked_at
+                self.accounts[bank_id] = stats
+        if stats is not None:
+            self.save(stats)
+        return stats
+
+    def catch_up(self, bank_id, stats):
+        """
+        Apply the account's transactions added since the latest applied.
+
+        Returns:
+            list of the new anomalies
+        """
+        with self.lock:
+            after_id = stats.max_id
+            # a bump during the query marks the statistics to check again
+            stats.checked_at = time.monotonic()
+
+        rows = load_transaction_rows(bank_id, after_id=after_id)
+
+        with self.lock:
+            new_alerts = stats.apply(rows)
+        if len(rows):
+            self.save(stats)
+        return new_alerts
+
+    def get(self, bank_id):
+        """
+        Returns the statistics of a bank account, seeding them if the
+        account hasn't been seen yet and catching up with new transactions
+        otherwise, or None if it doesn't exist.
+        """
+        with self.lock:
+            stats = self.accounts.get(bank_id)
+        if stats is None:
+            return self.seed(bank_id)
+
+        checked_at = stats.checked_at
+        if checked_at is None or \
+                time.monotonic() - checked_at >= ANOMALY_MAX_AGE:
+            self.catch_up(bank_id, stats)
+        return stats
+
+    def invalidate(self, bank_id):
+        """
+        Check the database for new transactions on the account's next
+        request, or on every account's next request for None.
+
+        Subscribed to account_versions, and called when notifications may
+        have been missed.
+        """
+        with self.lock:
+            if bank_id is None:
+                accounts = list(self.accounts.values())
+            else:
+                accounts = [self.accounts.get(bank_id)]
+            for stats in accounts:
+                if stats is not None:
+                    stats.checked_at = None
+
+    def alerts(self, bank_id, limit=ANOMALY_RECENT):
+        """
+        Returns a bank account's most recent anomalies, latest first, or
+        None if the bank account doesn't exist.
+        """
+        stats = self.get(bank_id)
+        if stats is None:
+            return None
+        with self.lock:
+            return stats.alerts[::-1][:limit]
+
+    def ingest(self, bank_id, transaction_ids):
+        """
+        Catch a bank account's statistics up after new transactions were
+        added.
+
+        The account's transactions above the latest applied are loaded
+        rather than the given ones, so that transactions sent to other
+        workers aren't skipped. Accounts that haven't been seeded yet are
+        skipped, they will pick the transactions up when they are seeded.
+
+        Parameters:
+            bank_id (int): bank account id
+            transaction_ids (list): ids of new plaid_main_transactions rows
+
+        Returns:
+            list of the new anomalies
+        """
+        with self.lock:
+            if bank_id in self.seeding:
+                self.seeding[bank_id] = True
+                return []
+            stats = self.accounts.get(bank_id)
+        if stats is None or not transaction_ids:
+            return []
+        return self.catch_up(bank_id, stats)
+
+
+anomaly_store = AnomalyStore()
+account_versions.subscribe(anomaly_store.invalidate)
@@ -0,0 +1,47 @@
+import logging
+
+from fastapi import APIRouter
+from app.singleflight import single_flight_stats, account_cache
+from app.invalidation import account_versions
+from app.admission import admission_stats
+from app.jobs import budget_jobs
+from app.merchants import merchant_index
+from app.peers import peer_benchmarks
+
+log = logging.getLogger(__name__)
+router = APIRouter()
+
+
+@router.get('/metrics')
+async def metrics():
+    """
+    Return internal counters for tuning the API
+
+    ### Response
+    - `single_flight`: for each coalesced loader, the number of calls, the
+    number of database fetches they triggered, the number of calls that
+    shared another call's fetch, and the number of fetches still running.
+    - `admission`: for each admission lane, its concurrency limit and queue
+    size, the number of requests running and waiting, the number admitted
+    and rejected with a 503, and recent queue wait percentiles in
+    milliseconds.
+    - `budget_jobs`: the number of background budget jobs started, joined by
+    identical submissions and rejected, and the number unfinished and kept.
+    - `reference_data`: for each dataset shared between the workers, the
+    published version this worker is attached to and the size of its arrays
+    in bytes.
+    - `account_cache`: the number of values cached by this worker, hits,
+    misses (including stale and expired values) and values evicted after
+    new data for their account.
+    - `invalidation`: the number of times every account was invalidated
+    (`epoch`), the number of account invalidations and the number of
+    accounts invalidated.
+    """
+    return {'single_flight': single_flight_stats(),
+            'admission': admission_stats(),
+            'budget_jobs': budget_jobs.stats(),
+            'reference_data': {
+                'peer_sketches': peer_benchmarks.reference.stats(),
+                'merchant_index': merchant_index.shared.stats()},
+            'account_cache': account_cache.stats(),
+            'invalidation': account_versions.stats()}
@@ -0,0 +1,61 @@
+import logging
+import math
+import re
+
+from fastapi import APIRouter, HTTPException
+from app.peers import LEVELS, peer_benchmarks
+
+log = logging.getLogger(__name__)
+router = APIRouter()
+
+
+@router.get('/peer_percentile/{category}')
+async def peer_percentile(category: str, amount: float, month: str = 'all',
+                          level: str = 'grandparent'):
+    """
+    Compare a user's spending in a category with other savers 👥
+
+    ### Path Parameter
+    `category`: category name, e.g. Food
+
+    ### Query Parameters
+    - `amount`: float, the user's spending in the category over a month
+    - `OPTIONAL: month`: str (YYYY-MM), compare with that month's spending
+    instead of any month's
+    - `OPTIONAL: level`: str (grandparent or parent), the category level
+
+    ### Response
+    - `percentile`: percentage of savers who spent at most the amount in
+    the category in the month, e.g. 70 for "you spend more on Food than 70%
+    of savers". Savers who spent nothing in the category that month are
+    included. Without `month`, every month of every saver's last 12
+    complete months counts once
+    - `sample_size`: number of account months the percentile is based on
+
+    Percentiles come from sketches built offline with
+    `python -m app.peers build`, and count spending up to about 2% above
+    the amount.
+    """
+    # nan and inf parse as floats but have no place on the sketch
+    if not math.isfinite(amount):
+        raise HTTPException(status_code=422,
+                            detail='amount must be a finite number')
+
+    if level not in LEVELS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"level must be one of {', '.join(LEVELS)}")
+
+    if month != 'all' and not re.fullmatch(r'\d{4}-\d{2}', month):
+        raise HTTPException(status_code=422,
+                            detail='month must be formatted as YYYY-MM')
+
+    result = peer_benchmarks.percentile(level, category, amount, month)
+    if result is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No peer spending for {category} in {month}")
+
+    percentile, sample_size = result
+    return {'category': category, 'month': month, 'amount': amount,
+            'percentile': round(percentile, 1), 'sample_size': sample_size}
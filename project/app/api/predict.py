@@ -7,6 +7,15 @@ import json
 from fastapi import APIRouter, HTTPException, Request, Query
 from app.helpers import *
 from app.user import User
+from app.singleflight import (load_budget_data_shared,
+                              load_user_accounts_data_shared)
+from app.month_to_date import month_to_date_store
+from app.admission import forecast_lane, light_lane
+from app.jobs import budget_jobs
+from app.streaming import load_budget_data
+from app.forecast_state import (FORECAST_STATE_DIR, forecast_states,
+                                forecast_budget)
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field, validator
 from typing import Optional, List
 
@@ -29,55 +38,98 @@ class Budget(BaseModel):
         """Convert pydantic object to python dictionary."""
         return dict(self)
 
-    @validator('bank_account_id')
-    def user_ID_must_exist(cls, value):
-        """Validate that user_id is a valid ID."""
-        conn = psycopg2.connect(user=SAVER_USERNAME, password=SAVER_PASSWORD,
-                                host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
-        query = f"""
-        SELECT id
-        FROM PUBLIC.plaid_main_transactions
-        WHERE bank_account_id = {value}
-        LIMIT 1
-        """
-        df = pd.read_sql(query, conn)
-        conn.close()
-        assert len(df) > 0, f'the bank_account_id {value} is invalid'
-        return value
 
+class UserBudget(BaseModel):
+    """Use this data model to parse the request body JSON."""
 
-@router.post('/future_budget')
-async def future_budget(budget: Budget):
-    """
-    Suggest a budget for a specified user.
+    user_id: int = Field(..., example=21)
+    monthly_savings_goal: int = Field(..., example=50)
 
-    ### Request Body
-    - `bank_account_id`: int
-    - `monthly_savings_goal`: integer
+    def to_dict(self):
+        """Convert pydantic object to python dictionary."""
+        return dict(self)
 
-    ### Response
-    - `category`: grandparent category name
-    - `budgeted_amount`: integer suggesting the maximum the user should spend
-    in that catgory next month
 
-    """
+# most savings goals a /future_budget/sweep request can evaluate
+MAX_SWEEP_GOALS = 1000
 
-    # Get the JSON object from the request body and cast it to a dictionary
-    input_dict = budget.to_dict()
-    bank_account_id = input_dict['bank_account_id']
-    monthly_savings_goal = input_dict['monthly_savings_goal']
 
-    transactions = load_user_data(bank_account_id)
+class BudgetSweep(BaseModel):
+    """Use this data model to parse the request body JSON."""
+
+    bank_account_id: int = Field(..., example=131952)
+    monthly_savings_goals: Optional[List[int]] = Field(None,
+                                                       example=[25, 50, 100])
+    min_goal: Optional[int] = Field(None, example=0)
+    max_goal: Optional[int] = Field(None, example=500)
+    step: Optional[int] = Field(None, example=25)
+
+    def to_dict(self):
+        """Convert pydantic object to python dictionary."""
+        return dict(self)
+
+    def goals(self):
+        """The savings goals listed, or those of the range."""
+        if self.monthly_savings_goals is not None:
+            return self.monthly_savings_goals
+        return list(range(self.min_goal, self.max_goal + 1, self.step))
+
+    @validator('step', always=True)
+    def goals_must_be_valid(cls, value, values):
+        """Validate that goals or a range of at most MAX_SWEEP_GOALS are given"""
+        goals = values.get('monthly_savings_goals')
+        if goals is None:
+            min_goal, max_goal = values.get('min_goal'), values.get('max_goal')
+            assert None not in (min_goal, max_goal, value), \
+                'provide monthly_savings_goals or min_goal, max_goal and step'
+            assert value > 0, f'the step, {value}, must be positive'
+            goals = range(min_goal, max_goal + 1, value)
+        assert 0 < len(goals) <= MAX_SWEEP_GOALS, \
+            f'provide between 1 and {MAX_SWEEP_GOALS} savings goals'
+        return value
+
+# User settings for budgets: chooses the category column
+# (cat_column='grandparent_category_name' or 'parent_category_name' also
+# work). Only the top merchants are forecast, the long tail is budgeted as a
+# single misc. category
+BUDGET_SETTINGS = {'cat_column': 'merchant_name', 'top_k': 50,
+                   'top_share': 0.99}
 
-    # instantiate the user and chooses category column
-    # user = User(transactions, cat_column='grandparent_category_name')
-    # user = User(transactions, cat_column='parent_category_name')
-    user = User(transactions, cat_column='merchant_name')
 
+def suggest_budget(transactions, monthly_savings_goal):
+    """
+    Return the /future_budget response for a dataframe of transactions.
+
+    The response is the budget dictionary, or a JSON string of the budget
+    (None on fatal errors) and the warning list when warnings were raised.
+    """
+
+    # instantiate the user
+    user = User(transactions, **BUDGET_SETTINGS)
 
     # predict budget using time series model
     pred_bud = user.predict_budget()
 
+    return budget_response(user, pred_bud, monthly_savings_goal)
+
+
+def account_budget(bank_account_id, monthly_savings_goal):
+    """
+    Return the /future_budget response for a bank account, updating the
+    budget from its saved forecast state when possible (see
+    app/forecast_state.py).
+    """
+    user, pred_bud = forecast_budget(bank_account_id, forecast_states,
+                                     **BUDGET_SETTINGS)
+    return budget_response(user, pred_bud, monthly_savings_goal)
+
+
+def budget_response(user, pred_bud, monthly_savings_goal):
+    """
+    Return the /future_budget response for a User and the output of its
+    predict_budget().
+    """
+
     # if a fatal error was encountered while generating the budget,
     # return no budget along with the warning list
     if user.warning == 2:
@@ -100,12 +152,304 @@ async def future_budget(budget: Budget):
     return modified_budget
 
 
+def sweep_response(user, pred_bud, monthly_savings_goals):
+    """
+    Return the /future_budget/sweep response for a User and the output of
+    its predict_budget(): the budget of every savings goal, None on fatal
+    errors, with its warning list.
+    """
+    if user.warning == 2:
+        results = [(None, user.warning, user.warning_list)] * \
+            len(monthly_savings_goals)
+    else:
+        results = user.budget_sweep(pred_bud, monthly_savings_goals)
+
+    return [{'monthly_savings_goal': goal, 'budget': budget,
+             'warning': warning, 'warnings': warning_list}
+            for goal, (budget, warning, warning_list)
+            in zip(monthly_savings_goals, results)]
+
+
+def suggest_budget_sweep(transactions, monthly_savings_goals):
+    """
+    Return the /future_budget/sweep response for a dataframe of
+    transactions.
+    """
+    user = User(transactions, **BUDGET_SETTINGS)
+    pred_bud = user.predict_budget()
+    return sweep_response(user, pred_bud, monthly_savings_goals)
+
+
+def account_budget_sweep(bank_account_id, monthly_savings_goals):
+    """
+    Return the /future_budget/sweep response for a bank account from its
+    saved forecast state when possible.
+    """
+    user, pred_bud = forecast_budget(bank_account_id, forecast_states,
+                                     **BUDGET_SETTINGS)
+    return sweep_response(user, pred_bud, monthly_savings_goals)
+
+
+def bands_response(user, pred_bud, monthly_savings_goal):
+    """
+    Return the /future_budget/bands response for a User and the output of
+    its predict_budget(): the /future_budget budget (None on fatal errors)
+    along with the percentiles of next month's spending.
+    """
+    if user.warning == 2:
+        return {'budget': None, 'bands': None, 'warning': user.warning,
+                'warnings': user.warning_list}
+
+    # the bands are of the forecast spending, before the savings goal is
+    # taken out of the budget
+    bands = user.budget_bands(pred_bud)
+    modified_budget = user.budget_modifier(
+        pred_bud, monthly_savings_goal=monthly_savings_goal)
+
+    return {'budget': modified_budget, 'bands': bands,
+            'warning': user.warning, 'warnings': user.warning_list}
+
+
+def suggest_budget_bands(transactions, monthly_savings_goal):
+    """
+    Return the /future_budget/bands response for a dataframe of
+    transactions.
+    """
+    user = User(transactions, **BUDGET_SETTINGS)
+    pred_bud = user.predict_budget()
+    return bands_response(user, pred_bud, monthly_savings_goal)
+
+
+def account_budget_bands(bank_account_id, monthly_savings_goal):
+    """
+    Return the /future_budget/bands response for a bank account from its
+    saved forecast state when possible.
+    """
+    user, pred_bud = forecast_budget(bank_account_id, forecast_states,
+                                     **BUDGET_SETTINGS)
+    return bands_response(user, pred_bud, monthly_savings_goal)
+
+
+def budget_job(bank_account_id, monthly_savings_goal):
+    """
+    Load a bank account's transactions and suggest a budget. Runs in the
+    job worker processes.
+    """
+    if FORECAST_STATE_DIR:
+        return account_budget(bank_account_id, monthly_savings_goal)
+    return suggest_budget(load_budget_data(bank_account_id),
+                          monthly_savings_goal)
+
+
+@router.post('/future_budget')
+async def future_budget(budget: Budget):
+    """
+    Suggest a budget for a specified user.
+
+    ### Request Body
+    - `bank_account_id`: int
+    - `monthly_savings_goal`: integer
+
+    ### Response
+    - `category`: grandparent category name
+    - `budgeted_amount`: integer suggesting the maximum the user should spend
+    in that catgory next month
+
+    """
+
+    # Get the JSON object from the request body and cast it to a dictionary
+    input_dict = budget.to_dict()
+    bank_account_id = input_dict['bank_account_id']
+    monthly_savings_goal = input_dict['monthly_savings_goal']
+    await check_bank_account(bank_account_id)
+
+    # forecasting is CPU bound, so it runs in the threadpool and only a few
+    # forecasts run at once
+    async with forecast_lane.admit():
+        # with saved forecast states, only the transactions since the last
+        # closed month are loaded
+        if FORECAST_STATE_DIR:
+            return await run_in_threadpool(account_budget, bank_account_id,
+                                           monthly_savings_goal)
+
+        transactions = await load_budget_data_shared(bank_account_id)
+
+        return await run_in_threadpool(suggest_budget, transactions,
+                                       monthly_savings_goal)
+
+
+@router.post('/future_budget/sweep')
+async def future_budget_sweep(sweep: BudgetSweep):
+    """
+    Suggest a budget for each of several savings goals, e.g. the positions
+    of a savings goal slider, forecasting the user's spending once.
+
+    ### Request Body
+    - `bank_account_id`: int
+    - `monthly_savings_goals`: list of integers, or
+    - `min_goal`, `max_goal` and `step`: integers of a range of savings goals
+    (`max_goal` included)
+
+    ### Response
+    A list with for each savings goal:
+    - `monthly_savings_goal`: the savings goal
+    - `budget`: the budget /future_budget suggests for the goal, null when
+    the goal can't be met
+    - `warning`: 0 without warnings, 1 for warnings, 2 for fatal warnings
+    - `warnings`: list of warning messages
+    """
+    bank_account_id = sweep.bank_account_id
+    monthly_savings_goals = sweep.goals()
+    await check_bank_account(bank_account_id)
+
+    async with forecast_lane.admit():
+        if FORECAST_STATE_DIR:
+            return await run_in_threadpool(account_budget_sweep,
+                                           bank_account_id,
+                                           monthly_savings_goals)
+
+        transactions = await load_budget_data_shared(bank_account_id)
+
+        return await run_in_threadpool(suggest_budget_sweep, transactions,
+                                       monthly_savings_goals)
+
+
+@router.post('/future_budget/bands')
+async def future_budget_bands(budget: Budget):
+    """
+    Suggest a budget for a specified user, with the range next month's
+    spending is likely to fall in.
+
+    ### Request Body
+    - `bank_account_id`: int
+    - `monthly_savings_goal`: integer
+
+    ### Response
+    - `budget`: the budget /future_budget suggests, null on fatal warnings
+    - `bands`: percentiles `p10`, `p50` and `p90` of next month's spending
+    in each budget category (`categories`) and in total (`total`), from
+    simulated months. Spending has an 80% chance to fall between `p10` and
+    `p90`
+    - `warning`: 0 without warnings, 1 for warnings, 2 for fatal warnings
+    - `warnings`: list of warning messages
+    """
+    input_dict = budget.to_dict()
+    bank_account_id = input_dict['bank_account_id']
+    monthly_savings_goal = input_dict['monthly_savings_goal']
+    await check_bank_account(bank_account_id)
+
+    async with forecast_lane.admit():
+        if FORECAST_STATE_DIR:
+            return await run_in_threadpool(account_budget_bands,
+                                           bank_account_id,
+                                           monthly_savings_goal)
+
+        transactions = await load_budget_data_shared(bank_account_id)
+
+        return await run_in_threadpool(suggest_budget_bands, transactions,
+                                       monthly_savings_goal)
+
+
+@router.post('/future_budget/jobs', status_code=202)
+async def future_budget_job(budget: Budget):
+    """
+    Start suggesting a budget in the background, for clients that can't wait
+    for /future_budget under load.
+
+    ### Request Body
+    - `bank_account_id`: int
+    - `monthly_savings_goal`: integer
+
+    ### Response
+    - `job_id`: id to poll with GET /future_budget/jobs/{job_id}
+    - `status`: queued, running, done or failed
+
+    A job already running for the same bank account and savings goal is
+    returned instead of starting a new one.
+    """
+    input_dict = budget.to_dict()
+    bank_account_id = input_dict['bank_account_id']
+    monthly_savings_goal = input_dict['monthly_savings_goal']
+    await check_bank_account(bank_account_id)
+
+    job = budget_jobs.submit((bank_account_id, monthly_savings_goal),
+                             budget_job, bank_account_id,
+                             monthly_savings_goal)
+    return job.to_dict()
+
+
+@router.get('/future_budget/jobs/{job_id}')
+async def future_budget_job_result(job_id: str):
+    """
+    Poll a budget job started with POST /future_budget/jobs.
+
+    ### Path Parameter
+    `job_id`: id returned when the job was started
+
+    ### Response
+    - `job_id`: the job's id
+    - `status`: queued, running, done or failed
+    - `result`: once done, the same response /future_budget gives, including
+    the warning list when warnings were raised
+    - `error`: once failed, the error raised by the job
+
+    Results are kept for a limited time after the job finishes. Any of the
+    API's workers can answer the poll, as long as they share SAVER_JOB_DIR.
+    """
+    job = budget_jobs.get(job_id)
+
+    if job is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Job ID, {job_id}, doesn't exist or has expired")
+
+    return job.to_dict()
+
+
+@router.post('/user_future_budget')
+async def user_future_budget(budget: UserBudget):
+    """
+    Suggest a budget covering all of a user's bank accounts.
+
+    ### Request Body
+    - `user_id`: int
+    - `monthly_savings_goal`: integer
+
+    ### Response
+    - `category`: grandparent category name
+    - `budgeted_amount`: integer suggesting the maximum the user should spend
+    in that catgory next month
+
+    """
+    input_dict = budget.to_dict()
+    await check_user(input_dict['user_id'])
+
+    async with forecast_lane.admit():
+        transactions = await load_user_accounts_data_shared(
+            input_dict['user_id'])
+
+        # linked accounts without transactions leave nothing to budget
+        if len(transactions) == 0:
+            raise HTTPException(
+                status_code=404,
+                detail=(f"User ID, {input_dict['user_id']}, "
+                        "has no transactions"))
+
+        return await run_in_threadpool(suggest_budget, transactions,
+                                       input_dict['monthly_savings_goal'])
+
+
 @router.get('/current_month_spending/{bank_account_id}')
 async def current_month_spending(bank_account_id: int, day_of_month: Optional[int] = None, categories: List[str] = Query(None)):
 
-    transactions = load_user_data(bank_account_id)
+    # month-to-date totals are seeded once a month, then only the
+    # transactions added since the last request are read
+    async with light_lane.admit():
+        spending = await run_in_threadpool(month_to_date_store.spending,
+                                           bank_account_id, categories or [],
+                                           date_cutoff=day_of_month)
 
-    if len(transactions) == 0:
+    if spending is None:
         raise HTTPException(
             status_code=404, 
             detail=f"Bank Account ID, {bank_account_id}, doesn't exist")
@@ -115,10 +459,4 @@ async def current_month_spending(bank_account_id: int, day_of_month: Optional[in
             status_code=404, 
             detail=f"Please provide the categories that were in the user's budget")
 
-    user = User(transactions)
-
-    if day_of_month:
-        return user.current_month_spending(fixed_categories=categories,
-                                           date_cutoff=day_of_month)
-    else:
-        return user.current_month_spending(fixed_categories=categories)
+    return spending
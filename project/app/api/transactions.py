@@ -0,0 +1,177 @@
+import logging
+from contextlib import AsyncExitStack
+from datetime import date
+
+import anyio
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from app.admission import export_lane, light_lane
+from app.anomalies import ANOMALY_RECENT, anomaly_store
+from app.export import EXPORT_FORMATS, export_transactions
+from app.helpers import bank_account_exists
+from app.month_to_date import month_to_date_store
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+log = logging.getLogger(__name__)
+router = APIRouter()
+
+
+class NewTransactions(BaseModel):
+    """Use this data model to parse the request body JSON."""
+    bank_account_id: int = Field(..., example=131952)
+    transaction_ids: List[int] = Field(..., example=[1001, 1002])
+
+    def to_dict(self):
+        """Convert pydantic object to python dictionary."""
+        return dict(self)
+
+
+class ExportResponse(StreamingResponse):
+    """
+    StreamingResponse that closes its chunk iterator, and with it the
+    export's database connection, as soon as the response ends, including
+    when the client disconnects mid-download. It then leaves the admission
+    lane the export was admitted in.
+
+    Attributes:
+        chunks (iterator): the export_transactions() chunks being sent
+        exit_stack (AsyncExitStack): holds the export lane slot
+    """
+
+    def __init__(self, chunks, exit_stack, **kwargs):
+        super().__init__(chunks, **kwargs)
+        self.chunks = chunks
+        self.exit_stack = exit_stack
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # shielded, since the response may be ending because it was
+            # cancelled
+            with anyio.CancelScope(shield=True):
+                await run_in_threadpool(self.chunks.close)
+                await self.exit_stack.aclose()
+
+
+@router.post('/ingest_transactions')
+async def ingest_transactions(new_transactions: NewTransactions):
+    """
+    Apply newly inserted transactions to the running month-to-date totals
+    used by `/current_month_spending`
+
+    ### Request Body
+    - `bank_account_id`: int
+    - `transaction_ids`: list of plaid_main_transactions ids
+
+    ### Response
+    - `applied`: number of transactions added to the totals. Transfers,
+    income, transactions from other months and transactions that were
+    already applied are not counted.
+    - `anomalies`: the new transactions flagged as unusual spending, as
+    listed by `/anomalies/{bank_account_id}`, for accounts whose anomalies
+    have been requested
+    """
+    input_dict = new_transactions.to_dict()
+
+    applied = await run_in_threadpool(month_to_date_store.ingest,
+                                      input_dict['bank_account_id'],
+                                      input_dict['transaction_ids'])
+
+    anomalies = await run_in_threadpool(anomaly_store.ingest,
+                                        input_dict['bank_account_id'],
+                                        input_dict['transaction_ids'])
+
+    return {'applied': applied, 'anomalies': anomalies}
+
+
+@router.get('/anomalies/{bank_account_id}')
+async def anomalies(bank_account_id: int, limit: int = 20):
+    """
+    List a bank account's recent purchases that are unusually large for
+    their category
+
+    ### Path Parameter
+    `bank_account_id`: unique bank acount id number
+
+    ### Query Parameter
+    `limit`: number of anomalies to return, at most 50
+
+    ### Response
+    - `anomalies`: latest first, the transaction_id, date, category
+    (grandparent category name), amount_dollars, the usual_dollars and
+    std_dollars of the category's earlier purchases, the z_score (standard
+    deviations above the usual amount) and a message, e.g. "This Food
+    purchase of $120.00 is 3.4σ above your usual $24.10"
+
+    The first request for an account builds its statistics from its
+    history, later ones are kept current as transactions arrive.
+    """
+    if not 0 < limit <= ANOMALY_RECENT:
+        raise HTTPException(
+            status_code=422,
+            detail=f"the limit, {limit}, must be between 1 and {ANOMALY_RECENT}")
+
+    async with light_lane.admit():
+        alerts = await run_in_threadpool(anomaly_store.alerts,
+                                         bank_account_id, limit)
+
+    if alerts is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Bank Account ID, {bank_account_id}, doesn't exist")
+
+    return {'anomalies': alerts}
+
+
+@router.get('/transactions/{bank_account_id}/export')
+async def export(bank_account_id: int, format: str = 'csv',
+                 start_date: Optional[date] = None,
+                 end_date: Optional[date] = None):
+    """
+    Download all of a bank account's transactions, or those in a date range
+
+    ### Path Parameter
+    `bank_account_id`: unique bank acount id number
+
+    ### Query Parameters
+    - `format`: 'csv' (default) or 'ndjson'
+    - `start_date`: YYYY-MM-DD, only transactions on or after this date
+    - `end_date`: YYYY-MM-DD, only transactions on or before this date
+
+    ### Response
+    A CSV file with a header row, or one JSON object per line, of the
+    transaction_id, date, amount_dollars, grandparent_category_name,
+    parent_category_name, category_id, canonical merchant_name and
+    raw_merchant_name of each transaction, oldest first. Rows are streamed
+    as they are read from the database, and only a few exports run at once.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"the format, {format}, is invalid. Please use {' or '.join(EXPORT_FORMATS)}")
+
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(
+            status_code=422,
+            detail=f"the start_date, {start_date}, is after the end_date, {end_date}")
+
+    if not await run_in_threadpool(bank_account_exists, bank_account_id):
+        raise HTTPException(
+            status_code=404,
+            detail=f"Bank Account ID, {bank_account_id}, doesn't exist")
+
+    # the lane slot is held until the download ends, see ExportResponse
+    exit_stack = AsyncExitStack()
+    await exit_stack.enter_async_context(export_lane.admit())
+
+    # the chunks are read and formatted in the threadpool as the response
+    # is sent
+    return ExportResponse(
+        export_transactions(bank_account_id, format, start_date, end_date),
+        exit_stack,
+        media_type=EXPORT_FORMATS[format],
+        headers={'Content-Disposition':
+                 f'attachment; filename="transactions_{bank_account_id}.{format}"'})
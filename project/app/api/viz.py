@@ -5,13 +5,50 @@ import pandas as pd
 
 from fastapi import APIRouter, HTTPException
 from app.helpers import *
-from app.user import User
+from app.user import User, TIME_PERIOD_DAYS
+from app.singleflight import (load_chart_data_shared,
+                              load_user_data_window_shared,
+                              load_user_accounts_data_shared)
+from app.admission import charts_lane
+from app.periods import (DEFAULT_TIME_PERIODS, spending_periods,
+                         money_flow_periods)
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field, validator
-from typing import Optional
+from typing import Optional, List
 
 log = logging.getLogger(__name__)
 router = APIRouter()
 
+# plotly's built-in sequential color scales, built once rather than on
+# every validation
+COLOR_TEMPLATES = frozenset([
+    'Aggrnyl', 'Aggrnyl_r', 'Agsunset', 'Agsunset_r',
+    'Blackbody', 'Blackbody_r', 'Bluered', 'Bluered_r', 'Blues',
+    'Blues_r', 'Blugrn', 'Blugrn_r', 'Bluyl', 'Bluyl_r',
+    'Brwnyl', 'Brwnyl_r', 'BuGn', 'BuGn_r', 'BuPu', 'BuPu_r',
+    'Burg', 'Burg_r', 'Burgyl', 'Burgyl_r', 'Cividis',
+    'Cividis_r', 'Darkmint', 'Darkmint_r', 'Electric', 'Electric_r',
+    'Emrld', 'Emrld_r', 'GnBu', 'GnBu_r', 'Greens',
+    'Greens_r', 'Greys', 'Greys_r', 'Hot', 'Hot_r', 'Inferno',
+    'Inferno_r', 'Jet', 'Jet_r', 'Magenta', 'Magenta_r',
+    'Magma', 'Magma_r', 'Mint', 'Mint_r', 'OrRd', 'OrRd_r',
+    'Oranges', 'Oranges_r', 'Oryel', 'Oryel_r', 'Peach',
+    'Peach_r', 'Pinkyl', 'Pinkyl_r', 'Plasma', 'Plasma_r',
+    'Plotly3', 'Plotly3_r', 'PuBu', 'PuBuGn', 'PuBuGn_r',
+    'PuBu_r', 'PuRd', 'PuRd_r', 'Purp', 'Purp_r', 'Purples',
+    'Purples_r', 'Purpor', 'Purpor_r', 'Rainbow', 'Rainbow_r',
+    'RdBu', 'RdBu_r', 'RdPu', 'RdPu_r', 'Redor', 'Redor_r',
+    'Reds', 'Reds_r', 'Sunset', 'Sunset_r', 'Sunsetdark',
+    'Sunsetdark_r', 'Teal', 'Teal_r', 'Tealgrn', 'Tealgrn_r',
+    'Viridis', 'Viridis_r', 'YlGn', 'YlGnBu', 'YlGnBu_r',
+    'YlGn_r', 'YlOrBr', 'YlOrBr_r', 'YlOrRd', 'YlOrRd_r',
+    'algae', 'algae_r', 'amp', 'amp_r', 'deep', 'deep_r',
+    'dense', 'dense_r', 'gray', 'gray_r', 'haline',
+    'haline_r', 'ice', 'ice_r', 'matter', 'matter_r', 'solar',
+    'solar_r', 'speed', 'speed_r', 'swatches', 'tempo',
+    'tempo_r', 'thermal', 'thermal_r', 'turbid', 'turbid_r',
+])
+
 
 class Item(BaseModel):
     """Use this data model to parse the request body JSON."""
@@ -20,6 +57,7 @@ class Item(BaseModel):
     time_period: str = Field(..., example='week')
     color_template: Optional[str] = Field('Greens_r', example='Greens_r')
     hole: Optional[float] = Field(0.8, example=0.8)
+    resolution: Optional[str] = Field('day', example='auto')
 
     def to_df(self):
         """Convert pydantic object to pandas dataframe with 1 row."""
@@ -29,62 +67,50 @@ class Item(BaseModel):
         """Convert pydantic object to python dictionary."""
         return dict(self)
 
-    @validator('bank_account_id')
-    def user_ID_must_exist(cls, value):
-        """Validate that user_id is a valid ID."""
-        conn = psycopg2.connect(user=SAVER_USERNAME, password=SAVER_PASSWORD,
-                                host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
-        query = f"""
-        SELECT id
-        FROM PUBLIC.plaid_main_transactions
-        WHERE bank_account_id = {value}
-        LIMIT 1
-        """
-        df = pd.read_sql(query, conn)
-        conn.close()
-        assert len(df) > 0, f'the bank_account_id {value} is invalid'
+    @validator('color_template')
+    def color_template_must_be_valid(cls, value):
+        """Validate that the color_template value is valid"""
+        error_str = f'the color template, {value}, is invalid. Please see a list of valid templates at https://plotly.com/python/builtin-colorscales/#builtin-sequential-color-scales'
+        assert value in COLOR_TEMPLATES, error_str
         return value
 
+    @validator('resolution')
+    def resolution_must_be_valid(cls, value):
+        """Validate that the resolution value is valid"""
+        assert value in ('day', 'week', 'month', 'auto'), \
+            f"the resolution, {value}, is invalid. Please use 'day', 'week', 'month' or 'auto'"
+        return value
+
+
+class UserItem(BaseModel):
+    """Use this data model to parse the request body JSON."""
+    user_id: int = Field(..., example=21)
+    graph_type: str = Field(..., example='pie')
+    time_period: str = Field(..., example='week')
+    color_template: Optional[str] = Field('Greens_r', example='Greens_r')
+    hole: Optional[float] = Field(0.8, example=0.8)
+    resolution: Optional[str] = Field('day', example='auto')
+
+    def to_dict(self):
+        """Convert pydantic object to python dictionary."""
+        return dict(self)
+
     @validator('color_template')
     def color_template_must_be_valid(cls, value):
         """Validate that the color_template value is valid"""
-        color_template_set = set(
-            ['Aggrnyl', 'Aggrnyl_r', 'Agsunset', 'Agsunset_r',
-             'Blackbody', 'Blackbody_r', 'Bluered', 'Bluered_r', 'Blues',
-             'Blues_r', 'Blugrn', 'Blugrn_r', 'Bluyl', 'Bluyl_r',
-             'Brwnyl', 'Brwnyl_r', 'BuGn', 'BuGn_r', 'BuPu', 'BuPu_r',
-             'Burg', 'Burg_r', 'Burgyl', 'Burgyl_r', 'Cividis',
-             'Cividis_r', 'Darkmint', 'Darkmint_r', 'Electric', 'Electric_r',
-             'Emrld', 'Emrld_r', 'GnBu', 'GnBu_r', 'Greens',
-             'Greens_r', 'Greys', 'Greys_r', 'Hot', 'Hot_r', 'Inferno',
-             'Inferno_r', 'Jet', 'Jet_r', 'Magenta', 'Magenta_r',
-             'Magma', 'Magma_r', 'Mint', 'Mint_r', 'OrRd', 'OrRd_r',
-             'Oranges', 'Oranges_r', 'Oryel', 'Oryel_r', 'Peach',
-             'Peach_r', 'Pinkyl', 'Pinkyl_r', 'Plasma', 'Plasma_r',
-             'Plotly3', 'Plotly3_r', 'PuBu', 'PuBuGn', 'PuBuGn_r',
-             'PuBu_r', 'PuRd', 'PuRd_r', 'Purp', 'Purp_r', 'Purples',
-             'Purples_r', 'Purpor', 'Purpor_r', 'Rainbow', 'Rainbow_r',
-             'RdBu', 'RdBu_r', 'RdPu', 'RdPu_r', 'Redor', 'Redor_r',
-             'Reds', 'Reds_r', 'Sunset', 'Sunset_r', 'Sunsetdark',
-             'Sunsetdark_r', 'Teal', 'Teal_r', 'Tealgrn', 'Tealgrn_r',
-             'Viridis', 'Viridis_r', 'YlGn', 'YlGnBu', 'YlGnBu_r',
-             'YlGn_r', 'YlOrBr', 'YlOrBr_r', 'YlOrRd', 'YlOrRd_r',
-             'algae', 'algae_r', 'amp', 'amp_r', 'deep', 'deep_r',
-             'dense', 'dense_r', 'gray', 'gray_r', 'haline',
-             'haline_r', 'ice', 'ice_r', 'matter', 'matter_r', 'solar',
-             'solar_r', 'speed', 'speed_r', 'swatches', 'tempo',
-             'tempo_r', 'thermal', 'thermal_r', 'turbid', 'turbid_r',
-             ])
+        return Item.color_template_must_be_valid(value)
 
-        error_str = f'the color template, {value}, is invalid. Please see a list of valid templates at https://plotly.com/python/builtin-colorscales/#builtin-sequential-color-scales'
-        assert value in color_template_set, error_str
-        return value
+    @validator('resolution')
+    def resolution_must_be_valid(cls, value):
+        """Validate that the resolution value is valid"""
+        return Item.resolution_must_be_valid(value)
 
 
 class MoneyFlow(BaseModel):
     """Use this data model to parse the request body JSON."""
     bank_account_id: int = Field(..., example=131952)
     time_period: str = Field(..., example='week')
+    max_points: Optional[int] = Field(None, example=500)
 
     def to_df(self):
         """Convert pydantic object to pandas dataframe with 1 row."""
@@ -94,22 +120,139 @@ class MoneyFlow(BaseModel):
         """Convert pydantic object to python dictionary."""
         return dict(self)
 
-    @validator('bank_account_id')
-    def user_ID_must_exist(cls, value):
-        """Validate that user_id is a valid ID."""
-        conn = psycopg2.connect(user=SAVER_USERNAME, password=SAVER_PASSWORD,
-                                host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
-        query = f"""
-        SELECT id
-        FROM PUBLIC.plaid_main_transactions
-        WHERE bank_account_id = {value}
-        LIMIT 1
-        """
-        df = pd.read_sql(query, conn)
-        conn.close()
-        assert len(df) > 0, f'the bank_account_id {value} is invalid'
+    @validator('max_points')
+    def max_points_must_be_valid(cls, value):
+        """Validate that max_points is at least 3"""
+        assert value is None or value >= 3, \
+            f'max_points must be at least 3. Got {value} instead'
+        return value
+
+
+class UserMoneyFlow(BaseModel):
+    """Use this data model to parse the request body JSON."""
+    user_id: int = Field(..., example=21)
+    time_period: str = Field(..., example='week')
+    max_points: Optional[int] = Field(None, example=500)
+
+    def to_dict(self):
+        """Convert pydantic object to python dictionary."""
+        return dict(self)
+
+    @validator('max_points')
+    def max_points_must_be_valid(cls, value):
+        """Validate that max_points is at least 3"""
+        return MoneyFlow.max_points_must_be_valid(value)
+
+
+class SpendingPeriods(BaseModel):
+    """Use this data model to parse the request body JSON."""
+    bank_account_id: int = Field(..., example=131952)
+    graph_type: str = Field(..., example='pie')
+    time_periods: List[str] = Field(DEFAULT_TIME_PERIODS,
+                                    example=DEFAULT_TIME_PERIODS)
+    color_template: Optional[str] = Field('Greens_r', example='Greens_r')
+    hole: Optional[float] = Field(0.8, example=0.8)
+    resolution: Optional[str] = Field('day', example='auto')
+
+    def to_dict(self):
+        """Convert pydantic object to python dictionary."""
+        return dict(self)
+
+    @validator('graph_type')
+    def graph_type_must_be_valid(cls, value):
+        """Validate that the graph_type value is valid"""
+        assert value in ('pie', 'bar'), \
+            f"the graph type, {value}, is invalid. Please use 'pie' or 'bar'"
         return value
 
+    @validator('time_periods')
+    def time_periods_must_be_valid(cls, value):
+        """Validate that the time periods are valid, dropping repeats"""
+        return time_periods_must_be_valid(value)
+
+    @validator('color_template')
+    def color_template_must_be_valid(cls, value):
+        """Validate that the color_template value is valid"""
+        return Item.color_template_must_be_valid(value)
+
+    @validator('resolution')
+    def resolution_must_be_valid(cls, value):
+        """Validate that the resolution value is valid"""
+        return Item.resolution_must_be_valid(value)
+
+
+class MoneyFlowPeriods(BaseModel):
+    """Use this data model to parse the request body JSON."""
+    bank_account_id: int = Field(..., example=131952)
+    time_periods: List[str] = Field(DEFAULT_TIME_PERIODS,
+                                    example=DEFAULT_TIME_PERIODS)
+    max_points: Optional[int] = Field(None, example=500)
+
+    def to_dict(self):
+        """Convert pydantic object to python dictionary."""
+        return dict(self)
+
+    @validator('time_periods')
+    def time_periods_must_be_valid(cls, value):
+        """Validate that the time periods are valid, dropping repeats"""
+        return time_periods_must_be_valid(value)
+
+    @validator('max_points')
+    def max_points_must_be_valid(cls, value):
+        """Validate that max_points is at least 3"""
+        return MoneyFlow.max_points_must_be_valid(value)
+
+
+def time_periods_must_be_valid(value):
+    """
+    Validate a list of time periods for the /periods routes. Returns the
+    list without repeats.
+    """
+    assert len(value) > 0, 'time_periods must not be empty'
+    for time_period in value:
+        assert time_period in TIME_PERIOD_DAYS or time_period == 'all', \
+            f"the time period, {time_period}, is invalid. Please use 'day', 'week', 'month', 'year' or 'all'"
+    return list(dict.fromkeys(value))
+
+
+async def load_periods_data(bank_account_id, time_periods,
+                            expenses_only=False):
+    """
+    Load the transactions covering the longest of several time periods.
+    The windows of the shorter periods end at the same date, so they are
+    part of the longest one.
+    """
+    if 'all' in time_periods:
+        return await load_chart_data_shared(bank_account_id)
+    days = max(TIME_PERIOD_DAYS[time_period] for time_period in time_periods)
+    return await load_user_data_window_shared(bank_account_id, days,
+                                              expenses_only=expenses_only)
+
+
+def spending_chart(transactions, graph_type, time_period, color_template,
+                   hole, resolution='day'):
+    """
+    Return the jsonified plotly spending chart of the given graph type.
+    """
+    user = User(transactions, hole=hole)
+
+    if graph_type == 'pie':
+        return user.categorical_spending(time_period=time_period,
+                                         color_template=color_template)
+
+    if graph_type == 'bar':
+        return user.bar_viz(time_period=time_period,
+                            color_template=color_template,
+                            resolution=resolution)
+
+
+def money_flow_chart(transactions, time_period, max_points=None):
+    """
+    Return the jsonified plotly money flow chart.
+    """
+    user = User(transactions)
+    return user.money_flow(time_period=time_period, max_points=max_points)
+
 
 @router.post('/moneyflow')
 async def moneyflow(moneyflow: MoneyFlow):
@@ -118,6 +261,8 @@ async def moneyflow(moneyflow: MoneyFlow):
     ### Request Body
     - `bank_account_id`: int
     - `time_period`: str (week, month, year, all)
+    - `OPTIONAL: max_points`: int (at least 3), downsamples the line to at
+    most this many points
 
     ### Response
     - `plotly object`:
@@ -127,11 +272,21 @@ async def moneyflow(moneyflow: MoneyFlow):
     input_dict = moneyflow.to_dict()
     bank_account_id = input_dict['bank_account_id']
     time_period = input_dict['time_period']
+    await check_bank_account(bank_account_id)
 
-    transactions = load_user_data(bank_account_id)
+    # building figures is CPU bound, so it runs in the threadpool and only a
+    # few charts are built at once
+    async with charts_lane.admit():
+        # only fetch the rows the chart will use when the time period is
+        # bounded
+        if time_period in TIME_PERIOD_DAYS:
+            transactions = await load_user_data_window_shared(
+                bank_account_id, TIME_PERIOD_DAYS[time_period])
+        else:
+            transactions = await load_chart_data_shared(bank_account_id)
 
-    user = User(transactions)
-    return user.money_flow(time_period=time_period)
+        return await run_in_threadpool(money_flow_chart, transactions,
+                                       time_period, input_dict['max_points'])
 
 
 @router.post('/spending')
@@ -144,6 +299,9 @@ async def spending(item: Item):
     - `time_period`: str (week, month, year, all)
     - `OPTIONAL: color_template`: [Color Template Options (Sequential only)](https://plotly.com/python/builtin-colorscales/#builtin-sequential-color-scales)
     - `OPTIONAL: hole`: float (0 - 1)
+    - `OPTIONAL: resolution`: str (day, week, month, auto), bar chart bucket
+    size. Year and all bar charts have their totals labeled when bucketed
+    into weeks or months
     ### Response
     - `plotly object`:
     visualizing the user's spending habits in the form of the selected graph
@@ -156,15 +314,160 @@ async def spending(item: Item):
     time_period = input_dict['time_period']
     color_template = input_dict['color_template']
     hole = input_dict['hole']
+    await check_bank_account(bank_account_id)
 
-    transactions = load_user_data(bank_account_id)
+    async with charts_lane.admit():
+        # only fetch the rows the chart will use when the time period is
+        # bounded. spending charts are built from the user's expenses, so the
+        # window is anchored on the latest expense
+        if time_period in TIME_PERIOD_DAYS:
+            transactions = await load_user_data_window_shared(
+                bank_account_id, TIME_PERIOD_DAYS[time_period],
+                expenses_only=True)
+        else:
+            transactions = await load_chart_data_shared(bank_account_id)
 
-    user = User(transactions, hole=hole)
+        return await run_in_threadpool(spending_chart, transactions,
+                                       graph_type, time_period,
+                                       color_template, hole,
+                                       input_dict['resolution'])
 
-    if graph_type == 'pie':
-        return user.categorical_spending(time_period=time_period,
-                                         color_template=color_template)
 
-    if graph_type == 'bar':
-        return user.bar_viz(time_period=time_period,
-                            color_template=color_template)
+@router.post('/moneyflow/periods')
+async def moneyflow_by_period(moneyflow: MoneyFlowPeriods):
+    """
+    Visualize a user's money flow 📈 over several time periods at once, for
+    filling a set of period tabs with one request
+    ### Request Body
+    - `bank_account_id`: int
+    - `OPTIONAL: time_periods`: list of str (day, week, month, year, all),
+    defaults to week, month, year and all
+    - `OPTIONAL: max_points`: int (at least 3), downsamples each line to at
+    most this many points
+
+    ### Response
+    - `time period`: for each time period, the `plotly object` /moneyflow
+    returns for it
+    """
+    input_dict = moneyflow.to_dict()
+    time_periods = input_dict['time_periods']
+    await check_bank_account(input_dict['bank_account_id'])
+
+    async with charts_lane.admit():
+        transactions = await load_periods_data(
+            input_dict['bank_account_id'], time_periods)
+
+        return await run_in_threadpool(money_flow_periods, transactions,
+                                       time_periods,
+                                       input_dict['max_points'])
+
+
+@router.post('/spending/periods')
+async def spending_by_period(item: SpendingPeriods):
+    """
+    Make visualizations based on past spending 📊 over several time periods
+    at once, for filling a set of period tabs with one request
+    ### Request Body
+    - `bank_account_id`: int
+    - `graph_type`: str (pie or bar)
+    - `OPTIONAL: time_periods`: list of str (day, week, month, year, all),
+    defaults to week, month, year and all
+    - `OPTIONAL: color_template`: [Color Template Options (Sequential only)](https://plotly.com/python/builtin-colorscales/#builtin-sequential-color-scales)
+    - `OPTIONAL: hole`: float (0 - 1)
+    - `OPTIONAL: resolution`: str (day, week, month, auto), bar chart bucket
+    size. With auto, it is picked for each time period
+    ### Response
+    - `time period`: for each time period, the `plotly object` /spending
+    returns for it
+    """
+    input_dict = item.to_dict()
+    time_periods = input_dict['time_periods']
+    await check_bank_account(input_dict['bank_account_id'])
+
+    async with charts_lane.admit():
+        # spending charts are built from the user's expenses, so the window
+        # is anchored on the latest expense
+        transactions = await load_periods_data(
+            input_dict['bank_account_id'], time_periods, expenses_only=True)
+
+        return await run_in_threadpool(spending_periods, transactions,
+                                       input_dict['graph_type'],
+                                       time_periods,
+                                       input_dict['color_template'],
+                                       input_dict['hole'],
+                                       input_dict['resolution'])
+
+
+@router.post('/user_moneyflow')
+async def user_moneyflow(moneyflow: UserMoneyFlow):
+    """
+    Visualize the money flow across all of a user's bank accounts 📈
+    ### Request Body
+    - `user_id`: int
+    - `time_period`: str (week, month, year, all)
+    - `OPTIONAL: max_points`: int (at least 3), downsamples the line to at
+    most this many points
+
+    ### Response
+    - `plotly object`:
+    visualizing the user's combined money flow over the specified time
+    period. Transfers between the user's own accounts are left out.
+    """
+    input_dict = moneyflow.to_dict()
+    await check_user(input_dict['user_id'])
+
+    async with charts_lane.admit():
+        transactions = await load_user_accounts_data_shared(
+            input_dict['user_id'])
+
+        # linked accounts without transactions leave nothing to chart
+        if len(transactions) == 0:
+            raise HTTPException(
+                status_code=404,
+                detail=(f"User ID, {input_dict['user_id']}, "
+                        "has no transactions"))
+
+        return await run_in_threadpool(money_flow_chart, transactions,
+                                       input_dict['time_period'],
+                                       input_dict['max_points'])
+
+
+@router.post('/user_spending')
+async def user_spending(item: UserItem):
+    """
+    Make visualizations based on past spending across all of a user's bank
+    accounts 📊
+    ### Request Body
+    - `user_id`: int
+    - `graph_type`: str (pie or bar)
+    - `time_period`: str (week, month, year, all)
+    - `OPTIONAL: color_template`: [Color Template Options (Sequential only)](https://plotly.com/python/builtin-colorscales/#builtin-sequential-color-scales)
+    - `OPTIONAL: hole`: float (0 - 1)
+    - `OPTIONAL: resolution`: str (day, week, month, auto), bar chart bucket
+    size. Year and all bar charts have their totals labeled when bucketed
+    into weeks or months
+    ### Response
+    - `plotly object`:
+    visualizing the user's combined spending habits in the form of the
+    selected graph type.
+    """
+    input_dict = item.to_dict()
+    await check_user(input_dict['user_id'])
+
+    async with charts_lane.admit():
+        transactions = await load_user_accounts_data_shared(
+            input_dict['user_id'])
+
+        # linked accounts without transactions leave nothing to chart
+        if len(transactions) == 0:
+            raise HTTPException(
+                status_code=404,
+                detail=(f"User ID, {input_dict['user_id']}, "
+                        "has no transactions"))
+
+        return await run_in_threadpool(spending_chart, transactions,
+                                       input_dict['graph_type'],
+                                       input_dict['time_period'],
+                                       input_dict['color_template'],
+                                       input_dict['hole'],
+                                       input_dict['resolution'])
@@ -0,0 +1,171 @@
+"""
+Streaming exports of a bank account's transactions.
+
+/dashboard builds a user's whole history in a dataframe and serializes it
+at once, which costs memory in proportion to the account's history. Exports
+instead read query.sql through a named (server-side) cursor, CHUNK_SIZE rows
+at a time, and write each chunk as CSV or NDJSON text before fetching the
+next one, so memory stays flat whatever the size of the account:
+- categories are mapped by query.sql's CASE expressions as the rows are read
+- raw merchant names are canonicalized a chunk at a time with the shared
+  merchant index (see app/merchants.py)
+
+Rows are ordered by date and id, optionally filtered to a date range.
+
+A download holds its cursor, and so its connection, until the last chunk is
+sent, at the pace of the client. Exports therefore use a connection of
+their own rather than one from the pool the other routes share, and the
+route caps how many run at once with the export admission lane. Closing the
+iterator export_transactions() returns closes the connection.
+"""
+import csv
+import io
+import json
+import uuid
+from datetime import timedelta
+
+import pandas as pd
+import psycopg2
+
+from app.helpers import (SAVER_USERNAME, SAVER_PASSWORD, SAVER_DB_HOST,
+                         SAVER_DB_NAME, QUERY_SQL)
+from app.merchants import canonicalize_merchants
+from app.streaming import CHUNK_SIZE
+
+# columns of the exported rows, in order
+EXPORT_COLUMNS = ['transaction_id', 'date', 'amount_dollars',
+                  'grandparent_category_name', 'parent_category_name',
+                  'category_id', 'merchant_name', 'raw_merchant_name']
+
+EXPORT_FORMATS = {'csv': 'text/csv',
+                  'ndjson': 'application/x-ndjson'}
+
+
+def export_query(start_date=None, end_date=None):
+    """
+    Return the export statement, with the bank_id, start and end
+    parameters the filters use.
+
+    Parameters:
+        start_date (date): only export transactions on or after this date
+        end_date (date): only export transactions on or before this date
+    """
+    statement = QUERY_SQL + ' %(bank_id)s'
+    if start_date is not None:
+        statement += ' AND date >= %(start)s'
+    if end_date is not None:
+        statement += ' AND date < %(end)s'
+    return statement + ' ORDER BY date, id'
+
+
+def stream_export_rows(bank_id, start_date=None, end_date=None,
+                       chunk_size=CHUNK_SIZE):
+    """
+    Yield a bank account's transactions in chunks of at most chunk_size
+    rows, read through a server-side cursor on a connection outside the
+    pool. Each chunk is fetched and formatted before it is yielded, and the
+    connection is closed when the generator finishes or is closed.
+
+    Parameters:
+        bank_id (int): bank account id
+        start_date (date): only export transactions on or after this date
+        end_date (date): only export transactions on or before this date
+        chunk_size (int): number of rows per chunk
+
+    Yields:
+        lists of tuples with the values of EXPORT_COLUMNS
+    """
+    params = {'bank_id': int(bank_id), 'start': start_date,
+              'end': end_date + timedelta(days=1) if end_date else None}
+
+    conn = psycopg2.connect(user=SAVER_USERNAME, password=SAVER_PASSWORD,
+                            host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
+    try:
+        # a named cursor keeps the result set on the server
+        cursor = conn.cursor(name=f'export_{uuid.uuid4().hex}')
+        cursor.itersize = chunk_size
+        cursor.execute(export_query(start_date, end_date), params)
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            columns = [column.name for column in cursor.description]
+            positions = [columns.index(name) for name in
+                         ('id', 'date', 'amount_cents',
+                          'grandparent_category_name',
+                          'parent_category_name', 'category_id',
+                          'merchant_name')]
+            raw_names = [row[positions[-1]] for row in rows]
+            merchants = canonicalize_merchants(pd.Series(raw_names,
+                                                         dtype=object))
+            yield [(row[positions[0]], row[positions[1]].date().isoformat(),
+                    row[positions[2]] / 100, row[positions[3]],
+                    row[positions[4]], row[positions[5]], merchant, raw)
+                   for row, merchant, raw in zip(rows, merchants, raw_names)]
+    finally:
+        conn.close()
+
+
+def csv_chunks(row_chunks):
+    """
+    Yield the CSV text of chunks of export rows, starting with the header.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in row_chunks:
+        writer.writerows((transaction_id, date, f'{amount:.2f}', *rest)
+                         for transaction_id, date, amount, *rest in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # the header alone when there are no rows
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def ndjson_chunks(row_chunks):
+    """
+    Yield the newline delimited JSON text of chunks of export rows, one
+    object per transaction.
+    """
+    for rows in row_chunks:
+        yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n'
+                      for row in rows)
+
+
+def close_after(chunks, row_chunks):
+    """
+    Yield the text chunks, then close the row chunks they are written from,
+    also when the consumer stops early.
+    """
+    try:
+        yield from chunks
+    finally:
+        row_chunks.close()
+
+
+def export_transactions(bank_id, export_format='csv', start_date=None,
+                        end_date=None, chunk_size=CHUNK_SIZE):
+    """
+    Return an iterator of the text of a bank account's export, a chunk of
+    rows at a time. Close it to release the export's connection before the
+    last chunk.
+
+    Parameters:
+        bank_id (int): bank account id
+        export_format (str): 'csv' or 'ndjson'
+        start_date (date): only export transactions on or after this date
+        end_date (date): only export transactions on or before this date
+        chunk_size (int): number of rows fetched at a time
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(
+            f"export_format must be one of {', '.join(EXPORT_FORMATS)}. Got {export_format} instead.")
+
+    row_chunks = stream_export_rows(bank_id, start_date, end_date,
+                                    chunk_size)
+    if export_format == 'csv':
+        return close_after(csv_chunks(row_chunks), row_chunks)
+    return close_after(ndjson_chunks(row_chunks), row_chunks)
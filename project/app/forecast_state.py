@@ -0,0 +1,444 @@
+"""
+Persisted forecast state for month-over-month budget updates.
+
+predict_budget() forecasts each category with simple exponential smoothing
+over the 12 complete months before the latest expense, refit from the raw
+transactions on every request. The smoothing is a recurrence, so when one
+more month closes, the new forecast follows from the previous level and the
+new month's total alone:
+
+    level' = (1 - a) * level + a * new_total + (1 - a) ** 12 * (y2 - y1)
+
+where y1 and y2 are the first two months of the previous window. The last
+term accounts for the window dropping its oldest month, whose value the
+smoothing starts from, so the result is the same as a full refit.
+
+The state kept for each bank account is the unpruned monthly totals of the
+window (12 numbers per category), the smoothed level of each budgeted
+category, the number of expenses up to the end of the window, the date of
+the first expense, and the number and a checksum of the transactions dated
+before the end of the window. A request then only loads the transactions
+since the end of the window. The budget is refit from the full history
+instead when:
+- there is no state yet, or it was built with other User settings
+- the window would move by more than one month
+- the categories pruned into "Misc." change, or a category appears or
+  disappears
+- the transactions dated before the end of the window changed since the
+  state was saved: rows added, deleted (e.g. pending transactions Plaid
+  removed) or amended change their count or checksum
+- the last full refit is more than SAVER_FORECAST_STATE_MAX_AGE days old
+
+States are saved as one JSON file per bank account in
+SAVER_FORECAST_STATE_DIR. Leave it unset to always refit.
+"""
+import json
+import os
+import time
+
+import pandas as pd
+
+from app.helpers import fetch_statement, format_user_data, \
+    load_transaction_rows
+from app.streaming import load_budget_data
+from app.user import (User, SMOOTHING_LEVEL, select_pruned_categories,
+                      exp_smoothing_level, exp_smoothing_levels)
+
+# directory the forecast states are saved in. Unset turns them off
+FORECAST_STATE_DIR = os.environ.get("SAVER_FORECAST_STATE_DIR", "")
+
+# days after which a state is rebuilt from the full history
+FORECAST_STATE_MAX_AGE = float(
+    os.environ.get("SAVER_FORECAST_STATE_MAX_AGE", 90))
+
+
+def month_label(month):
+    """
+    Return the label monthly_spending_totals() gives a pandas month period,
+    e.g. '8/20'.
+    """
+    return f"{month.month}/{str(month.year)[2:]}"
+
+
+def count_expenses(df):
+    """
+    Return the number of expense transactions in a dataframe in the
+    load_user_data() format, including rows folded by app/streaming.py.
+    """
+    if 'transaction_count' in df.columns:
+        return int(df['transaction_count'].sum())
+    return len(df)
+
+
+def window_totals(expenses, months, category):
+    """
+    Sum expenses by month and category.
+
+    Parameters:
+        expenses (dataframe): expenses in the load_user_data() format
+        months (PeriodIndex): months of the window, oldest first
+        category (str): category column
+
+    Returns:
+        dataframe with a row per month and a column per category with
+        spending in the window, in alphabetical order
+    """
+    in_window = expenses[expenses['date'].dt.to_period('M').isin(months)]
+    totals = in_window.groupby(
+        [in_window['date'].dt.to_period('M'), category])['amount_dollars'] \
+        .sum().unstack(fill_value=0.0)
+    totals = totals.reindex(months, fill_value=0.0).sort_index(axis=1)
+    totals.columns.name = category
+    return totals
+
+
+def pruned_totals(window, top_k=None, top_share=None, min_frequency=1,
+                  name='Misc.'):
+    """
+    Combine window totals the way prune_categories() and
+    monthly_spending_totals() do.
+
+    Returns:
+        tuple of the monthly totals predict_budget() forecasts from (rows
+        labeled like monthly_spending_totals()), the list of pruned
+        categories and the list of rare pruned categories that were dropped
+    """
+    window = window.loc[:, (window != 0).any()]
+    pruned, rare = [], []
+    if top_k is not None or top_share is not None:
+        pruned = select_pruned_categories(exp_smoothing_levels(window),
+                                          top_k=top_k, top_share=top_share)
+        active = (window > 0).sum()
+        rare = [cat for cat in pruned if active[cat] <= min_frequency]
+
+    totals = window.drop(columns=pruned)
+    misc = [cat for cat in pruned if cat not in rare]
+    if misc:
+        totals[name] = window[misc].sum(axis=1)
+    totals = totals.sort_index(axis=1)
+    totals.index = [month_label(month) for month in window.index]
+    return totals, pruned, rare
+
+
+class ForecastState():
+    """
+    Class used to keep what a bank account's budget forecast needs between
+    requests.
+
+    Attributes:
+        bank_id (int): bank account id
+        settings (dict): cat_column, top_k and top_share of the User
+        month (Period): last month of the window
+        window (dataframe): unpruned monthly totals of the window
+        levels (dict): smoothed level of each forecast category
+        pruned (list): categories combined into "Misc."
+        rare (list): pruned categories that were dropped
+        num_expenses (int): number of expenses up to the end of the window
+        first_date (Timestamp): date of the first expense
+        max_id (int): highest transaction id seen
+        checksum (list): number and checksum of the transactions dated before
+            next_month_start(), see window_checksum()
+        refit_at (float): time.time() of the last full refit
+    """
+
+    def __init__(self, bank_id, settings, window, levels, pruned, rare,
+                 num_expenses, first_date, max_id, checksum=None,
+                 refit_at=None):
+        """
+        Constructor for the ForecastState class.
+        """
+        self.bank_id = bank_id
+        self.settings = settings
+        self.window = window
+        self.month = window.index[-1]
+        self.levels = levels
+        self.pruned = pruned
+        self.rare = rare
+        self.num_expenses = num_expenses
+        self.first_date = first_date
+        self.max_id = max_id
+        self.checksum = checksum
+        self.refit_at = refit_at or time.time()
+
+    def next_month_start(self):
+        """
+        Returns the first day after the window.
+        """
+        return (self.month + 1).start_time
+
+    def expired(self):
+        """
+        Returns True if the last full refit is older than
+        FORECAST_STATE_MAX_AGE days.
+        """
+        return time.time() - self.refit_at > FORECAST_STATE_MAX_AGE * 86400
+
+    def to_dict(self):
+        """
+        Returns the state as a JSON serializable dictionary.
+        """
+        return {
+            'bank_id': self.bank_id,
+            'settings': self.settings,
+            'months': [str(month) for month in self.window.index],
+            'window': {cat: self.window[cat].tolist()
+                       for cat in self.window.columns},
+            'levels': self.levels,
+            'pruned': self.pruned,
+            'rare': self.rare,
+            'num_expenses': self.num_expenses,
+            'first_date': self.first_date.isoformat(),
+            'max_id': self.max_id,
+            'checksum': self.checksum,
+            'refit_at': self.refit_at,
+        }
+
+    @classmethod
+    def from_dict(cls, saved):
+        """
+        Rebuild a state from to_dict().
+        """
+        months = pd.PeriodIndex(saved['months'], freq='M')
+        window = pd.DataFrame(saved['window'], index=months,
+                              dtype=float).sort_index(axis=1)
+        window.columns.name = saved['settings']['cat_column']
+        return cls(saved['bank_id'], saved['settings'], window,
+                   saved['levels'], saved['pruned'], saved['rare'],
+                   saved['num_expenses'],
+                   pd.Timestamp(saved['first_date']), saved['max_id'],
+                   saved.get('checksum'), saved['refit_at'])
+
+
+def window_checksum(bank_id, end, max_id=None):
+    """
+    Returns the number of a bank account's transactions dated before end,
+    and the sum of a hash of their ids, dates, amounts, categories and
+    merchants, which changes when any of them is added, deleted or amended.
+
+    Parameters:
+        bank_id (int): bank account id
+        end (Timestamp): end of the covered dates
+        max_id (int): only cover the transactions up to this id
+
+    Returns:
+        list of the count and the checksum
+    """
+    df = fetch_statement('window_checksum', (int(bank_id), end, max_id),
+                         strategy='read_sql')
+    return [int(df['count'].iloc[0]), int(df['checksum'].iloc[0])]
+
+
+def build_state(bank_id, transactions, user, settings, max_id):
+    """
+    Build the state of a User whose predict_budget() just ran on the
+    account's full history.
+
+    Parameters:
+        bank_id (int): bank account id
+        transactions (dataframe): the history the User was created with
+        user (User): the user, after predict_budget()
+        settings (dict): cat_column, top_k and top_share of the User
+        max_id (int): highest transaction id when the history was loaded
+
+    Returns:
+        ForecastState
+    """
+    latest = user.expenses['date'].max().to_period('M')
+    months = pd.period_range(end=latest - 1, periods=user.past_months,
+                             freq='M')
+    window = window_totals(user.expenses, months, user.cat_column)
+    _, pruned, rare = pruned_totals(
+        window, settings['top_k'], settings['top_share'],
+        min_frequency=int(user.past_months / 10))
+
+    levels = {cat: exp_smoothing_level(user.spending_by_month[cat].values)
+              for cat in user.spending_by_month.columns}
+
+    # expenses up to the end of the window, so later requests can add the
+    # ones loaded since
+    expenses = transactions[
+        (transactions['grandparent_category_name'] != 'Transfers') &
+        (transactions['amount_dollars'] > 0) &
+        (transactions['date'] < latest.start_time)]
+
+    return ForecastState(bank_id, settings, window, levels, pruned, rare,
+                         count_expenses(expenses),
+                         user.expenses['date'].min(), max_id)
+
+
+def advance_state(state, new_transactions):
+    """
+    Forecast a budget from a state and the transactions since the end of
+    its window, moving the window forward if another month has closed.
+
+    Parameters:
+        state (ForecastState): state saved by an earlier request
+        new_transactions (dataframe): transactions dated on or after
+            state.next_month_start(), in the load_user_data() format
+
+    Returns:
+        tuple of the User (ready for budget_modifier()), the budget
+        predict_budget() would return and the new ForecastState, or None if
+        the budget has to be refit from the full history
+    """
+    settings = state.settings
+    user = User(new_transactions, **settings)
+    if len(user.expenses) == 0:
+        return None
+
+    # the window ends the month before the latest expense
+    latest = user.expenses['date'].max().to_period('M')
+    shift = (latest - 1 - state.month).n
+    if shift not in (0, 1):
+        return None
+
+    min_frequency = int(user.past_months / 10)
+    old_totals, _, _ = pruned_totals(state.window, settings['top_k'],
+                                     settings['top_share'], min_frequency)
+    window = state.window
+    levels = state.levels
+    num_expenses = state.num_expenses
+
+    if shift == 1:
+        closed = state.month + 1
+        closed_expenses = user.expenses[
+            user.expenses['date'].dt.to_period('M') == closed]
+        new_month = window_totals(closed_expenses,
+                                  pd.PeriodIndex([closed]),
+                                  user.cat_column)
+        window = pd.concat([window.iloc[1:], new_month]).fillna(0.0) \
+            .sort_index(axis=1)
+        window.columns.name = user.cat_column
+        num_expenses += len(closed_expenses)
+
+    totals, pruned, rare = pruned_totals(window, settings['top_k'],
+                                         settings['top_share'],
+                                         min_frequency)
+    if pruned != state.pruned or rare != state.rare or \
+            set(totals.columns) != set(levels):
+        return None
+
+    if shift == 1:
+        decay = (1 - SMOOTHING_LEVEL) ** len(window)
+        levels = {cat: (1 - SMOOTHING_LEVEL) * levels[cat] +
+                  SMOOTHING_LEVEL * totals[cat].iloc[-1] +
+                  decay * (old_totals[cat].iloc[1] - old_totals[cat].iloc[0])
+                  for cat in totals.columns}
+
+    # the warnings predict_budget() gives for the full history
+    user.num_expenses = state.num_expenses + user.num_expenses
+    transaction_history = (user.expenses['date'].max() -
+                           state.first_date).days
+    new_state = ForecastState(state.bank_id, settings, window.copy(), levels,
+                              pruned, rare, num_expenses, state.first_date,
+                              state.max_id, state.checksum, state.refit_at)
+    if not user.check_history(user.num_expenses, transaction_history):
+        return user, None, new_state
+
+    user.spending_by_month = totals.copy()
+    forecast = totals.loc[:, (totals != 0).sum() > min_frequency]
+    budget = user.budget_from_forecasts(
+        {cat: levels[cat] for cat in forecast.columns})
+    return user, budget, new_state
+
+
+class ForecastStateStore():
+    """
+    Class used to save and load forecast states as JSON files.
+
+    Attributes:
+        directory (str): directory the states are saved in
+    """
+
+    def __init__(self, directory=FORECAST_STATE_DIR):
+        """
+        Constructor for the ForecastStateStore class.
+
+        Parameters:
+            directory (str): directory the states are saved in
+        """
+        self.directory = directory
+
+    def path(self, bank_id):
+        """
+        Returns the file a bank account's state is saved in.
+        """
+        return os.path.join(self.directory, f'{int(bank_id)}.json')
+
+    def load(self, bank_id, settings):
+        """
+        Returns the saved state of a bank account, or None if there is none
+        or it was built with other settings.
+        """
+        try:
+            with open(self.path(bank_id)) as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if saved['settings'] != settings:
+            return None
+        return ForecastState.from_dict(saved)
+
+    def save(self, state):
+        """
+        Write a state to its file.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(state.bank_id)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state.to_dict(), f)
+        os.replace(tmp_path, path)
+
+
+def forecast_budget(bank_id, store, **settings):
+    """
+    Forecast a bank account's budget, from its saved state when possible.
+
+    Parameters:
+        bank_id (int): bank account id
+        store (ForecastStateStore): where states are saved
+        **settings: cat_column, top_k and top_share of the User
+
+    Returns:
+        tuple of the User (ready for budget_modifier()) and the output of
+        predict_budget()
+    """
+    state = store.load(bank_id, settings)
+    # transactions dated inside the window that were added, deleted or
+    # amended since the state was saved aren't reflected in it
+    if state is not None and not state.expired() and \
+            window_checksum(bank_id, state.next_month_start()) == \
+            state.checksum:
+        rows = load_transaction_rows(bank_id, since=state.next_month_start())
+        result = advance_state(state, format_user_data(rows))
+        if result is not None:
+            user, budget, new_state = result
+            if len(rows):
+                new_state.max_id = max(state.max_id, int(rows['id'].max()))
+            if new_state.month != state.month:
+                new_state.checksum = window_checksum(
+                    bank_id, new_state.next_month_start(), new_state.max_id)
+            store.save(new_state)
+            return user, budget
+
+    # taken before loading, so transactions added while loading are picked
+    # up by the next request
+    max_id = fetch_statement('max_transaction_id',
+                             (int(bank_id),))['max_id'].iloc[0]
+    transactions = load_budget_data(bank_id)
+    user = User(transactions, **settings)
+    budget = user.predict_budget()
+
+    if budget is not None and max_id is not None:
+        state = build_state(bank_id, transactions, user, settings,
+                            int(max_id))
+        # only the transactions that were loaded, so that ones added since
+        # don't match
+        state.checksum = window_checksum(bank_id, state.next_month_start(),
+                                         int(max_id))
+        store.save(state)
+    return user, budget
+
+
+forecast_states = ForecastStateStore()
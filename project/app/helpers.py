@@ -1,18 +1,497 @@
 import pandas as pd
+import io
+import logging
 import os
+import re
+import select
+import threading
+from contextlib import contextmanager
 from sqlalchemy import create_engine
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from os.path import join, dirname
 from dotenv import load_dotenv
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
 
 dotenv_path = join(dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 
+log = logging.getLogger(__name__)
+
 SAVER_USERNAME = os.environ.get("SAVER_USERNAME")
 SAVER_PASSWORD = os.environ.get("SAVER_PASSWORD")
 SAVER_DB_HOST = os.environ.get("SAVER_DB_HOST")
 SAVER_DB_NAME = os.environ.get("SAVER_DB_NAME")
 
+# where load_user_data reads transactions from: 'postgres' (default) or
+# 'parquet' to read from a snapshot written by app/snapshot.py
+SAVER_DATA_BACKEND = os.environ.get("SAVER_DATA_BACKEND", "postgres")
+
+# how query results are turned into dataframes: 'read_sql' (default) or
+# 'copy' to stream them with COPY, see fetch_dataframe()
+SAVER_FETCH_STRATEGY = os.environ.get("SAVER_FETCH_STRATEGY", "read_sql")
+
+# maximum number of pooled database connections, see connection()
+SAVER_DB_POOL_SIZE = int(os.environ.get("SAVER_DB_POOL_SIZE", 10))
+
+# seconds a request waits for a pooled connection before it is answered
+# with a 503
+SAVER_DB_POOL_TIMEOUT = float(os.environ.get("SAVER_DB_POOL_TIMEOUT", 10))
+
+# seconds to wait before reopening a dropped LISTEN connection, doubled
+# after each failed attempt up to LISTEN_RETRY_MAX_SECONDS
+LISTEN_RETRY_SECONDS = 1
+LISTEN_RETRY_MAX_SECONDS = 60
+
+# the transactions query, read once. It ends with "bank_account_id = "
+QUERY_SQL = open(join(dirname(__file__), 'query.sql')).read()
+
+# query.sql for a set of bank accounts, with the equality swapped for IN
+QUERY_SQL_IN = QUERY_SQL.rstrip().rstrip('=') + ' IN'
+
+# the hot queries, by name: (parameter types, statement with $n parameters).
+# Each pooled connection prepares a statement the first time it runs it, so
+# Postgres parses and rewrites query.sql once per connection instead of once
+# per request. Postgres still decides per execution whether to reuse a
+# generic plan; account sizes vary a lot, so it usually re-plans for the
+# given account
+STATEMENTS = {
+    'transactions': ('bigint', QUERY_SQL + ' $1'),
+    'transactions_since': ('bigint, timestamp',
+                           QUERY_SQL + ' $1 AND date >= $2'),
+    'transactions_by_id': ('bigint, bigint[]',
+                           QUERY_SQL + ' $1 AND id = ANY($2)'),
+    'transactions_after_id': ('bigint, bigint',
+                              QUERY_SQL + ' $1 AND id > $2'),
+    'transactions_window': ('bigint, int', f"""
+    WITH transactions AS (
+    {QUERY_SQL} $1
+    )
+    SELECT *
+    FROM transactions
+    WHERE date > (SELECT max(date) FROM transactions)
+                 - $2 * interval '1 day'
+    """),
+    # the anchor mirrors the filter User uses to build its expenses dataframe
+    'transactions_window_expenses': ('bigint, int', f"""
+    WITH transactions AS (
+    {QUERY_SQL} $1
+    )
+    SELECT *
+    FROM transactions
+    WHERE date > (SELECT max(date) FROM transactions
+                  WHERE grandparent_category_name != 'Transfers'
+                    AND amount_cents > 0)
+                 - $2 * interval '1 day'
+    """),
+    'accounts_transactions': ('bigint[]', QUERY_SQL + ' ANY($1)'),
+    'max_transaction_id': ('bigint', """
+    SELECT max(id) AS max_id
+    FROM public.plaid_main_transactions
+    WHERE bank_account_id = $1
+    """),
+    # a NULL $3 covers every id. hashtext() may change with a major Postgres
+    # upgrade, which only costs a refit of each saved forecast state
+    'window_checksum': ('bigint, timestamp, bigint', """
+    SELECT
+        count(*) AS count,
+        coalesce(sum(hashtext(concat_ws('|', id, date, amount_cents,
+                                         category_id, merchant_name))),
+                 0) AS checksum
+    FROM public.plaid_main_transactions
+    WHERE bank_account_id = $1
+      AND date < $2
+      AND ($3::bigint IS NULL OR id <= $3)
+    """),
+    'user_transactions': ('bigint', QUERY_SQL_IN + """ (
+        SELECT
+            bank_accounts.id
+        FROM
+            bank_accounts
+        INNER JOIN
+            plaid_financial_authentications ON plaid_financial_authentications.id=bank_accounts.plaid_financial_authentication_id
+        WHERE
+            plaid_financial_authentications.user_id = $1
+    )
+    """),
+    'account_user_id': ('bigint', """
+    SELECT
+        user_id
+    FROM
+        bank_accounts
+    INNER JOIN
+        plaid_financial_authentications ON plaid_financial_authentications.id=bank_accounts.plaid_financial_authentication_id
+    WHERE
+        bank_accounts.id = $1
+    """),
+    'latest_spend_earn_ratio': ('bigint', """
+    SELECT
+        user_id, spend_earn_ratio
+    FROM
+        transactional_financial_health_scores
+    WHERE
+        user_id = $1
+    ORDER BY
+        run_date DESC
+    LIMIT 1
+    """),
+    'account_balance': ('bigint', """
+    SELECT
+        current_balance_cents, account_subtype
+    FROM
+        bank_accounts
+    WHERE
+        id = $1
+    """),
+    'account_exists': ('bigint', """
+    SELECT id
+    FROM PUBLIC.plaid_main_transactions
+    WHERE bank_account_id = $1
+    LIMIT 1
+    """),
+    'user_bank_accounts': ('bigint', """
+    SELECT
+        bank_accounts.id
+    FROM
+        bank_accounts
+    INNER JOIN
+        plaid_financial_authentications ON plaid_financial_authentications.id=bank_accounts.plaid_financial_authentication_id
+    WHERE
+        plaid_financial_authentications.user_id = $1
+    """),
+}
+
+# Postgres type oids of the columns fetch_dataframe() parses specially
+TIMESTAMP_OIDS = {1114, 1184}
+DATE_OIDS = {1082}
+BOOL_OIDS = {16}
+TEXT_OIDS = {18, 19, 25, 1042, 1043}
+
+
+def copy_to_dataframe(query, conn):
+    """
+    Run a query with COPY ... TO STDOUT and parse the CSV output with the
+    pandas C parser, which skips building a Python tuple and object per
+    row the way pd.read_sql over a psycopg2 cursor does.
+
+    The column types are read from a zero-row run of the same query, so the
+    dataframe has the same columns and dtypes read_sql would return.
+
+    Parameters:
+            query (str): SELECT statement, without a trailing semicolon
+            conn (connection): open psycopg2 connection
+
+    Returns:
+            dataframe of the query results
+    """
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT * FROM ({query}) AS q LIMIT 0")
+    columns = [(column.name, column.type_code)
+               for column in cursor.description]
+
+    buffer = io.BytesIO()
+    cursor.copy_expert(
+        f"COPY ({query}) TO STDOUT WITH CSV HEADER NULL '\\N'", buffer)
+    cursor.close()
+    buffer.seek(0)
+
+    # text columns stay strings even when they look like numbers, and only
+    # NULLs (written as \N) are read as missing values
+    dtype = {name: str for name, oid in columns if oid in TEXT_OIDS}
+    df = pd.read_csv(buffer, dtype=dtype, na_values=['\\N'],
+                     keep_default_na=False, true_values=['t'],
+                     false_values=['f'])
+
+    for name, oid in columns:
+        if oid in TIMESTAMP_OIDS:
+            df[name] = pd.to_datetime(df[name], utc=(oid == 1184))
+        elif oid in DATE_OIDS:
+            df[name] = pd.to_datetime(df[name]).dt.date
+        elif oid in BOOL_OIDS and df[name].dtype != bool:
+            df[name] = df[name].astype(object)
+        elif oid in TEXT_OIDS and df[name].isna().any():
+            # read_sql returns None rather than NaN for NULL strings
+            df[name] = df[name].where(df[name].notna(), None)
+    return df
+
+
+def fetch_dataframe(query, conn, strategy=None):
+    """
+    Run a query and return the results as a dataframe.
+
+    Parameters:
+            query (str): SELECT statement, without a trailing semicolon
+            conn (connection): open psycopg2 connection
+            strategy (str): 'read_sql' or 'copy'. Defaults to the
+                            SAVER_FETCH_STRATEGY environment variable
+
+    Returns:
+            dataframe of the query results
+    """
+    if (strategy or SAVER_FETCH_STRATEGY) == 'copy':
+        return copy_to_dataframe(query, conn)
+    return pd.read_sql(query, conn)
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """
+    psycopg2 connection that remembers which of the STATEMENTS it has
+    prepared. Prepared statements live as long as the database session.
+
+    Attributes:
+        prepared (set): names of the statements prepared on this connection
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """
+    Raised when no pooled connection frees up within the pool's timeout.
+    The API answers it with a 503, see app/main.py.
+    """
+
+
+class ConnectionPool():
+    """
+    Thread-safe pool of PreparedConnections.
+
+    Connections are opened as they are needed, up to maxconn. Returned
+    connections are kept open, along with their prepared statements, unless
+    they are broken. When every connection is in use, getconn() waits for
+    one to be returned, up to timeout seconds.
+
+    Attributes:
+        maxconn (int): most connections open at once
+        timeout (float): seconds getconn() waits for a free connection
+        kwargs (dict): arguments of psycopg2.connect()
+        idle (list): open connections not in use
+        slots (BoundedSemaphore): one slot per connection that can be lent
+        lock (Lock): guards idle
+    """
+
+    def __init__(self, maxconn, timeout=None, **kwargs):
+        """
+        Constructor for the ConnectionPool class.
+
+        Parameters:
+            maxconn (int): most connections open at once
+            timeout (float): seconds getconn() waits for a free connection,
+                None to wait without limit
+            kwargs: arguments of psycopg2.connect()
+        """
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.kwargs = kwargs
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        """
+        Returns an idle connection, or a new one if none is idle.
+
+        Raises:
+            PoolTimeout: when every connection stays in use for timeout
+                seconds
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f'no database connection was free within '
+                              f'{self.timeout} seconds')
+        try:
+            with self.lock:
+                if self.idle:
+                    return self.idle.pop()
+            return psycopg2.connect(connection_factory=PreparedConnection,
+                                    **self.kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        """
+        Return a connection to the pool. It is kept open for reuse unless
+        close is set or it is already closed.
+        """
+        try:
+            if close or conn.closed:
+                if not conn.closed:
+                    conn.close()
+            else:
+                with self.lock:
+                    self.idle.append(conn)
+        finally:
+            self.slots.release()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+@contextmanager
+def connection():
+    """
+    Borrow a connection from the pool for the body of a `with` block.
+
+    The pool is created on first use, so each process (including the job
+    workers) gets its own. Any open transaction is rolled back when the
+    connection is returned, and connections that fail to roll back are
+    closed instead of being reused. When all SAVER_DB_POOL_SIZE connections
+    are in use, it waits up to SAVER_DB_POOL_TIMEOUT seconds for one before
+    raising PoolTimeout.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(SAVER_DB_POOL_SIZE,
+                                   timeout=SAVER_DB_POOL_TIMEOUT,
+                                   user=SAVER_USERNAME,
+                                   password=SAVER_PASSWORD,
+                                   host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
+    pool = _pool
+
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        try:
+            conn.rollback()
+            broken = False
+        except psycopg2.Error:
+            broken = True
+        pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def listen_for_notifications(channels, stop_event, timeout=5,
+                             on_reconnect=None,
+                             retry_seconds=LISTEN_RETRY_SECONDS):
+    """
+    Yield the payloads of the Postgres notifications sent on a set of
+    channels, as a list per batch received, until stop_event is set.
+
+    The LISTEN connection is opened outside the pool, since it is held for
+    the life of the listener. A dropped connection is reopened, waiting
+    longer after each failed attempt. Notifications sent while disconnected
+    are lost, so on_reconnect() is called once listening again, for the
+    caller to resync whatever the notifications keep current.
+
+    Parameters:
+            channels (list): notification channels to LISTEN on
+            stop_event (Event): set to stop listening
+            timeout (int): seconds to wait for notifications between checks
+                           of stop_event
+            on_reconnect (function): called after listening again
+            retry_seconds (float): seconds to wait before the first attempt
+                                   to reconnect
+    """
+    delay = retry_seconds
+    lost = False
+    while not stop_event.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(user=SAVER_USERNAME,
+                                    password=SAVER_PASSWORD,
+                                    host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
+            conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+            for channel in channels:
+                cursor.execute(f'LISTEN "{channel}";')
+
+            delay = retry_seconds
+            if lost and on_reconnect is not None:
+                try:
+                    on_reconnect()
+                except Exception:
+                    log.exception('failed to resync after reconnecting')
+            lost = False
+
+            while not stop_event.is_set():
+                if select.select([conn], [], [], timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                payloads = []
+                while conn.notifies:
+                    payloads.append(conn.notifies.pop(0).payload)
+                yield payloads
+        except (psycopg2.Error, OSError):
+            log.exception(f'lost the LISTEN connection to {channels}, '
+                          f'reconnecting in {delay} seconds')
+            lost = True
+        finally:
+            if conn is not None:
+                conn.close()
+
+        if stop_event.wait(delay):
+            break
+        delay = min(delay * 2, LISTEN_RETRY_MAX_SECONDS)
+
+
+def inline_params(conn, statement, params):
+    """
+    Return a statement from STATEMENTS with its $n parameters replaced by
+    the quoted values, for the COPY fetch strategy, which can't run a
+    prepared statement.
+    """
+    # escape literal percent signs before using psycopg2's %(name)s quoting
+    query = re.sub(r'\$(\d+)', r'%(p\1)s', statement.replace('%', '%%'))
+    values = {f'p{i}': value for i, value in enumerate(params, start=1)}
+    return conn.cursor().mogrify(query, values).decode()
+
+
+def execute_prepared(conn, name, params):
+    """
+    Run one of the STATEMENTS on a pooled connection, preparing it first if
+    the connection hasn't prepared it yet.
+
+    Parameters:
+            conn (PreparedConnection): connection from connection()
+            name (str): key of the statement in STATEMENTS
+            params (tuple): values of the statement's $n parameters
+
+    Returns:
+            dataframe of the results, as pd.read_sql would return them
+    """
+    types, statement = STATEMENTS[name]
+    cursor = conn.cursor()
+    if name not in conn.prepared:
+        cursor.execute(f"PREPARE {name} ({types}) AS {statement}")
+        conn.prepared.add(name)
+
+    placeholders = ', '.join(['%s'] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", tuple(params))
+    columns = [column.name for column in cursor.description]
+    df = pd.DataFrame.from_records(cursor.fetchall(), columns=columns,
+                                   coerce_float=True)
+    cursor.close()
+    return df
+
+
+def fetch_statement(name, params, strategy=None):
+    """
+    Run one of the STATEMENTS with the given parameters on a pooled
+    connection and return the results as a dataframe.
+
+    Parameters:
+            name (str): key of the statement in STATEMENTS
+            params (tuple): values of the statement's $n parameters
+            strategy (str): 'read_sql' or 'copy'. Defaults to the
+                            SAVER_FETCH_STRATEGY environment variable
+
+    Returns:
+            dataframe of the query results
+    """
+    with connection() as conn:
+        if (strategy or SAVER_FETCH_STRATEGY) == 'copy':
+            query = inline_params(conn, STATEMENTS[name][1], params)
+            return copy_to_dataframe(query, conn)
+        return execute_prepared(conn, name, params)
+
+
 def convert_to_datetime(df, columns=[]):
     """
     Takes in a dataframe and a list of columns, and converts those columns to
@@ -27,17 +506,210 @@ def convert_to_datetime(df, columns=[]):
         df[col] = pd.to_datetime(df[col], infer_datetime_format=True)
 
 
-def load_user_data(bank_id):
-    # currently sets category_name to parent_category_name
-    conn1 = psycopg2.connect(user=SAVER_USERNAME, password=SAVER_PASSWORD,
-                             host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
-    
-    query = open('app/query.sql').read() + str(bank_id)
-    df = pd.read_sql(query, conn1)
-    conn1.close()
+def format_user_data(df):
+    """
+    Takes in a dataframe of raw rows returned by query.sql and reduces it to
+    the columns used by the API.
+
+    Parameters:
+            df (dataframe): rows returned by query.sql
+
+    Returns:
+            dataframe with the category, date, canonical merchant, and
+            amount_dollars columns
+    """
+    from app.merchants import canonicalize_merchants
+
     df = df[['category_id','amount_cents','date', 'grandparent_category_name',
              'parent_category_name', 'merchant_name']]
+    df['merchant_name'] = canonicalize_merchants(df['merchant_name'])
     df['category_name'] = df.parent_category_name
     df['amount_dollars'] = df['amount_cents'] / 100
     df.drop(columns=["amount_cents"], inplace=True)
     return df
+
+
+def load_user_data(bank_id, backend=None):
+    """
+    Load a bank account's transactions into a dataframe.
+
+    Parameters:
+            bank_id (int): bank account id
+            backend (str): 'postgres' or 'parquet'. Defaults to the
+                           SAVER_DATA_BACKEND environment variable
+
+    Returns:
+            dataframe with the category, date, merchant, and amount_dollars
+            columns
+    """
+    # currently sets category_name to parent_category_name
+    if (backend or SAVER_DATA_BACKEND) == 'parquet':
+        from app.snapshot import load_snapshot_data
+        return load_snapshot_data(bank_id)
+
+    df = fetch_statement('transactions', (int(bank_id),))
+    return format_user_data(df)
+
+
+def load_transaction_rows(bank_id, since=None, transaction_ids=None,
+                          after_id=None):
+    """
+    Load the raw query.sql rows for a bank account, including the
+    transaction id.
+
+    Parameters:
+            bank_id (int): bank account id
+            since (date): only load transactions on or after this date
+            transaction_ids (list): only load the transactions with these ids
+            after_id (int): only load the transactions with greater ids
+
+    Returns:
+            dataframe of the rows returned by query.sql
+    """
+    if transaction_ids is not None:
+        return fetch_statement('transactions_by_id',
+                               (int(bank_id),
+                                [int(i) for i in transaction_ids]))
+    if after_id is not None:
+        return fetch_statement('transactions_after_id',
+                               (int(bank_id), int(after_id)))
+    if since is not None:
+        return fetch_statement('transactions_since', (int(bank_id), since))
+    return fetch_statement('transactions', (int(bank_id),))
+
+
+def load_user_data_window(bank_id, days, expenses_only=False, backend=None):
+    """
+    Load only the transactions within a number of days of the account's
+    latest transaction date.
+
+    The cutoff is computed inside the same statement, so the window is
+    relative to the latest transaction rather than today, matching
+    get_last_time_period() in app/user.py.
+
+    Parameters:
+            bank_id (int): bank account id
+            days (int): size of the window in days
+            expenses_only (bool): anchor the window on the latest expense
+                                  (positive, non-transfer transaction)
+                                  instead of the latest transaction. Use this
+                                  for charts built from User.expenses.
+
+    Returns:
+            dataframe in the same format as load_user_data()
+    """
+    if (backend or SAVER_DATA_BACKEND) == 'parquet':
+        # snapshots are local, so apply the same window after reading
+        df = load_user_data(bank_id, backend='parquet')
+        anchor = df
+        if expenses_only:
+            anchor = df[(df['grandparent_category_name'] != 'Transfers') &
+                        (df['amount_dollars'] > 0)]
+        cutoff = anchor['date'].max() - pd.Timedelta(days=int(days))
+        return df[df['date'] > cutoff].reset_index(drop=True)
+
+    name = 'transactions_window_expenses' if expenses_only \
+        else 'transactions_window'
+    df = fetch_statement(name, (int(bank_id), int(days)))
+    return format_user_data(df)
+
+
+def load_dashboard_metadata(bank_id):
+    """
+    Load the account information shown on the dashboard.
+
+    Parameters:
+            bank_id (int): bank account id
+
+    Returns:
+            dictionary with the user's latest spend_earn_ratio (None if the
+            user doesn't have one), the account type and the current balance
+    """
+    with connection() as conn:
+        # get user id based on bank id given
+        user_id = execute_prepared(conn, 'account_user_id', (int(bank_id),))
+        user_id_number = user_id['user_id'].iloc[0]
+
+        # get spend_earn_ratio of user for the latest 12 months we have data
+        # for
+        profile = execute_prepared(conn, 'latest_spend_earn_ratio',
+                                   (int(user_id_number),))
+        if len(profile) == 0:
+            spend_earn_ratio = None
+        else:
+            spend_earn_ratio = profile['spend_earn_ratio'].iloc[0]
+
+        # get current account balance and account type
+        current_balance = execute_prepared(conn, 'account_balance',
+                                           (int(bank_id),))
+
+    return {
+        'user_id': user_id_number,
+        'spend_earn_ratio': spend_earn_ratio,
+        'account_type': current_balance['account_subtype'].iloc[0],
+        'current_balance': current_balance['current_balance_cents'].iloc[0]/100,
+    }
+
+
+def bank_account_exists(bank_id):
+    """
+    Return True if the bank account has at least one transaction.
+    """
+    return len(fetch_statement('account_exists', (int(bank_id),),
+                               strategy='read_sql')) > 0
+
+
+def load_user_bank_account_ids(user_id):
+    """
+    Return the ids of every bank account linked by a user.
+    """
+    df = fetch_statement('user_bank_accounts', (int(user_id),),
+                         strategy='read_sql')
+    return list(df['id'])
+
+
+async def check_bank_account(bank_account_id, field='bank_account_id'):
+    """
+    Raise a 422, shaped like a request validation error, unless the bank
+    account has transactions. Routes call it instead of checking in a
+    pydantic validator, which would query the database on the event loop.
+    """
+    if not await run_in_threadpool(bank_account_exists, bank_account_id):
+        raise HTTPException(status_code=422, detail=[{
+            'loc': ['body', field],
+            'msg': f'the bank_account_id {bank_account_id} is invalid',
+            'type': 'value_error'}])
+
+
+async def check_user(user_id, field='user_id'):
+    """
+    Raise a 422, shaped like a request validation error, unless the user has
+    linked bank accounts.
+    """
+    if not await run_in_threadpool(load_user_bank_account_ids, user_id):
+        raise HTTPException(status_code=422, detail=[{
+            'loc': ['body', field],
+            'msg': f'the user_id {user_id} is invalid',
+            'type': 'value_error'}])
+
+
+def load_user_accounts_data(user_id):
+    """
+    Load the transactions of every bank account linked by a user with a
+    single query.
+
+    Transfers between two of the user's own accounts are removed, since they
+    don't move money in or out of the user's combined balance.
+
+    Parameters:
+            user_id (int): user id
+
+    Returns:
+            dataframe in the same format as load_user_data()
+    """
+    from app.user import drop_internal_transfers
+
+    df = fetch_statement('user_transactions', (int(user_id),))
+
+    df = drop_internal_transfers(df)
+    return format_user_data(df)
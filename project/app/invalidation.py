@@ -0,0 +1,449 @@
+"""
+Invalidation of per-account caches when new data lands.
+
+A cache in front of load_user_data(), the dashboard metadata or rendered
+charts serves stale data unless it learns when an account gets new
+transactions or a new transactional_financial_health_scores run lands.
+Every account has a version number in AccountVersions, bumped when the
+account's data changes. AccountCache keeps each value with the version it
+was loaded at, and only returns it while the version is unchanged.
+
+Versions are bumped by a background thread started in every worker
+process, so each worker drops its own stale entries:
+- listening to Postgres notifications (SAVER_INVALIDATION_CHANNELS, comma
+  separated) sent by the triggers in notify_new_transactions.sql and
+  notify_health_scores.sql. Payloads are JSON objects with a
+  bank_account_id, a user_id (every account of the user), or all: true.
+  Notifications sent while the connection is down are lost, so every
+  account is bumped once it is reopened
+- or, without triggers, polling the max(id) of plaid_main_transactions and
+  transactional_financial_health_scores every
+  SAVER_INVALIDATION_POLL_SECONDS seconds, and bumping the accounts of the
+  rows not seen by the previous poll. Ids are handed out before rows
+  commit, so a row can show up below the watermark: each poll also
+  re-reads the last WATERMARK_LOOKBACK ids. Rows committed later than that
+  are only seen once the cached values expire
+
+The cache is off unless SAVER_ACCOUNT_CACHE_SIZE is set. Entries also
+expire after SAVER_ACCOUNT_CACHE_TTL seconds, which bounds staleness for
+changes no notification covers, like balance updates.
+
+Usage, to print the bumps of a database:
+
+    python -m app.invalidation watch --channels new_transactions
+    python -m app.invalidation watch --poll 5
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app.helpers import (connection, listen_for_notifications,
+                         load_user_bank_account_ids)
+
+log = logging.getLogger(__name__)
+
+# notification channels to LISTEN on, e.g.
+# "new_transactions,new_health_scores". Empty turns listening off
+INVALIDATION_CHANNELS = [channel for channel in os.environ.get(
+    "SAVER_INVALIDATION_CHANNELS", "").split(',') if channel]
+
+# seconds between polls of the max(id) watermarks. 0 turns polling off
+INVALIDATION_POLL_SECONDS = float(
+    os.environ.get("SAVER_INVALIDATION_POLL_SECONDS", 0))
+
+# number of values kept by the account cache. 0 turns it off
+ACCOUNT_CACHE_SIZE = int(os.environ.get("SAVER_ACCOUNT_CACHE_SIZE", 0))
+
+# seconds a cached value is kept at most
+ACCOUNT_CACHE_TTL = float(os.environ.get("SAVER_ACCOUNT_CACHE_TTL", 300))
+
+# tables polled without triggers, and the column their rows are bumped by
+WATERMARK_TABLES = {
+    'plaid_main_transactions': 'bank_account_id',
+    'transactional_financial_health_scores': 'user_id',
+}
+
+# number of ids below the watermark each poll reads again, for rows that
+# committed after rows with higher ids
+WATERMARK_LOOKBACK = 1000
+
+
+class AccountVersions():
+    """
+    Class used to keep a version number per bank account.
+
+    Attributes:
+        versions (dict): version of each bumped bank account. Accounts
+            never bumped are at version 0
+        epoch (int): bumped to invalidate every account at once
+        listeners (list): functions called with the bank account id (None
+            for every account) after each bump
+        bumps (int): number of accounts bumped
+        lock (Lock): guards the versions
+    """
+
+    def __init__(self):
+        """
+        Constructor for the AccountVersions class.
+        """
+        self.versions = {}
+        self.epoch = 0
+        self.listeners = []
+        self.bumps = 0
+        self.lock = threading.Lock()
+
+    def version(self, bank_id):
+        """
+        Returns the current version of a bank account, as a tuple of the
+        epoch and the account's own version.
+        """
+        return (self.epoch, self.versions.get(int(bank_id), 0))
+
+    def bump(self, bank_ids):
+        """
+        Bump the version of bank accounts whose data changed.
+        """
+        bank_ids = [int(bank_id) for bank_id in bank_ids]
+        with self.lock:
+            for bank_id in bank_ids:
+                self.versions[bank_id] = self.versions.get(bank_id, 0) + 1
+            self.bumps += len(bank_ids)
+        for bank_id in bank_ids:
+            for listener in self.listeners:
+                listener(bank_id)
+
+    def bump_all(self):
+        """
+        Bump the version of every bank account.
+        """
+        with self.lock:
+            self.epoch += 1
+        for listener in self.listeners:
+            listener(None)
+
+    def subscribe(self, listener):
+        """
+        Call listener(bank_id) after each bump, with None when every account
+        is bumped.
+        """
+        self.listeners.append(listener)
+
+    def stats(self):
+        """
+        Returns the number of bumps and accounts bumped.
+        """
+        return {'epoch': self.epoch, 'bumps': self.bumps,
+                'accounts': len(self.versions)}
+
+
+class AccountCache():
+    """
+    Class used to cache values by bank account until the account's version
+    changes, least recently used first out.
+
+    Attributes:
+        name (str): name used when reporting stats
+        versions (AccountVersions): versions the values are checked against
+        max_entries (int): number of values kept, 0 to cache nothing
+        ttl (float): seconds a value is kept at most
+        entries (OrderedDict): (version, load time, value) by (bank account
+            id, key), oldest first
+        hits (int): number of values found
+        misses (int): number of values missing, stale or expired
+        evictions (int): number of values removed after a bump
+        lock (Lock): guards the entries
+    """
+
+    def __init__(self, name, versions, max_entries=ACCOUNT_CACHE_SIZE,
+                 ttl=ACCOUNT_CACHE_TTL):
+        """
+        Constructor for the AccountCache class.
+
+        Parameters:
+            name (str): name used when reporting stats
+            versions (AccountVersions): versions the values are checked
+                against
+            max_entries (int): number of values kept, 0 to cache nothing
+            ttl (float): seconds a value is kept at most
+        """
+        self.name = name
+        self.versions = versions
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        versions.subscribe(self.evict)
+
+    def get(self, bank_id, key):
+        """
+        Returns the value cached for a bank account and key, or None when
+        it is missing, stale or expired.
+        """
+        entry_key = (int(bank_id), key)
+        with self.lock:
+            entry = self.entries.get(entry_key)
+            if entry is not None:
+                version, loaded, value = entry
+                if version == self.versions.version(bank_id) and \
+                        time.monotonic() - loaded < self.ttl:
+                    self.entries.move_to_end(entry_key)
+                    self.hits += 1
+                    return value
+                del self.entries[entry_key]
+            self.misses += 1
+        return None
+
+    def put(self, bank_id, key, value, version):
+        """
+        Cache a value loaded for a bank account.
+
+        Parameters:
+            bank_id (int): bank account id
+            key (hashable): identifies the value among the account's values
+            value: the value, shared read-only with every caller
+            version (tuple): the account's version read before the value
+                was loaded, so that a value loaded while the account was
+                bumped is never returned
+        """
+        if not self.max_entries:
+            return
+        entry_key = (int(bank_id), key)
+        with self.lock:
+            self.entries[entry_key] = (version, time.monotonic(), value)
+            self.entries.move_to_end(entry_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def evict(self, bank_id):
+        """
+        Remove the values of a bank account, or every value for None.
+        Stale values are never returned, this frees their memory early.
+        """
+        with self.lock:
+            stale = [entry_key for entry_key in self.entries
+                     if bank_id is None or entry_key[0] == bank_id]
+            for entry_key in stale:
+                del self.entries[entry_key]
+            self.evictions += len(stale)
+
+    def stats(self):
+        """
+        Returns a dictionary of the cache's counters.
+        """
+        return {'size': len(self.entries), 'max_entries': self.max_entries,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+account_versions = AccountVersions()
+
+
+def payload_target(payload):
+    """
+    Returns what a notification payload bumps: ('all', None),
+    ('bank_account_id', id) or ('user_id', id).
+
+    Raises:
+        ValueError: when the payload isn't JSON
+        KeyError: when it names no account
+    """
+    message = json.loads(payload)
+    if message.get('all'):
+        return ('all', None)
+    for key in ('bank_account_id', 'user_id'):
+        if key in message:
+            return (key, int(message[key]))
+    raise KeyError('bank_account_id')
+
+
+def apply_target(target, versions=account_versions):
+    """
+    Bump the accounts of a payload_target().
+    """
+    key, value = target
+    if key == 'all':
+        versions.bump_all()
+    elif key == 'bank_account_id':
+        versions.bump([value])
+    else:
+        versions.bump(load_user_bank_account_ids(value))
+
+
+def apply_payload(payload, versions=account_versions):
+    """
+    Bump the accounts named by a notification payload: a JSON object with
+    a bank_account_id, a user_id or all set to true.
+    """
+    apply_target(payload_target(payload), versions)
+
+
+def listen_for_invalidations(channels, versions=account_versions, timeout=5,
+                             stop_event=None):
+    """
+    Bump the accounts announced with Postgres NOTIFY on a set of channels.
+    Blocks until stop_event is set, so run it in a background thread. A
+    dropped connection is reopened, and every account is bumped since the
+    notifications sent in between are lost.
+
+    Parameters:
+        channels (list): notification channels to LISTEN on
+        versions (AccountVersions): versions to bump
+        timeout (int): seconds to wait for notifications between checks of
+            stop_event
+        stop_event (Event): set to stop listening
+    """
+    stop_event = stop_event or threading.Event()
+
+    for payloads in listen_for_notifications(channels, stop_event, timeout,
+                                             on_reconnect=versions.bump_all):
+        # payloads differ by transaction id, so a burst of notifications for
+        # the same account is grouped by what they bump
+        targets = {}
+        for payload in payloads:
+            try:
+                targets.setdefault(payload_target(payload), payload)
+            except (ValueError, KeyError, TypeError):
+                log.warning(f'ignoring notification {payload!r}')
+
+        for target, payload in targets.items():
+            try:
+                apply_target(target, versions)
+            except Exception:
+                log.exception(f'failed to apply notification {payload!r}')
+
+
+def poll_watermarks(versions=account_versions,
+                    interval=INVALIDATION_POLL_SECONDS, stop_event=None,
+                    tables=WATERMARK_TABLES):
+    """
+    Bump the accounts with rows not seen by the previous poll of each
+    table, for databases without the notification triggers. The first poll
+    only reads the tables. Blocks until stop_event is set, so run it in a
+    background thread.
+
+    Parameters:
+        versions (AccountVersions): versions to bump
+        interval (float): seconds between polls
+        stop_event (Event): set to stop polling
+        tables (dict): column the rows of each table are bumped by,
+            bank_account_id or user_id
+    """
+    stop_event = stop_event or threading.Event()
+    watermarks = {}
+
+    while True:
+        for table, column in tables.items():
+            try:
+                watermarks[table] = poll_table(table, column,
+                                               watermarks.get(table),
+                                               versions)
+            except Exception:
+                log.exception(f'failed to poll {table}')
+        if stop_event.wait(interval):
+            break
+
+
+def poll_table(table, column, watermark, versions=account_versions,
+               lookback=WATERMARK_LOOKBACK):
+    """
+    Bump the accounts with rows the previous poll of a table didn't see:
+    rows above its watermark, and rows within lookback ids below it that
+    committed since.
+
+    Parameters:
+        table (str): table polled
+        column (str): column the rows are bumped by
+        watermark (tuple): the table's max(id) and the ids seen within
+            lookback of it, as returned by the previous poll. None for the
+            first poll, which bumps nothing
+        versions (AccountVersions): versions to bump
+        lookback (int): number of ids below the watermark read again
+
+    Returns:
+        the new watermark
+    """
+    with connection() as conn:
+        cursor = conn.cursor()
+        if watermark is None:
+            cursor.execute(f'SELECT max(id) FROM public.{table}')
+            max_id, seen = cursor.fetchone()[0] or 0, None
+        else:
+            max_id, seen = watermark
+
+        cursor.execute(f"""
+        SELECT id, {column}
+        FROM public.{table}
+        WHERE id > %s
+        """, (max_id - lookback,))
+        rows = cursor.fetchall()
+
+    if seen is not None:
+        keys = list(dict.fromkeys(key for row_id, key in rows
+                                  if row_id not in seen))
+        if column == 'user_id':
+            for user_id in keys:
+                versions.bump(load_user_bank_account_ids(user_id))
+        elif keys:
+            versions.bump(keys)
+
+    max_id = max([max_id] + [row_id for row_id, _ in rows])
+    return max_id, {row_id for row_id, _ in rows
+                    if row_id > max_id - lookback}
+
+
+def start_invalidation(channels=INVALIDATION_CHANNELS,
+                       poll_seconds=INVALIDATION_POLL_SECONDS,
+                       versions=account_versions):
+    """
+    Start listen_for_invalidations() when channels are given, otherwise
+    poll_watermarks() when poll_seconds is set, in a daemon thread.
+
+    Returns:
+        the Event that stops the thread when set, None if neither is set
+    """
+    stop_event = threading.Event()
+    if channels:
+        target, args = listen_for_invalidations, (channels, versions)
+    elif poll_seconds:
+        target, args = poll_watermarks, (versions, poll_seconds)
+    else:
+        return None
+
+    thread = threading.Thread(target=target, args=args,
+                              kwargs={'stop_event': stop_event},
+                              name='invalidation', daemon=True)
+    thread.start()
+    return stop_event
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Print the bank accounts invalidated by a database.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    watch = subparsers.add_parser('watch')
+    watch.add_argument('--channels', default=','.join(INVALIDATION_CHANNELS))
+    watch.add_argument('--poll', type=float,
+                       default=INVALIDATION_POLL_SECONDS or 5)
+
+    args = parser.parse_args()
+    if args.command == 'watch':
+        account_versions.subscribe(
+            lambda bank_id: print('all accounts' if bank_id is None
+                                  else f'bank account {bank_id}',
+                                  flush=True))
+        channels = [channel for channel in args.channels.split(',')
+                    if channel]
+        if channels:
+            listen_for_invalidations(channels)
+        else:
+            poll_watermarks(interval=args.poll)
+    else:
+        parser.print_help()
@@ -0,0 +1,463 @@
+"""
+Background jobs for requests that can outlast the gateway timeout.
+
+Under peak load a /future_budget forecast can take longer than the gateway
+allows. The job routes instead submit the work to a local process pool and
+return a job id straight away; the client then polls for the result.
+
+Identical jobs submitted while one is still queued or running (same key,
+e.g. the same bank account and savings goal) share that job. Finished jobs
+are kept for SAVER_JOB_TTL seconds after they finish and then forgotten.
+
+The API usually runs several uvicorn worker processes, and a poll can reach
+a different worker than the one that started the job. Each job's status and
+result are therefore written as a JSON file in SAVER_JOB_DIR, which the
+workers share, along with a claim file per key that lets a worker join a job
+another worker is running. SAVER_JOB_DIR defaults to job_state, relative
+to the working directory. Set empty, jobs are only known to the worker that
+started them, which is only correct with a single worker. A job whose worker
+died is reported as failed once it is older than SAVER_JOB_TTL.
+
+If a pool process dies, e.g. killed for running out of memory, the pool is
+broken: the jobs it was running and the next one submitted are reported as
+failed, and a new pool is started for the jobs after that.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import HTTPException
+
+# number of worker processes running jobs
+SAVER_JOB_WORKERS = int(os.environ.get("SAVER_JOB_WORKERS", 2))
+
+# seconds a finished job's result is kept
+SAVER_JOB_TTL = float(os.environ.get("SAVER_JOB_TTL", 600))
+
+# number of unfinished jobs allowed before new ones are rejected
+SAVER_JOB_QUEUE = int(os.environ.get("SAVER_JOB_QUEUE", 100))
+
+# directory the job records are shared through. Empty keeps them in the
+# memory of the worker that started the job
+SAVER_JOB_DIR = os.environ.get("SAVER_JOB_DIR", "job_state")
+
+# seconds between scans of SAVER_JOB_DIR for expired records
+JOB_PURGE_INTERVAL = 60
+
+UNFINISHED = ('queued', 'running')
+
+
+def key_digest(key):
+    """
+    Returns the name of a job key's claim file.
+    """
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def json_default(value):
+    """
+    Convert the numpy values of a job result for json.dump().
+    """
+    return value.item()
+
+
+def read_record(path):
+    """
+    Returns the job record saved at path, or None if there is none.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_record(path, record):
+    """
+    Atomically write a job record.
+    """
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f, default=json_default)
+    os.replace(tmp_path, path)
+
+
+def run_job(path, func, *args):
+    """
+    Mark a job's record as running, then return func(*args). Runs in the
+    job worker processes.
+    """
+    if path:
+        record = read_record(path)
+        if record is not None:
+            write_record(path, dict(record, status='running'))
+    return func(*args)
+
+
+class Job():
+    """
+    Class used to track one submitted job.
+
+    Attributes:
+        job_id (str): id returned to the client
+        key (hashable): identifies jobs that return the same result
+        future (Future): the job's future in the process pool, None for a
+            job read from another worker's record
+        record (dict): the saved record of a job from another worker
+        submitted (float): time.time() when the job was submitted
+        finished (float): time.time() when the job finished, None until then
+    """
+
+    def __init__(self, job_id, key, future=None, record=None):
+        """
+        Constructor for the Job class.
+
+        Parameters:
+            job_id (str): id returned to the client
+            key (hashable): identifies jobs that return the same result
+            future (Future): the job's future in the process pool
+            record (dict): the saved record of a job from another worker
+        """
+        self.job_id = job_id
+        self.key = key
+        self.future = future
+        self.record = record
+        self.submitted = record['submitted'] if record else time.time()
+        self.finished = record.get('finished') if record else None
+
+    def status(self):
+        """
+        Returns one of queued, running, done or failed.
+        """
+        if self.future is None:
+            return self.record['status']
+        if not self.future.done():
+            return 'running' if self.future.running() else 'queued'
+        if self.future.exception() is not None:
+            return 'failed'
+        return 'done'
+
+    def to_dict(self):
+        """
+        Returns the job's status, with the result once it is done or the
+        error once it has failed.
+        """
+        if self.future is None:
+            return {name: self.record[name] for name in
+                    ('job_id', 'status', 'result', 'error')
+                    if name in self.record}
+
+        status = self.status()
+        response = {'job_id': self.job_id, 'status': status}
+        if status == 'done':
+            response['result'] = self.future.result()
+        elif status == 'failed':
+            response['error'] = repr(self.future.exception())
+        return response
+
+
+class JobQueue():
+    """
+    Class used to run jobs in a process pool and keep their results.
+
+    Attributes:
+        name (str): name used when reporting stats
+        workers (int): number of worker processes
+        ttl (float): seconds a finished job is kept
+        max_pending (int): number of unfinished jobs allowed at once
+        directory (str): directory the job records are shared through,
+            empty to keep them in memory
+        executor (ProcessPoolExecutor): the pool, created on first use
+        jobs (dict): jobs started by this worker, by job id
+        in_flight (dict): ids of unfinished jobs by key
+        purged (float): time.time() of the last scan of directory
+        submitted (int): number of jobs started
+        deduplicated (int): number of submissions that joined a running job
+        rejected (int): number of submissions turned away with a 503
+    """
+
+    def __init__(self, name, workers=SAVER_JOB_WORKERS, ttl=SAVER_JOB_TTL,
+                 max_pending=SAVER_JOB_QUEUE, directory=SAVER_JOB_DIR):
+        """
+        Constructor for the JobQueue class.
+
+        Parameters:
+            name (str): name used when reporting stats
+            workers (int): number of worker processes
+            ttl (float): seconds a finished job is kept
+            max_pending (int): number of unfinished jobs allowed at once
+            directory (str): directory the job records are shared through
+        """
+        self.name = name
+        self.workers = workers
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.directory = directory
+        self.executor = None
+        self.jobs = {}
+        self.in_flight = {}
+        self.purged = 0
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        # futures finish on the pool's management thread
+        self.lock = threading.Lock()
+
+    def record_path(self, job_id):
+        """
+        Returns the file a job's record is saved in.
+        """
+        return os.path.join(self.directory, f'{self.name}-{job_id}.json')
+
+    def claim_path(self, key):
+        """
+        Returns the file holding the id of the unfinished job for a key.
+        """
+        return os.path.join(self.directory,
+                            f'{self.name}-key-{key_digest(key)}')
+
+    def read_job(self, job_id, key=None):
+        """
+        Returns a job from its saved record, or None if there is none or it
+        has expired. Unfinished jobs older than ttl are reported as failed,
+        since their worker must have died.
+        """
+        record = read_record(self.record_path(job_id))
+        if record is None:
+            return None
+        now = time.time()
+        if record['status'] in UNFINISHED and \
+                now - record['submitted'] > self.ttl:
+            record = dict(record, status='failed',
+                          finished=record['submitted'] + self.ttl,
+                          error='the job was lost by its worker')
+        if record.get('finished') is not None and \
+                record['finished'] < now - self.ttl:
+            return None
+        return Job(job_id, key, record=record)
+
+    def claim(self, key, job_id):
+        """
+        Claim a key for a new job, unless another worker's job for the key
+        is unfinished.
+
+        Returns:
+            the other worker's Job, or None when the key was claimed
+        """
+        path = self.claim_path(key)
+        tmp_path = f'{path}.{job_id}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(job_id)
+        try:
+            # two attempts: the first may find a claim left by a finished or
+            # lost job
+            for _ in range(2):
+                try:
+                    # linking fails if the claim exists, so only one worker
+                    # gets it, with its content already written
+                    os.link(tmp_path, path)
+                    return None
+                except FileExistsError:
+                    pass
+                try:
+                    with open(path) as f:
+                        owner = f.read()
+                except FileNotFoundError:
+                    continue
+                job = self.read_job(owner, key)
+                if job is not None and job.status() in UNFINISHED:
+                    return job
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            return None
+        finally:
+            os.remove(tmp_path)
+
+    def release(self, key, job_id):
+        """
+        Remove a key's claim if it is held by the job.
+        """
+        path = self.claim_path(key)
+        try:
+            with open(path) as f:
+                if f.read() != job_id:
+                    return
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def submit(self, key, func, *args):
+        """
+        Start func(*args) in the process pool, unless a job with the same key
+        is still unfinished, in which case return that job.
+
+        Parameters:
+            key (hashable): identifies jobs that return the same result
+            func (callable): module-level function, so that it can be sent
+                to the worker processes
+
+        Returns:
+            Job
+
+        Raises:
+            HTTPException: 503 with a Retry-After header when max_pending
+                jobs are unfinished
+        """
+        with self.lock:
+            self.purge()
+
+            job_id = self.in_flight.get(key)
+            if job_id is not None:
+                self.deduplicated += 1
+                return self.jobs[job_id]
+
+            if len(self.in_flight) >= self.max_pending:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail=f'Too many {self.name} jobs, please retry later',
+                    headers={'Retry-After': '5'})
+
+            job_id = uuid.uuid4().hex
+            path = ''
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+                path = self.record_path(job_id)
+                # the record exists before the claim points at it
+                write_record(path, {'job_id': job_id, 'status': 'queued',
+                                    'submitted': time.time()})
+                shared = self.claim(key, job_id)
+                if shared is not None:
+                    os.remove(path)
+                    self.deduplicated += 1
+                    return shared
+
+            if self.executor is None:
+                # spawned rather than forked, so the workers don't inherit
+                # the server's threads and database connections
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+
+            try:
+                future = self.executor.submit(run_job, path, func, *args)
+            except BrokenProcessPool as error:
+                # a worker process died. Fail this job and start a new pool
+                # for the next one
+                self.executor.shutdown(wait=False)
+                self.executor = None
+                future = Future()
+                future.set_exception(error)
+
+            job = Job(job_id, key, future)
+            self.jobs[job.job_id] = job
+            self.in_flight[key] = job.job_id
+            self.submitted += 1
+
+        job.future.add_done_callback(lambda future: self.finish(job))
+        return job
+
+    def finish(self, job):
+        """
+        Mark a job as finished so that new submissions start a new job, and
+        save its result for the other workers.
+        """
+        with self.lock:
+            job.finished = time.time()
+            if self.in_flight.get(job.key) == job.job_id:
+                del self.in_flight[job.key]
+
+        if not self.directory or job.future.cancelled():
+            return
+        record = dict(job.to_dict(), submitted=job.submitted,
+                      finished=job.finished)
+        try:
+            write_record(self.record_path(job.job_id), record)
+        except (TypeError, AttributeError) as error:
+            write_record(self.record_path(job.job_id),
+                         dict(record, status='failed', result=None,
+                              error=f'the result could not be saved: '
+                                    f'{error!r}'))
+        self.release(job.key, job.job_id)
+
+    def get(self, job_id):
+        """
+        Returns the job with the given id, or None if it is unknown or has
+        expired.
+        """
+        with self.lock:
+            self.purge()
+            job = self.jobs.get(job_id)
+        if job is not None or not self.directory:
+            return job
+        # started by another worker. Job ids are hex, anything else can't
+        # name a record
+        if not re.fullmatch(r'[0-9a-f]{32}', job_id):
+            return None
+        return self.read_job(job_id)
+
+    def purge(self):
+        """
+        Forget jobs that finished more than ttl seconds ago, and remove their
+        records at most every JOB_PURGE_INTERVAL seconds. Called with the
+        lock held.
+        """
+        now = time.time()
+        cutoff = now - self.ttl
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished is not None and job.finished < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+        if not self.directory or now - self.purged < JOB_PURGE_INTERVAL:
+            return
+        self.purged = now
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        prefix = f'{self.name}-'
+        for name in names:
+            if not (name.startswith(prefix) and name.endswith('.json')) or \
+                    name.startswith(f'{prefix}key-'):
+                continue
+            job_id = name[len(prefix):-len('.json')]
+            if job_id not in self.jobs and self.read_job(job_id) is None:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def shutdown(self):
+        """
+        Stop the worker processes.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def stats(self):
+        """
+        Returns a dictionary of the job counters.
+        """
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'submitted': self.submitted,
+                'deduplicated': self.deduplicated,
+                'rejected': self.rejected,
+                'unfinished': len(self.in_flight),
+                'kept': len(self.jobs),
+            }
+
+
+budget_jobs = JobQueue('budget')
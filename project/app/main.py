@@ -1,8 +1,15 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+import os
 import uvicorn
 
-from app.api import predict, viz, dashboard
+from app.api import predict, viz, dashboard, metrics, transactions, peers
+from app.month_to_date import start_listener, month_to_date_store
+from app.anomalies import anomaly_store
+from app.invalidation import start_invalidation
+from app.jobs import budget_jobs
+from app.helpers import PoolTimeout
 
 app = FastAPI(
     title='saverlife-a',
@@ -14,6 +21,9 @@ app = FastAPI(
 app.include_router(predict.router)
 app.include_router(viz.router)
 app.include_router(dashboard.router)
+app.include_router(metrics.router)
+app.include_router(transactions.router)
+app.include_router(peers.router)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,5 +33,46 @@ app.add_middleware(
     allow_headers=['*'],
 )
 
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout(request: Request, error: PoolTimeout):
+    """
+    Answer requests that waited too long for a database connection with a
+    503, so that clients back off instead of piling up behind the pool.
+    """
+    return JSONResponse(status_code=503, content={'detail': str(error)},
+                        headers={'Retry-After': '1'})
+
+
+@app.on_event('startup')
+def listen_for_new_transactions():
+    """
+    Keep month-to-date totals and anomaly statistics current from Postgres
+    notifications when SAVER_TRANSACTION_CHANNEL is set (see
+    app/notify_new_transactions.sql).
+    """
+    channel = os.environ.get('SAVER_TRANSACTION_CHANNEL')
+    if channel:
+        start_listener(channel, (month_to_date_store, anomaly_store))
+
+
+@app.on_event('startup')
+def listen_for_invalidations():
+    """
+    Keep the account cache current from Postgres notifications when
+    SAVER_INVALIDATION_CHANNELS is set, or by polling when
+    SAVER_INVALIDATION_POLL_SECONDS is set (see app/invalidation.py).
+    """
+    start_invalidation()
+
+
+@app.on_event('shutdown')
+def stop_job_workers():
+    """
+    Stop the background job worker processes.
+    """
+    budget_jobs.shutdown()
+
+
 if __name__ == '__main__':
     uvicorn.run(app)
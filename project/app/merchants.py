@@ -0,0 +1,345 @@
+"""
+Merchant name canonicalization index.
+
+Raw Plaid merchant names come with store numbers, punctuation and
+inconsistent casing ("STARBUCKS 456", "Starbucks #123"), which splits
+merchant-level budgets across near-duplicate columns. The index maps every
+raw merchant name to one canonical merchant:
+
+    raw name -> normalized name -> merchant key -> canonical merchant
+
+The normalized name is what query.sql used to compute with regexp_replace.
+Names sharing a merchant key are treated as the same merchant. The offline
+build names each merchant after the key's most common normalized name
+across the whole table. Merchants added in-process are named after the key
+alone (merchant_display_name()), never after the spellings in the batch at
+hand, so every worker gives a new merchant the same name.
+
+The index is built offline from the database and extended in-process with
+names it hasn't seen, so requests only pay for a lookup. The build saves the
+index as JSON, used by incremental builds, and publishes it as sorted arrays
+shared by the API's worker processes (see app/reference.py), so the workers
+don't each hold a copy of every name.
+
+Usage (from the project directory):
+
+    python -m app.merchants build
+    python -m app.merchants build --update
+"""
+import argparse
+import json
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from app.helpers import (SAVER_USERNAME, SAVER_PASSWORD, SAVER_DB_HOST,
+                         SAVER_DB_NAME)
+from app.reference import (REFERENCE_DIR, ReferenceData, publish,
+                           sorted_lookup)
+
+MERCHANT_INDEX_PATH = os.environ.get("SAVER_MERCHANT_INDEX",
+                                     "merchant_index.json")
+
+# words that don't tell merchants apart
+NOISE_WORDS = {
+    'the', 'inc', 'llc', 'ltd', 'co', 'com', 'corp', 'www', 'net', 'org',
+    'store', 'stores', 'pmts', 'pmt', 'payment', 'payments', 'purchase',
+    'pos', 'debit', 'mktplace', 'marketplace', 'online', 'recurring',
+}
+
+# longest normalized name, matching the left(..., 25) query.sql used
+MAX_NAME_LENGTH = 25
+
+
+def normalize_merchant(raw_name):
+    """
+    Replace everything but letters with spaces, collapse whitespace and keep
+    the first 25 characters.
+
+    Matches the regexp_replace expression query.sql used to apply to every
+    row.
+    """
+    if not isinstance(raw_name, str):
+        return raw_name
+    name = re.sub(r'[^\w\s]|[\d_]', ' ', raw_name).strip(' ')
+    name = re.sub(r'\s+', ' ', name)
+    return name[:MAX_NAME_LENGTH]
+
+
+def merchant_key(normalized_name):
+    """
+    Return the key used to group near-duplicate merchant names: the first
+    two lowercase words, ignoring noise words and leftover one or two letter
+    codes.
+    """
+    words = [word for word in normalized_name.lower().split()
+             if len(word) > 2 and word not in NOISE_WORDS]
+    if not words:
+        return normalized_name.lower()
+    return ' '.join(words[:2])
+
+
+def merchant_display_name(key):
+    """
+    Return the canonical name of a merchant key seen for the first time
+    outside of a build: its words, capitalized.
+    """
+    return ' '.join(word.capitalize() for word in key.split())
+
+
+def encode_names(names):
+    """
+    Return an array of UTF-8 encoded names, the form names are published in.
+    """
+    return np.array([name.encode('utf-8') for name in names], dtype=bytes)
+
+
+class MerchantIndex():
+    """
+    Class used to map raw merchant names to canonical merchants.
+
+    Attributes:
+        names (dict): canonical merchant for each raw merchant name not in
+            the shared arrays
+        keys (dict): canonical merchant for each merchant key not in the
+            shared arrays
+        last_id (int): largest plaid_main_transactions id included in the
+            last build, used by incremental updates
+        added (int): number of names added since the index was loaded
+        shared (ReferenceData): published index the dictionaries extend, or
+            None
+        lock (Lock): guards the dictionaries, which requests extend and
+            reset from several threads
+    """
+
+    def __init__(self, names=None, keys=None, last_id=0, shared=None):
+        """
+        Constructor for the MerchantIndex class.
+        """
+        self.names = names or {}
+        self.keys = keys or {}
+        self.last_id = last_id
+        self.added = 0
+        self.shared = shared
+        self.lock = threading.Lock()
+
+    def lookup(self, table, values):
+        """
+        Look values up in the dictionaries and the shared arrays.
+
+        Parameters:
+            table (str): 'names' for raw merchant names, 'keys' for merchant
+                keys
+            values (iterable): names or keys to look up
+
+        Returns:
+            dictionary of the canonical merchant of each value found
+        """
+        local = self.names if table == 'names' else self.keys
+        found = {value: local[value] for value in values if value in local}
+
+        arrays = self.shared.get() if self.shared is not None else None
+        missing = [value for value in values if value not in found]
+        if arrays is None or not missing:
+            return found
+
+        positions, matches = sorted_lookup(arrays[table],
+                                           encode_names(missing))
+        merchants = arrays['merchants'][
+            arrays[f'{table}_merchants'][positions[matches]]]
+        for value, merchant in zip(np.array(missing, dtype=object)[matches],
+                                   merchants):
+            found[value] = merchant.decode('utf-8')
+        return found
+
+    def add_names(self, counts, most_common=False):
+        """
+        Add raw merchant names to the index.
+
+        Names whose merchant key is new start a new merchant, named with
+        merchant_display_name(). Names with a known key join the existing
+        merchant.
+
+        Parameters:
+            counts (series): number of transactions for each raw name
+            most_common (bool): name new merchants after the key's most
+                common normalized name in counts instead. Only for builds,
+                where counts covers the whole table
+        """
+        known = self.lookup('names', counts.index)
+        counts = counts[[name not in known for name in counts.index]]
+        if len(counts) == 0:
+            return
+
+        normalized = pd.Series([normalize_merchant(name)
+                                for name in counts.index],
+                               index=counts.index)
+        keys = normalized.map(merchant_key)
+
+        # pick the most common spelling of each new key
+        spellings = pd.DataFrame({'normalized': normalized.values,
+                                  'key': keys.values,
+                                  'count': counts.values})
+        spellings = spellings.groupby(['key', 'normalized'])['count'].sum()
+        spellings = spellings.reset_index().sort_values(
+            by=['count', 'normalized'], ascending=[False, True])
+        known_keys = self.lookup('keys', spellings['key'].unique())
+        for key, name in zip(spellings['key'], spellings['normalized']):
+            if key not in known_keys:
+                if not most_common:
+                    name = merchant_display_name(key)
+                known_keys[key] = self.keys[key] = name
+
+        for raw_name, key in keys.items():
+            self.names[raw_name] = known_keys[key]
+        self.added += len(counts)
+
+    def canonicalize(self, raw_names):
+        """
+        Map a series of raw merchant names to canonical merchants. Names not
+        in the index are added to it first.
+
+        Parameters:
+            raw_names (series): raw merchant names
+
+        Returns:
+            series of canonical merchant names
+        """
+        counts = raw_names.value_counts()
+        with self.lock:
+            # names added in-process are dropped once a rebuilt index is
+            # published, as the build maps them as well
+            if self.shared is not None and self.shared.refresh():
+                self.names, self.keys = {}, {}
+
+            self.add_names(counts)
+            canonical = self.lookup('names', counts.index)
+        return raw_names.map(canonical)
+
+    def pack(self):
+        """
+        Pack the dictionaries into the sorted arrays the index is published
+        as: the raw names and merchant keys, each with the position of its
+        canonical merchant in the sorted canonical merchants.
+
+        Returns:
+            dictionary of arrays
+        """
+        merchants = np.sort(encode_names(set(self.names.values()) |
+                                         set(self.keys.values())))
+        arrays = {'merchants': merchants}
+        for table, mapping in (('names', self.names), ('keys', self.keys)):
+            values = encode_names(mapping)
+            order = np.argsort(values)
+            canonical = encode_names(mapping.values())[order]
+            arrays[table] = values[order]
+            arrays[f'{table}_merchants'] = np.searchsorted(
+                merchants, canonical).astype(np.int32)
+        return arrays
+
+    def save(self, path=MERCHANT_INDEX_PATH):
+        """
+        Write the index to a JSON file.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'last_id': self.last_id, 'keys': self.keys,
+                       'names': self.names}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=MERCHANT_INDEX_PATH):
+        """
+        Read an index written by save(). Returns an empty index if the file
+        doesn't exist.
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            saved = json.load(f)
+        return cls(saved['names'], saved['keys'], saved['last_id'])
+
+    @classmethod
+    def attach(cls, path=MERCHANT_INDEX_PATH, reference_dir=REFERENCE_DIR):
+        """
+        Return an index backed by the published arrays. Until an index has
+        been published, the JSON file is read instead.
+        """
+        shared = ReferenceData('merchant_index', reference_dir)
+        index = cls() if shared.get() is not None else cls.load(path)
+        index.shared = shared
+        return index
+
+
+def build_index(path=MERCHANT_INDEX_PATH, update=False,
+                reference_dir=REFERENCE_DIR):
+    """
+    Build the merchant index from plaid_main_transactions, save it and
+    publish it to the API's workers.
+
+    Parameters:
+        path (str): file the index is written to
+        update (bool): extend the existing index with names from
+            transactions added since the last build instead of starting over
+        reference_dir (str): directory the index is published in
+
+    Returns:
+        the MerchantIndex
+    """
+    index = MerchantIndex.load(path) if update else MerchantIndex()
+
+    conn = psycopg2.connect(user=SAVER_USERNAME, password=SAVER_PASSWORD,
+                            host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
+    query = f"""
+    SELECT merchant_name, count(*) AS count, max(id) AS last_id
+    FROM public.plaid_main_transactions
+    WHERE merchant_name IS NOT NULL
+      AND id > {int(index.last_id)}
+    GROUP BY merchant_name
+    """
+    df = pd.read_sql(query, conn)
+    conn.close()
+
+    index.add_names(df.set_index('merchant_name')['count'],
+                    most_common=not update)
+    if len(df) > 0:
+        index.last_id = int(max(index.last_id, df['last_id'].max()))
+    index.save(path)
+    publish('merchant_index', index.pack(), reference_dir)
+    return index
+
+
+merchant_index = MerchantIndex.attach()
+
+
+def canonicalize_merchants(raw_names):
+    """
+    Map a series of raw merchant names to canonical merchants using the
+    shared index.
+    """
+    return merchant_index.canonicalize(raw_names)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the merchant canonicalization index.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build = subparsers.add_parser('build')
+    build.add_argument('--out', default=MERCHANT_INDEX_PATH)
+    build.add_argument('--update', action='store_true',
+                       help='only add names from new transactions')
+    build.add_argument('--reference-dir', default=REFERENCE_DIR)
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        index = build_index(args.out, update=args.update,
+                            reference_dir=args.reference_dir)
+        print(f'{len(index.names)} names mapped to {len(index.keys)} '
+              f'merchants in {args.out}')
+    else:
+        parser.print_help()
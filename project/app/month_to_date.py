@@ -0,0 +1,400 @@
+"""
+Incremental month-to-date spending totals.
+
+/current_month_spending used to reload the account's full history and regroup
+the current month on every poll. Instead, each account keeps running totals
+by category for the current month. They are seeded once a month from the
+database and then updated with new transactions:
+- before serving the totals, with the account's transactions whose id is
+  above the highest id read so far, one small query. Totals are served
+  without that check for SAVER_MONTH_TO_DATE_MAX_AGE seconds after the last
+  one, unless the account was bumped in the meantime (see
+  app/invalidation.py)
+- as they arrive, through the /ingest_transactions endpoint or Postgres
+  notifications (see notify_new_transactions.sql)
+
+Transactions that are deleted or amended after they were applied are only
+corrected when the account is seeded again, at the start of the next month
+or when every account is bumped.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from app.helpers import (fetch_statement, listen_for_notifications,
+                         load_transaction_rows)
+from app.invalidation import account_versions
+from app.singleflight import BlockingSingleFlight
+from app.user import trim_month_spending
+
+log = logging.getLogger(__name__)
+
+# seconds an account's totals are served before checking the database for
+# new transactions again. 0 checks on every request
+MONTH_TO_DATE_MAX_AGE = float(
+    os.environ.get("SAVER_MONTH_TO_DATE_MAX_AGE", 0))
+
+
+def month_start(year, month):
+    """
+    Return the first day of the given month as an ISO formatted string.
+    """
+    return dt.date(year, month, 1).isoformat()
+
+
+class MonthToDateSpending():
+    """
+    Class used to keep running spending totals for one bank account's month.
+
+    Attributes:
+        year (int): year of the month being tracked
+        month (int): month being tracked
+        cat_column (str): category column the totals are grouped by
+        daily (dict): for each category, an array of the cents spent on each
+            day of the month (index 0 is unused)
+        totals (dict): cents spent in each category so far this month
+        seen_ids (set): ids of the transactions already applied
+        max_id (int): highest transaction id read from the database for
+            the account
+        checked_at (float): time.monotonic() of the last check for new
+            transactions, None when the next request must check
+    """
+
+    def __init__(self, year, month, cat_column='parent_category_name'):
+        """
+        Constructor for the MonthToDateSpending class.
+
+        Parameters:
+            year (int): year of the month being tracked
+            month (int): month being tracked
+            cat_column (str): category column the totals are grouped by
+        """
+        self.year = year
+        self.month = month
+        self.cat_column = cat_column
+        self.daily = {}
+        self.totals = {}
+        self.seen_ids = set()
+        self.max_id = 0
+        self.checked_at = None
+
+    def apply(self, rows):
+        """
+        Add transactions to the running totals.
+
+        Transfers, income, transactions outside the tracked month and
+        transactions that were already applied are ignored, so the same rows
+        can safely be applied more than once.
+
+        Parameters:
+            rows (dataframe): rows returned by query.sql, including the id
+
+        Returns:
+            the number of transactions added
+        """
+        if len(rows) == 0:
+            return 0
+
+        dates = rows['date']
+        new = rows[(rows['grandparent_category_name'] != 'Transfers') &
+                   (rows['amount_cents'] > 0) &
+                   (dates.dt.year == self.year) &
+                   (dates.dt.month == self.month) &
+                   (~rows['id'].isin(self.seen_ids))]
+        # ids may be repeated within a batch of notifications
+        new = new.drop_duplicates(subset='id')
+
+        grouped = new.groupby(
+            [self.cat_column, new['date'].dt.day])['amount_cents'].sum()
+        for (category, day), cents in grouped.items():
+            if category not in self.daily:
+                self.daily[category] = np.zeros(32, dtype=np.int64)
+                self.totals[category] = 0
+            self.daily[category][day] += cents
+            self.totals[category] += cents
+
+        self.seen_ids.update(new['id'])
+        return len(new)
+
+    def spending(self, fixed_categories, date_cutoff=None):
+        """
+        Return month-to-date spending in the same format as
+        User.current_month_spending().
+
+        Parameters:
+            fixed_categories (list): categories that will be explicitly
+                listed in the output regardless of current spending amount
+            date_cutoff (int): if set, only days up to and including the
+                cutoff are counted
+
+        Returns:
+            Python dictionary of spending by category.
+        """
+        if date_cutoff:
+            cents = {category: self.daily[category][:date_cutoff + 1].sum()
+                     for category in self.daily}
+            # leave out categories only spent in after the cutoff
+            cents = {category: cents[category] for category in cents
+                     if cents[category] > 0}
+        else:
+            cents = self.totals
+
+        grouped_dict = {category: round(cents[category] / 100, 2)
+                        for category in sorted(cents)}
+
+        return trim_month_spending(grouped_dict, fixed_categories)
+
+
+class MonthToDateStore():
+    """
+    Class used to hold the MonthToDateSpending of every bank account seen by
+    this worker.
+
+    Attributes:
+        cat_column (str): category column the totals are grouped by
+        accounts (dict): MonthToDateSpending for each bank account id
+        seeding (dict): rows that arrived while an account was being seeded
+        seeds (BlockingSingleFlight): runs one seed at a time per account
+        lock (Lock): guards accounts and seeding, which are shared with the
+            notification listener thread
+    """
+
+    def __init__(self, cat_column='parent_category_name'):
+        """
+        Constructor for the MonthToDateStore class.
+
+        Parameters:
+            cat_column (str): category column the totals are grouped by
+        """
+        self.cat_column = cat_column
+        self.accounts = {}
+        self.seeding = {}
+        self.seeds = BlockingSingleFlight()
+        self.lock = threading.Lock()
+
+    def seed(self, bank_id, year, month):
+        """
+        Build the running totals for an account's month from the database.
+        Concurrent requests for an account being seeded wait for that seed.
+
+        Returns:
+            MonthToDateSpending, or None if the bank account doesn't exist
+        """
+        return self.seeds.do(bank_id, self.fetch_seed, bank_id, year, month)
+
+    def fetch_seed(self, bank_id, year, month):
+        """
+        Query the running totals for an account's month, applying the
+        transactions ingested meanwhile. Only called through seed().
+
+        Returns:
+            MonthToDateSpending, or None if the bank account doesn't exist
+        """
+        with self.lock:
+            self.seeding[bank_id] = []
+
+        try:
+            # read before the month's rows, so later rows are caught up
+            max_id = fetch_statement('max_transaction_id',
+                                     (int(bank_id),))['max_id'].iloc[0]
+            if max_id is None or pd.isna(max_id):
+                aggregator = None
+            else:
+                checked_at = time.monotonic()
+                rows = load_transaction_rows(
+                    bank_id, since=month_start(year, month))
+                aggregator = MonthToDateSpending(year, month, self.cat_column)
+                aggregator.apply(rows)
+                aggregator.max_id = int(max_id)
+                aggregator.checked_at = checked_at
+        except Exception:
+            with self.lock:
+                self.seeding.pop(bank_id, None)
+            raise
+
+        with self.lock:
+            pending = self.seeding.pop(bank_id)
+            if aggregator is not None:
+                # apply anything ingested while the seed query was running
+                for rows in pending:
+                    aggregator.apply(rows)
+                self.accounts[bank_id] = aggregator
+        return aggregator
+
+    def catch_up(self, bank_id, aggregator):
+        """
+        Apply the account's transactions added since the totals were last
+        read from the database.
+        """
+        with self.lock:
+            after_id = aggregator.max_id
+            # a bump during the query marks the totals to check again
+            aggregator.checked_at = time.monotonic()
+
+        rows = load_transaction_rows(bank_id, after_id=after_id)
+
+        with self.lock:
+            aggregator.apply(rows)
+            if len(rows):
+                aggregator.max_id = max(aggregator.max_id,
+                                        int(rows['id'].max()))
+
+    def get(self, bank_id):
+        """
+        Return the running totals for the current month, seeding them if the
+        account hasn't been seen yet or the month has rolled over, and
+        catching up with new transactions otherwise.
+
+        Returns:
+            MonthToDateSpending, or None if the bank account doesn't exist
+        """
+        now = dt.datetime.now()
+        with self.lock:
+            aggregator = self.accounts.get(bank_id)
+
+        if aggregator is None or ((aggregator.year, aggregator.month) !=
+                                  (now.year, now.month)):
+            return self.seed(bank_id, now.year, now.month)
+
+        checked_at = aggregator.checked_at
+        if checked_at is None or \
+                time.monotonic() - checked_at >= MONTH_TO_DATE_MAX_AGE:
+            self.catch_up(bank_id, aggregator)
+        return aggregator
+
+    def invalidate(self, bank_id):
+        """
+        Check the database for new transactions on the account's next
+        request, or seed every account again for None.
+
+        Subscribed to account_versions, and called when notifications may
+        have been missed.
+        """
+        with self.lock:
+            if bank_id is None:
+                self.accounts.clear()
+                return
+            aggregator = self.accounts.get(bank_id)
+            if aggregator is not None:
+                aggregator.checked_at = None
+
+    def spending(self, bank_id, fixed_categories, date_cutoff=None):
+        """
+        Return month-to-date spending for a bank account, or None if the bank
+        account doesn't exist.
+        """
+        aggregator = self.get(bank_id)
+        if aggregator is None:
+            return None
+        with self.lock:
+            return aggregator.spending(fixed_categories,
+                                       date_cutoff=date_cutoff)
+
+    def ingest(self, bank_id, transaction_ids):
+        """
+        Apply new transactions to an account's running totals.
+
+        Accounts that haven't been seeded yet are skipped, they will pick the
+        transactions up when they are seeded.
+
+        Parameters:
+            bank_id (int): bank account id
+            transaction_ids (list): ids of new plaid_main_transactions rows
+
+        Returns:
+            the number of transactions added
+        """
+        with self.lock:
+            aggregator = self.accounts.get(bank_id)
+            tracked = bank_id in self.seeding or aggregator is not None
+        if not tracked or not transaction_ids:
+            return 0
+
+        rows = load_transaction_rows(bank_id,
+                                     transaction_ids=transaction_ids)
+
+        with self.lock:
+            if bank_id in self.seeding:
+                self.seeding[bank_id].append(rows)
+                return len(rows)
+            aggregator = self.accounts.get(bank_id)
+            if aggregator is None:
+                return 0
+            return aggregator.apply(rows)
+
+
+month_to_date_store = MonthToDateStore()
+account_versions.subscribe(month_to_date_store.invalidate)
+
+
+def listen_for_new_transactions(channel, stores=(month_to_date_store,),
+                                timeout=5, stop_event=None):
+    """
+    Apply new transactions announced with Postgres NOTIFY to the stores.
+
+    Each notification payload is a JSON object with the bank_account_id and
+    id of a new plaid_main_transactions row, as sent by the trigger in
+    notify_new_transactions.sql. Blocks until stop_event is set, so run it in
+    a background thread. After a dropped connection is reopened, every
+    store is invalidated, since the notifications sent in between are lost.
+
+    Parameters:
+        channel (str): notification channel to LISTEN on
+        stores (list): stores the transactions are applied to, with
+            ingest(bank_id, transaction_ids) and invalidate(bank_id) methods
+            like MonthToDateStore
+        timeout (int): seconds to wait for notifications between checks of
+            stop_event
+        stop_event (Event): set to stop listening
+    """
+    stop_event = stop_event or threading.Event()
+
+    def resync():
+        for store in stores:
+            try:
+                store.invalidate(None)
+            except Exception:
+                log.exception(f'failed to invalidate {store!r}')
+
+    for payloads in listen_for_notifications([channel], stop_event, timeout,
+                                             on_reconnect=resync):
+        # group the notifications by account so each account needs a single
+        # query
+        new_ids = {}
+        for payload in payloads:
+            try:
+                message = json.loads(payload)
+                new_ids.setdefault(int(message['bank_account_id']),
+                                   []).append(int(message['id']))
+            except (ValueError, KeyError, TypeError):
+                log.warning(f'ignoring notification {payload!r}')
+
+        for bank_id, ids in new_ids.items():
+            for store in stores:
+                try:
+                    store.ingest(bank_id, ids)
+                except Exception:
+                    log.exception(f'failed to ingest transactions {ids} '
+                                  f'for bank account {bank_id}')
+
+
+def start_listener(channel, stores=(month_to_date_store,)):
+    """
+    Start listen_for_new_transactions() in a daemon thread.
+
+    Returns:
+        the Event that stops the listener when set
+    """
+    stop_event = threading.Event()
+    thread = threading.Thread(target=listen_for_new_transactions,
+                              args=(channel, stores),
+                              kwargs={'stop_event': stop_event},
+                              name=f'listen-{channel}', daemon=True)
+    thread.start()
+    return stop_event
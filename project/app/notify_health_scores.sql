@@ -0,0 +1,30 @@
+-- Announce new financial health scores so the API can drop the cached
+-- dashboard data of the scored users' accounts (see app/invalidation.py).
+-- Start the API with SAVER_INVALIDATION_CHANNELS=new_transactions,new_health_scores
+-- to listen, along with notify_new_transactions.sql.
+--
+-- Scores are inserted in runs covering many users, so the trigger runs once
+-- per statement: it names each scored user, or every account when a
+-- statement scores more than 100 users.
+
+CREATE OR REPLACE FUNCTION notify_new_health_scores() RETURNS trigger AS $$
+BEGIN
+    IF (SELECT count(DISTINCT user_id) FROM new_scores) > 100 THEN
+        PERFORM pg_notify('new_health_scores',
+                          json_build_object('all', true)::text);
+    ELSE
+        PERFORM pg_notify('new_health_scores',
+                          json_build_object('user_id', user_id)::text)
+        FROM (SELECT DISTINCT user_id FROM new_scores) AS scored_users;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS transactional_financial_health_scores_notify
+    ON public.transactional_financial_health_scores;
+
+CREATE TRIGGER transactional_financial_health_scores_notify
+    AFTER INSERT ON public.transactional_financial_health_scores
+    REFERENCING NEW TABLE AS new_scores
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_new_health_scores();
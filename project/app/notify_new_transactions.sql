@@ -0,0 +1,19 @@
+-- Announce new transactions so the API can update its month-to-date totals
+-- without reloading the account (see app/month_to_date.py).
+-- Start the API with SAVER_TRANSACTION_CHANNEL=new_transactions to listen.
+
+CREATE OR REPLACE FUNCTION notify_new_transaction() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('new_transactions',
+                      json_build_object('bank_account_id', NEW.bank_account_id,
+                                        'id', NEW.id)::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS plaid_main_transactions_notify
+    ON public.plaid_main_transactions;
+
+CREATE TRIGGER plaid_main_transactions_notify
+    AFTER INSERT ON public.plaid_main_transactions
+    FOR EACH ROW EXECUTE PROCEDURE notify_new_transaction();
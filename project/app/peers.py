@@ -0,0 +1,493 @@
+"""
+Peer spending benchmarks from mergeable quantile sketches.
+
+To tell a user "you spend more on Food than 70% of savers", the API needs
+the distribution of every account's monthly spending per category. Computing
+exact percentiles over every account per request is out of the question, so
+an offline job summarizes the distributions into quantile sketches and the
+API answers percentile lookups from them in microseconds.
+
+The sketches keep counts in logarithmic buckets (as in DDSketch): the
+quantiles they report are within RELATIVE_ACCURACY of the exact ones, the
+percentile of an amount counts the values up to at most 2 *
+RELATIVE_ACCURACY above it, and two sketches merge exactly by adding their
+counts. The build job splits the
+accounts into chunks, sketches each chunk in its own process and merges the
+results.
+
+The build saves the sketches as JSON and publishes them packed into flat
+arrays (see pack_sketches()) as reference data shared by the API's worker
+processes (see app/reference.py), which answer lookups from the arrays
+without loading the sketches into each process.
+
+There is one sketch per category level (grandparent or parent), category
+and month, holding each account's total spending in that category that
+month, plus one per category across all months, holding every account
+month. As in monthly_spending_totals(), an account's latest month is left
+out since it is usually incomplete, and only the 12 months before it are
+used. Accounts that spent nothing in a category in a month they were active
+count as zero spending, so that percentiles are of all savers rather than
+of the savers who spent in the category.
+
+Usage (from the project directory):
+
+    python -m app.peers build
+    python -m app.peers build --workers 4 --chunk-size 500
+"""
+import argparse
+import bisect
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from app.helpers import (SAVER_USERNAME, SAVER_PASSWORD, SAVER_DB_HOST,
+                         SAVER_DB_NAME, fetch_statement)
+from app.reference import (REFERENCE_DIR, ReferenceData, publish,
+                           sorted_lookup)
+
+PEER_SKETCH_PATH = os.environ.get("SAVER_PEER_SKETCHES",
+                                  "peer_sketches.json")
+
+# relative error of the values at the ranks reported by the sketches
+RELATIVE_ACCURACY = 0.01
+
+# category columns the sketches are kept for, by level
+LEVELS = {
+    'grandparent': 'grandparent_category_name',
+    'parent': 'parent_category_name',
+}
+
+# number of complete months used per account
+NUM_MONTHS = 12
+
+
+class QuantileSketch():
+    """
+    Class used to summarize a distribution of positive amounts.
+
+    Attributes:
+        relative_accuracy (float): relative error of the bucket values
+        counts (dict): number of values in each logarithmic bucket
+        zero_count (int): number of values at or below zero
+        count (int): number of values added
+    """
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        """
+        Constructor for the QuantileSketch class.
+
+        Parameters:
+            relative_accuracy (float): relative error of the bucket values
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.counts = {}
+        self.zero_count = 0
+        self.count = 0
+        self.keys = None
+        self.cumulative = None
+
+    def bucket(self, value):
+        """
+        Return the bucket a positive value falls in.
+        """
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def add(self, values):
+        """
+        Add an array of values to the sketch.
+        """
+        values = np.asarray(values, dtype=float)
+        positive = values[values > 0]
+        self.zero_count += int(len(values) - len(positive))
+        self.count += int(len(values))
+
+        buckets, counts = np.unique(
+            np.ceil(np.log(positive) / self.log_gamma).astype(int),
+            return_counts=True)
+        for bucket, count in zip(buckets.tolist(), counts.tolist()):
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.keys = None
+
+    def merge(self, other):
+        """
+        Add the values of another sketch with the same accuracy.
+        """
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.keys = None
+
+    def freeze(self):
+        """
+        Build the sorted buckets and cumulative counts rank() and quantile()
+        search. Done once after the last add() or merge().
+        """
+        self.keys = sorted(self.counts)
+        self.cumulative = []
+        total = self.zero_count
+        for bucket in self.keys:
+            total += self.counts[bucket]
+            self.cumulative.append(total)
+
+    def rank(self, value):
+        """
+        Return the fraction of values at or below the given value. Values in
+        the same bucket as the given value, at most a factor gamma above it,
+        are counted too.
+        """
+        if self.count == 0:
+            return None
+        if self.keys is None:
+            self.freeze()
+        if value <= 0:
+            return self.zero_count / self.count
+
+        i = bisect.bisect_right(self.keys, self.bucket(value))
+        below = self.cumulative[i - 1] if i else self.zero_count
+        return below / self.count
+
+    def quantile(self, q):
+        """
+        Return the value at quantile q (0 - 1), within relative_accuracy.
+        """
+        if self.count == 0:
+            return None
+        if self.keys is None:
+            self.freeze()
+
+        target = q * (self.count - 1)
+        if target < self.zero_count:
+            return 0.0
+        i = bisect.bisect_right(self.cumulative, target)
+        bucket = self.keys[min(i, len(self.keys) - 1)]
+        return 2 * self.gamma ** bucket / (self.gamma + 1)
+
+    def to_dict(self):
+        """
+        Returns the sketch as a JSON serializable dictionary.
+        """
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'counts': {str(bucket): count
+                       for bucket, count in self.counts.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, saved):
+        """
+        Rebuild a sketch from to_dict().
+        """
+        sketch = cls(saved['relative_accuracy'])
+        sketch.counts = {int(bucket): count
+                         for bucket, count in saved['counts'].items()}
+        sketch.zero_count = saved['zero_count']
+        sketch.count = saved['count']
+        return sketch
+
+
+def pack_sketches(sketches):
+    """
+    Pack sketches into the flat arrays PeerBenchmarks looks percentiles up
+    in.
+
+    Parameters:
+        sketches (dict): QuantileSketch by sketch_key()
+
+    Returns:
+        dictionary of arrays: the sorted sketch keys, each sketch's
+        relative accuracy, count and zero count, and its sorted buckets and
+        cumulative counts (as built by freeze()) at buckets[starts[i]:
+        starts[i + 1]]
+    """
+    keys = sorted(sketches)
+    starts = [0]
+    buckets, cumulative = [], []
+    for key in keys:
+        sketch = sketches[key]
+        sketch.freeze()
+        buckets.extend(sketch.keys)
+        cumulative.extend(sketch.cumulative)
+        starts.append(len(buckets))
+
+    return {
+        'keys': np.array(keys, dtype=str),
+        'relative_accuracy': np.array(
+            [sketches[key].relative_accuracy for key in keys], dtype=float),
+        'counts': np.array([sketches[key].count for key in keys],
+                           dtype=np.int64),
+        'zero_counts': np.array([sketches[key].zero_count for key in keys],
+                                dtype=np.int64),
+        'starts': np.array(starts, dtype=np.int64),
+        'buckets': np.array(buckets, dtype=np.int32),
+        'cumulative': np.array(cumulative, dtype=np.int64),
+    }
+
+
+def sketch_key(level, category, month='all'):
+    """
+    Return the key a sketch is saved under, e.g. 'grandparent|Food|2020-08'.
+    """
+    return f'{level}|{category}|{month}'
+
+
+def monthly_category_totals(rows):
+    """
+    Sum each account's expenses by month and category.
+
+    Parameters:
+        rows (dataframe): rows returned by query.sql for several accounts
+
+    Returns:
+        dictionary of series, by level, of the totals in dollars indexed by
+        bank_account_id, month and category
+    """
+    expenses = rows[(rows['grandparent_category_name'] != 'Transfers') &
+                    (rows['amount_cents'] > 0)]
+    dates = pd.to_datetime(expenses['date'])
+    month_number = dates.dt.year * 12 + dates.dt.month
+
+    # leave out each account's latest, usually incomplete, month and keep
+    # the NUM_MONTHS months before it
+    latest = month_number.groupby(expenses['bank_account_id']) \
+        .transform('max')
+    age = latest - month_number
+    keep = (age >= 1) & (age <= NUM_MONTHS)
+    expenses = expenses[keep]
+    month = dates[keep].dt.strftime('%Y-%m')
+
+    return {
+        level: expenses.groupby(['bank_account_id', month, column])
+        ['amount_cents'].sum() / 100
+        for level, column in LEVELS.items()
+    }
+
+
+def active_account_months(rows):
+    """
+    Count the accounts active each month: those whose months kept by
+    monthly_category_totals() include it, from their first expense on.
+
+    Parameters:
+        rows (dataframe): rows returned by query.sql for several accounts
+
+    Returns:
+        dictionary of the number of accounts by month ('YYYY-MM')
+    """
+    expenses = rows[(rows['grandparent_category_name'] != 'Transfers') &
+                    (rows['amount_cents'] > 0)]
+    dates = pd.to_datetime(expenses['date'])
+    month_number = dates.dt.year * 12 + dates.dt.month - 1
+    bounds = month_number.groupby(expenses['bank_account_id']) \
+        .agg(['min', 'max'])
+
+    active = {}
+    for first, latest in zip(bounds['min'], bounds['max']):
+        for number in range(max(first, latest - NUM_MONTHS), latest):
+            month = f'{number // 12:04d}-{number % 12 + 1:02d}'
+            active[month] = active.get(month, 0) + 1
+    return active
+
+
+def add_zero_spending(sketches, active):
+    """
+    Count the accounts active in a month that didn't spend in a category as
+    zero spending in the category's sketches. Done once the chunks are
+    merged, since a chunk has no sketch for the categories none of its
+    accounts spent in.
+
+    Parameters:
+        sketches (dict): QuantileSketch by sketch_key(), of the positive
+            totals
+        active (dict): number of active accounts by month, see
+            active_account_months()
+    """
+    account_months = sum(active.values())
+    for key, sketch in sketches.items():
+        month = key.rsplit('|', 1)[1]
+        accounts = account_months if month == 'all' else active.get(month, 0)
+        zeros = accounts - sketch.count
+        if zeros > 0:
+            sketch.zero_count += zeros
+            sketch.count += zeros
+            sketch.keys = None
+
+
+def sketch_accounts(bank_ids, relative_accuracy=RELATIVE_ACCURACY):
+    """
+    Build the sketches of the positive totals for a chunk of bank accounts.
+    Runs in the build's worker processes.
+
+    Returns:
+        dictionary of QuantileSketch by sketch_key(), and the number of
+        active accounts by month
+    """
+    rows = fetch_statement('accounts_transactions',
+                           ([int(i) for i in bank_ids],))
+    sketches = {}
+    if len(rows) == 0:
+        return sketches, {}
+
+    for level, totals in monthly_category_totals(rows).items():
+        for (month, category), values in totals.groupby(level=[1, 2]):
+            for key in (sketch_key(level, category, month),
+                        sketch_key(level, category)):
+                sketch = sketches.setdefault(
+                    key, QuantileSketch(relative_accuracy))
+                sketch.add(values.values)
+    return sketches, active_account_months(rows)
+
+
+def build_sketches(path=PEER_SKETCH_PATH, workers=4, chunk_size=500,
+                   relative_accuracy=RELATIVE_ACCURACY,
+                   reference_dir=REFERENCE_DIR):
+    """
+    Build the peer sketches from plaid_main_transactions, save them and
+    publish them to the API's workers.
+
+    Parameters:
+        path (str): file the sketches are written to
+        workers (int): number of processes building chunks at once
+        chunk_size (int): number of accounts per chunk
+        relative_accuracy (float): relative error of the sketches
+        reference_dir (str): directory the packed sketches are published in
+
+    Returns:
+        dictionary of QuantileSketch by sketch_key()
+    """
+    conn = psycopg2.connect(user=SAVER_USERNAME, password=SAVER_PASSWORD,
+                            host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
+    bank_ids = pd.read_sql("""
+    SELECT DISTINCT bank_account_id
+    FROM public.plaid_main_transactions
+    ORDER BY bank_account_id
+    """, conn)['bank_account_id'].tolist()
+    conn.close()
+
+    chunks = [bank_ids[i:i + chunk_size]
+              for i in range(0, len(bank_ids), chunk_size)]
+
+    sketches = {}
+    active = {}
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        for chunk_sketches, chunk_active in executor.map(
+                sketch_accounts, chunks,
+                [relative_accuracy] * len(chunks)):
+            for key, sketch in chunk_sketches.items():
+                if key in sketches:
+                    sketches[key].merge(sketch)
+                else:
+                    sketches[key] = sketch
+            for month, count in chunk_active.items():
+                active[month] = active.get(month, 0) + count
+    add_zero_spending(sketches, active)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'built_at': time.time(), 'accounts': len(bank_ids),
+                   'sketches': {key: sketch.to_dict()
+                                for key, sketch in sketches.items()}}, f)
+    os.replace(tmp_path, path)
+
+    publish('peer_sketches', pack_sketches(sketches), reference_dir)
+    return sketches
+
+
+class PeerBenchmarks():
+    """
+    Class used to answer percentile lookups from the published sketches.
+
+    The arrays are memory-mapped from the published version and the next
+    version is attached when the sketches are rebuilt, without restarting
+    the API.
+
+    Attributes:
+        reference (ReferenceData): the published arrays of pack_sketches()
+    """
+
+    def __init__(self, reference_dir=REFERENCE_DIR):
+        """
+        Constructor for the PeerBenchmarks class.
+
+        Parameters:
+            reference_dir (str): directory the sketches are published in
+        """
+        self.reference = ReferenceData('peer_sketches', reference_dir)
+
+    def percentile(self, level, category, amount, month='all'):
+        """
+        Return the percentage of accounts active in the given month
+        ('YYYY-MM') that spent at most `amount` in the category, spending
+        nothing included, and the number of account months the sketch
+        holds. With 'all', each account's months count separately.
+
+        The percentile is the sketch's rank() of the amount.
+
+        Returns:
+            (percentile, count), or None if there is no sketch for the
+            category and month
+        """
+        arrays = self.reference.get()
+        if arrays is None:
+            return None
+        positions, found = sorted_lookup(
+            arrays['keys'], [sketch_key(level, category, month)])
+        if not found[0]:
+            return None
+
+        i = positions[0]
+        count = int(arrays['counts'][i])
+        if count == 0:
+            return None
+        zero_count = int(arrays['zero_counts'][i])
+        if amount <= 0:
+            return 100 * (zero_count / count), count
+
+        relative_accuracy = float(arrays['relative_accuracy'][i])
+        gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        bucket = math.ceil(math.log(amount) / math.log(gamma))
+        start, end = arrays['starts'][i], arrays['starts'][i + 1]
+        j = int(np.searchsorted(arrays['buckets'][start:end], bucket,
+                                side='right'))
+        below = int(arrays['cumulative'][start + j - 1]) if j else zero_count
+        return 100 * (below / count), count
+
+
+peer_benchmarks = PeerBenchmarks()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the peer spending sketches.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build = subparsers.add_parser('build')
+    build.add_argument('--out', default=PEER_SKETCH_PATH)
+    build.add_argument('--workers', type=int, default=4)
+    build.add_argument('--chunk-size', type=int, default=500)
+    build.add_argument('--relative-accuracy', type=float,
+                       default=RELATIVE_ACCURACY)
+    build.add_argument('--reference-dir', default=REFERENCE_DIR)
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        start = time.perf_counter()
+        sketches = build_sketches(args.out, args.workers, args.chunk_size,
+                                  args.relative_accuracy, args.reference_dir)
+        print(f'{len(sketches)} sketches written to {args.out} in '
+              f'{time.perf_counter() - start:.1f}s')
+    else:
+        parser.print_help()
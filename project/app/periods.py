@@ -0,0 +1,230 @@
+"""
+Charts for several time periods built from one pass over the transactions.
+
+The frontend fills its week / month / year / all tabs by calling /spending
+or /moneyflow once per period, and every call reloaded the transactions,
+filtered them again with get_last_time_period() and grouped them again.
+
+PeriodTotals sorts the transactions once and sums them by date and
+category. The windows of get_last_time_period() are the dates after a
+cutoff, so each window starts at a searchsorted() position in the sorted
+dates and ends at the last date:
+- the pie chart's category totals for a window are the cumulative sums at
+  the end minus the cumulative sums at its start
+- the bar and money flow charts take the window's slice of the daily
+  totals, which only has one row per date and category
+
+Sums are kept in integer cents, so the differences are exact.
+
+Building plotly figures costs more than the sums, so the pie and money flow
+charts are built once and only their data and title are replaced for the
+other periods. Bar charts have one trace per category and are built for
+each period.
+"""
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from app.user import (User, TIME_PERIOD_DAYS, trimmer, choose_resolution,
+                      bucket_dates)
+
+# time periods charted when none are given, in the frontend's tab order
+DEFAULT_TIME_PERIODS = ['week', 'month', 'year', 'all']
+
+
+class PeriodTotals():
+    """
+    Class used to sum transactions over the windows of several time periods.
+
+    Attributes:
+        dates (array): sorted dates that have transactions
+        categories (index): categories, None when the totals aren't split
+            by category
+        latest (Timestamp): latest date, the end of every window
+        daily (array): cents on each date, by category
+        daily_counts (array): number of transactions on each date, by
+            category
+        cumulative (array): cents on the dates before each date, by category
+            (one more row than dates)
+        counts (array): cumulative number of transactions, like cumulative
+    """
+
+    def __init__(self, transactions, category=None):
+        """
+        Constructor for the PeriodTotals class.
+
+        Parameters:
+            transactions (dataframe): transactions or folded totals with date
+                and amount_dollars columns
+            category (str): category column to split the totals by
+        """
+        transactions = transactions.sort_values(by=['date'])
+        cents = pd.Series(
+            np.rint(transactions['amount_dollars'].values * 100)
+            .astype(np.int64), index=transactions.index)
+        if 'transaction_count' in transactions.columns:
+            counts = transactions['transaction_count']
+        else:
+            counts = pd.Series(1, index=transactions.index)
+
+        if category is None:
+            keys = [transactions['date']]
+        else:
+            keys = [transactions['date'], transactions[category]]
+        daily = pd.DataFrame({'cents': cents, 'count': counts}) \
+            .groupby(keys, dropna=False).sum()
+
+        if category is None:
+            self.categories = None
+            cents, counts = daily[['cents']], daily[['count']]
+        else:
+            cents = daily['cents'].unstack(fill_value=0)
+            counts = daily['count'].unstack(fill_value=0)
+            self.categories = cents.columns
+
+        self.dates = cents.index.values
+        self.latest = cents.index[-1]
+        self.daily = cents.values
+        self.daily_counts = counts.values
+        zeros = np.zeros((1, cents.shape[1]), dtype=np.int64)
+        self.cumulative = np.vstack([zeros, np.cumsum(cents.values, axis=0)])
+        self.counts = np.vstack([zeros, np.cumsum(counts.values, axis=0)])
+
+    def start(self, time_period):
+        """
+        Returns the position in dates of the first date in the window of
+        get_last_time_period().
+        """
+        if time_period == 'all':
+            return 0
+        if time_period not in TIME_PERIOD_DAYS:
+            raise ValueError(
+                f"time_period must be one of 'day, week, month, year, or all'. Got {time_period} instead.")
+        cutoff = self.latest - timedelta(days=TIME_PERIOD_DAYS[time_period])
+        return int(np.searchsorted(self.dates, np.datetime64(cutoff),
+                                   side='right'))
+
+    def category_totals(self, time_period):
+        """
+        Returns a dataframe of the window's amount_dollars by category, for
+        the categories with transactions in the window.
+        """
+        start = self.start(time_period)
+        cents = self.cumulative[-1] - self.cumulative[start]
+        counts = self.counts[-1] - self.counts[start]
+        totals = pd.DataFrame({'amount_dollars': cents / 100},
+                              index=self.categories)
+        totals.index.name = self.categories.name
+        return totals[counts > 0]
+
+    def daily_totals(self, time_period):
+        """
+        Returns the window's daily cents as a dataframe indexed by date,
+        with a column per category (or a single 'cents' column). Dates
+        without transactions in a category are NaN.
+        """
+        start = self.start(time_period)
+        columns = self.categories if self.categories is not None \
+            else ['cents']
+        cents = np.where(self.daily_counts[start:] > 0, self.daily[start:],
+                         np.nan)
+        return pd.DataFrame(cents, index=self.dates[start:], columns=columns)
+
+
+def pie_charts(user, time_periods, category, color_template):
+    """
+    Returns the categorical_spending() pie chart of each time period.
+    """
+    totals = PeriodTotals(user.expenses, category)
+    charts = {}
+    fig = None
+    for time_period in time_periods:
+        grouped = totals.category_totals(time_period)
+        # NaN categories are left out, as by groupby()
+        grouped = grouped[grouped.index.notna()]
+        trimmer(grouped, threshold_1=0.02, trim_name='amount_dollars')
+        fig = user.pie_figure(grouped, time_period, color_template, fig)
+        charts[time_period] = fig.to_json()
+    return charts
+
+
+def bar_charts(user, time_periods, category, color_template, resolution):
+    """
+    Returns the bar_viz() bar chart of each time period.
+    """
+    totals = PeriodTotals(user.expenses, category)
+    charts = {}
+    for time_period in time_periods:
+        daily = totals.daily_totals(time_period)
+        daily.columns = daily.columns.astype(str)
+        daily.index.name = 'date'
+        daily.columns.name = category
+
+        period_resolution = resolution
+        if resolution == 'auto':
+            period_resolution = choose_resolution(daily.index)
+
+        # stack() leaves out the NaN of dates without spending
+        bars = daily.stack().rename('cents').reset_index()
+        bars['date'] = bucket_dates(bars['date'], period_resolution)
+        bars = bars.groupby([category, 'date'])['cents'].sum() / 100
+        bars = bars.rename('amount_dollars').reset_index()
+        charts[time_period] = user.bar_figure(
+            bars, time_period, category, color_template,
+            period_resolution).to_json()
+    return charts
+
+
+def spending_periods(transactions, graph_type, time_periods, color_template,
+                     hole, resolution='day'):
+    """
+    Return the jsonified /spending chart of each time period.
+
+    Parameters:
+        transactions (dataframe): transactions covering the longest period
+        graph_type (str): 'pie' or 'bar'
+        time_periods (list): time periods accepted by get_last_time_period()
+
+    Returns:
+        dictionary of plotly json by time period
+    """
+    user = User(transactions, hole=hole)
+    category = 'grandparent_category_name'
+
+    if graph_type == 'pie':
+        return pie_charts(user, time_periods, category, color_template)
+
+    if graph_type == 'bar':
+        return bar_charts(user, time_periods, category, color_template,
+                          resolution)
+
+
+def money_flow_periods(transactions, time_periods, max_points=None):
+    """
+    Return the jsonified /moneyflow chart of each time period.
+
+    Parameters:
+        transactions (dataframe): transactions covering the longest period
+        time_periods (list): time periods accepted by get_last_time_period()
+        max_points (int): if set, each line is downsampled to at most this
+            many points
+
+    Returns:
+        dictionary of plotly json by time period
+    """
+    user = User(transactions)
+    totals = PeriodTotals(user.data)
+    charts = {}
+    fig = None
+    for time_period in time_periods:
+        daily = totals.daily_totals(time_period)['cents'] / 100
+        total_each_day = pd.DataFrame(
+            {'amount_dollars': daily.resample('D').sum()})
+        total_each_day.index.name = 'date'
+        total_each_day['amount_flipped'] = \
+            total_each_day['amount_dollars'] * -1
+        fig = user.money_flow_figure(total_each_day, time_period,
+                                     max_points, fig)
+        charts[time_period] = fig.to_json()
+    return charts
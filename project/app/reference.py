@@ -0,0 +1,167 @@
+"""
+Reference data shared by the API's worker processes.
+
+Every uvicorn worker used to build its own copy of the data that only
+changes when an offline job is rerun: the peer spending sketches and the
+merchant index were read from JSON into Python dictionaries in each
+process, costing every worker the same tens of megabytes.
+
+Reference data is instead published as a set of NumPy arrays saved as .npy
+files, which workers open with np.load(mmap_mode='r'). The arrays are
+memory-mapped read-only, so every worker reads the same pages of the OS
+page cache and none of them holds a private copy.
+
+Each publish writes a new version directory and then replaces the CURRENT
+file naming the version, so workers see either the old set of arrays or
+the new one, never a mix. Workers check CURRENT when the data is used and
+attach to the new version when it changes. Old versions are removed after
+KEEP_VERSIONS newer ones are published; a worker still attached to a
+removed version keeps reading it until it switches, as the mapping stays
+valid after the files are unlinked.
+
+Arrays are published under SAVER_REFERENCE_DIR, one directory per dataset:
+
+    reference_data/peer_sketches/CURRENT
+    reference_data/peer_sketches/1602245843123456789/keys.npy
+    ...
+"""
+import os
+import shutil
+import time
+
+import numpy as np
+
+REFERENCE_DIR = os.environ.get("SAVER_REFERENCE_DIR", "reference_data")
+
+# number of published versions kept for workers that haven't switched yet
+KEEP_VERSIONS = 2
+
+
+def publish(name, arrays, directory=REFERENCE_DIR):
+    """
+    Publish a new version of a dataset.
+
+    Parameters:
+        name (str): name of the dataset, e.g. 'peer_sketches'
+        arrays (dict): NumPy arrays by name. Object arrays can't be
+            memory-mapped, so strings are stored as fixed width 'U' or 'S'
+            arrays
+        directory (str): directory the datasets are published in
+
+    Returns:
+        the version published
+    """
+    dataset = os.path.join(directory, name)
+    version = str(time.time_ns())
+    os.makedirs(os.path.join(dataset, version))
+
+    for array_name, array in arrays.items():
+        array = np.asarray(array)
+        if array.dtype == object:
+            raise ValueError(f'{name}/{array_name} is an object array')
+        np.save(os.path.join(dataset, version, f'{array_name}.npy'), array)
+
+    current = os.path.join(dataset, 'CURRENT')
+    with open(current + '.tmp', 'w') as f:
+        f.write(version)
+    os.replace(current + '.tmp', current)
+
+    versions = sorted((entry for entry in os.listdir(dataset)
+                       if entry.isdigit()), key=int)
+    for old in versions[:-KEEP_VERSIONS - 1]:
+        shutil.rmtree(os.path.join(dataset, old), ignore_errors=True)
+    return version
+
+
+class ReferenceData():
+    """
+    Class used to attach to the current version of a published dataset.
+
+    Attributes:
+        name (str): name of the dataset
+        directory (str): directory the datasets are published in
+        version (str): version attached to, None until one is published
+        arrays (dict): read-only memory-mapped arrays of the version
+        mtime (int): modification time of CURRENT when it was read
+    """
+
+    def __init__(self, name, directory=REFERENCE_DIR):
+        """
+        Constructor for the ReferenceData class.
+
+        Parameters:
+            name (str): name of the dataset
+            directory (str): directory the datasets are published in
+        """
+        self.name = name
+        self.directory = directory
+        self.version = None
+        self.arrays = {}
+        self.mtime = None
+
+    def refresh(self):
+        """
+        Attach to the current version if it has changed since the last
+        call.
+
+        Returns:
+            True if a new version was attached
+        """
+        dataset = os.path.join(self.directory, self.name)
+        current = os.path.join(dataset, 'CURRENT')
+        try:
+            mtime = os.stat(current).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self.mtime:
+            return False
+
+        with open(current) as f:
+            version = f.read().strip()
+        if version == self.version:
+            self.mtime = mtime
+            return False
+
+        path = os.path.join(dataset, version)
+        arrays = {entry[:-len('.npy')]:
+                  np.load(os.path.join(path, entry), mmap_mode='r')
+                  for entry in os.listdir(path) if entry.endswith('.npy')}
+        self.arrays, self.version, self.mtime = arrays, version, mtime
+        return True
+
+    def get(self):
+        """
+        Returns the arrays of the current version, or None if the dataset
+        hasn't been published.
+        """
+        self.refresh()
+        return self.arrays if self.version is not None else None
+
+    def stats(self):
+        """
+        Returns the attached version and the size of its arrays in bytes.
+        """
+        return {'version': self.version,
+                'bytes': int(sum(array.nbytes
+                                 for array in self.arrays.values()))}
+
+
+def sorted_lookup(sorted_values, values):
+    """
+    Find values in a sorted array.
+
+    Parameters:
+        sorted_values (array): sorted array to search
+        values (array): values to find
+
+    Returns:
+        tuple of the positions of the values in sorted_values and a boolean
+        array of which values were found
+    """
+    values = np.asarray(values)
+    if len(sorted_values) == 0:
+        return (np.zeros(len(values), dtype=int),
+                np.zeros(len(values), dtype=bool))
+    positions = np.minimum(np.searchsorted(sorted_values, values),
+                           len(sorted_values) - 1)
+    return positions, sorted_values[positions] == values
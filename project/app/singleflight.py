@@ -0,0 +1,252 @@
+"""
+Single-flight coalescing for the data loaders.
+
+When the app opens, the frontend calls /dashboard, /spending, /moneyflow and
+/current_month_spending for the same bank account at nearly the same time.
+Routes load data through the coroutines in this module so that concurrent
+requests for the same account share one database fetch.
+
+The dataframe returned to coalesced callers is the same object, so callers
+must treat it as read-only and copy it before modifying it in place. The
+same goes for values kept by the account cache (see app/invalidation.py),
+which is used when SAVER_ACCOUNT_CACHE_SIZE is set.
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from starlette.concurrency import run_in_threadpool
+
+from app.helpers import (load_user_data, load_user_data_window,
+                         load_user_accounts_data, load_dashboard_metadata)
+from app.invalidation import AccountCache, account_versions
+from app.streaming import (SAVER_STREAMING_MIN_ROWS, load_chart_data,
+                           load_budget_data)
+
+
+class SingleFlight():
+    """
+    Class used to coalesce concurrent calls for the same key into one call.
+
+    Attributes:
+        name (str): name used when reporting stats
+        in_flight (dict): running fetches keyed by the caller's key
+        calls (int): number of calls made through do()
+        fetches (int): number of calls that started a new fetch
+        coalesced (int): number of calls that waited on a running fetch
+    """
+
+    def __init__(self, name):
+        """
+        Constructor for the SingleFlight class.
+
+        Parameters:
+            name (str): name used when reporting stats
+        """
+        self.name = name
+        self.in_flight = {}
+        self.calls = 0
+        self.fetches = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in the threadpool, unless a call with the
+        same key is already running, in which case wait for its result.
+
+        The fetch runs in its own task, so a cancelled caller does not cancel
+        the fetch for the other callers waiting on it.
+
+        Parameters:
+            key (hashable): identifies calls that return the same result
+            func (callable): blocking function to run
+
+        Returns:
+            the return value of func
+        """
+        self.calls += 1
+        task = self.in_flight.get(key)
+
+        if task is None:
+            self.fetches += 1
+            task = asyncio.ensure_future(
+                run_in_threadpool(func, *args, **kwargs))
+            self.in_flight[key] = task
+
+            # forget the fetch once it finishes so later calls fetch again
+            def done(finished_task):
+                if self.in_flight.get(key) is finished_task:
+                    del self.in_flight[key]
+            task.add_done_callback(done)
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def stats(self):
+        """
+        Returns a dictionary of the call counters.
+        """
+        return {
+            'calls': self.calls,
+            'fetches': self.fetches,
+            'coalesced': self.coalesced,
+            'in_flight': len(self.in_flight),
+        }
+
+
+class BlockingSingleFlight():
+    """
+    Class used to coalesce concurrent calls for the same key made from
+    threads into one call, for the stores called from the threadpool and
+    the notification listener thread.
+
+    Attributes:
+        in_flight (dict): Future of each running call keyed by the caller's
+            key
+        lock (Lock): guards in_flight
+    """
+
+    def __init__(self):
+        """
+        Constructor for the BlockingSingleFlight class.
+        """
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs), unless a call with the same key is
+        already running, in which case wait for its result.
+
+        Parameters:
+            key (hashable): identifies calls that return the same result
+            func (callable): blocking function to call
+
+        Returns:
+            the return value of func, or raises its exception
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            running = future is not None
+            if not running:
+                future = Future()
+                self.in_flight[key] = future
+        if running:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            # forget the call once it finishes so later calls run again
+            with self.lock:
+                del self.in_flight[key]
+
+
+user_data_flight = SingleFlight('load_user_data')
+dashboard_flight = SingleFlight('dashboard_metadata')
+
+account_cache = AccountCache('account_data', account_versions)
+
+
+def load_versioned(bank_id, func, *args, **kwargs):
+    """
+    Return the bank account's version read before calling func, and the
+    value func returns.
+    """
+    version = account_versions.version(bank_id)
+    return version, func(*args, **kwargs)
+
+
+async def load_account_value(flight, key, bank_id, func, *args, **kwargs):
+    """
+    Return a bank account's value from the account cache, or load it
+    through a SingleFlight and cache it.
+
+    Parameters:
+        flight (SingleFlight): coalesces the loads of the value
+        key (tuple): identifies the value, starting with its kind
+        bank_id (int): bank account id, whose version the value is kept at
+        func (callable): blocking function loading the value
+    """
+    if not account_cache.max_entries:
+        return await flight.do(key, func, *args, **kwargs)
+
+    value = account_cache.get(bank_id, key)
+    if value is None:
+        # the version is read in the shared fetch, so a call joining a fetch
+        # started before a bump doesn't cache its value as current
+        version, value = await flight.do(key, load_versioned, bank_id, func,
+                                         *args, **kwargs)
+        account_cache.put(bank_id, key, value, version)
+    return value
+
+
+async def load_user_data_shared(bank_id):
+    """
+    Coalesced version of load_user_data(). The result is shared read-only.
+    """
+    return await load_account_value(user_data_flight, ('all', bank_id),
+                                    bank_id, load_user_data, bank_id)
+
+
+async def load_user_data_window_shared(bank_id, days, expenses_only=False):
+    """
+    Coalesced version of load_user_data_window(). The result is shared
+    read-only.
+    """
+    return await load_account_value(
+        user_data_flight, ('window', bank_id, days, expenses_only), bank_id,
+        load_user_data_window, bank_id, days, expenses_only=expenses_only)
+
+
+async def load_chart_data_shared(bank_id):
+    """
+    Coalesced version of load_chart_data(). The result is shared read-only.
+    """
+    if not SAVER_STREAMING_MIN_ROWS:
+        return await load_user_data_shared(bank_id)
+    return await load_account_value(user_data_flight, ('chart', bank_id),
+                                    bank_id, load_chart_data, bank_id)
+
+
+async def load_budget_data_shared(bank_id):
+    """
+    Coalesced version of load_budget_data(). The result is shared read-only.
+    """
+    if not SAVER_STREAMING_MIN_ROWS:
+        return await load_user_data_shared(bank_id)
+    return await load_account_value(user_data_flight, ('budget', bank_id),
+                                    bank_id, load_budget_data, bank_id)
+
+
+async def load_user_accounts_data_shared(user_id):
+    """
+    Coalesced version of load_user_accounts_data(). The result is shared
+    read-only.
+    """
+    return await user_data_flight.do(('user', user_id),
+                                     load_user_accounts_data, user_id)
+
+
+async def load_dashboard_metadata_shared(bank_id):
+    """
+    Coalesced version of load_dashboard_metadata(). The result is shared
+    read-only.
+    """
+    return await load_account_value(dashboard_flight, ('dashboard', bank_id),
+                                    bank_id, load_dashboard_metadata, bank_id)
+
+
+def single_flight_stats():
+    """
+    Returns the counters of every SingleFlight in this module.
+    """
+    return {flight.name: flight.stats()
+            for flight in (user_data_flight, dashboard_flight)}
@@ -0,0 +1,263 @@
+"""
+Columnar snapshots of plaid_main_transactions.
+
+The export command reads the transactions table through query.sql, so the
+snapshot already contains the grandparent and parent category names, and
+writes one Parquet file per range of bank account ids into a new version
+directory:
+
+    <snapshot_dir>/
+        CURRENT
+        <version>/
+            _snapshot.json
+            account_bucket=0/part-0.parquet
+            account_bucket=1/part-0.parquet
+            ...
+
+CURRENT, holding the name of the latest complete version, is replaced
+atomically once the version is written, the same way app/reference.py
+publishes datasets, so readers see either the old snapshot or the new one.
+
+Rows are sorted by bank_account_id and date inside every file, so the row
+group statistics let readers skip everything but the requested account.
+
+Usage (from the project directory):
+
+    python -m app.snapshot export --out snapshots/transactions
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+import datetime as dt
+
+import pandas as pd
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from app.helpers import (SAVER_USERNAME, SAVER_PASSWORD, SAVER_DB_HOST,
+                         SAVER_DB_NAME, QUERY_SQL, fetch_dataframe,
+                         format_user_data)
+
+# columns kept in the snapshot. Everything the API needs from query.sql plus
+# the ids used for partitioning and ordering
+SNAPSHOT_COLUMNS = ['id', 'bank_account_id', 'date', 'amount_cents',
+                    'category_id', 'merchant_name',
+                    'grandparent_category_name', 'parent_category_name']
+
+# default number of bank account ids per partition
+BUCKET_SIZE = 10000
+
+# default number of rows per Parquet row group
+ROW_GROUP_SIZE = 100000
+
+SNAPSHOT_DIR = os.environ.get("SAVER_SNAPSHOT_DIR", "snapshots/transactions")
+
+# previous versions kept for readers still using them
+KEEP_VERSIONS = 2
+
+
+def current_snapshot(snapshot_dir):
+    """
+    Return the directory of the snapshot's current version. Snapshots
+    written before versioning, without a CURRENT file, are read in place.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, 'CURRENT')) as f:
+            return os.path.join(snapshot_dir, f.read().strip())
+    except FileNotFoundError:
+        return snapshot_dir
+
+
+def bucket_path(snapshot_dir, bucket):
+    """
+    Return the directory holding the partition with the given bucket number.
+    """
+    return os.path.join(snapshot_dir, f'account_bucket={bucket}')
+
+
+def read_manifest(snapshot_dir):
+    """
+    Return the manifest written by export_snapshot() as a dictionary.
+    """
+    snapshot_dir = current_snapshot(snapshot_dir)
+    with open(os.path.join(snapshot_dir, '_snapshot.json')) as f:
+        return json.load(f)
+
+
+def export_snapshot(out_dir=SNAPSHOT_DIR, bucket_size=BUCKET_SIZE,
+                    row_group_size=ROW_GROUP_SIZE):
+    """
+    Snapshot plaid_main_transactions into Parquet files partitioned by
+    bank account id range.
+
+    The snapshot is written to a new version directory, and CURRENT is
+    repointed to it once every partition has been written, so readers never
+    see a partial snapshot or none at all.
+
+    Parameters:
+            out_dir (str): directory the snapshot is written to
+            bucket_size (int): number of bank account ids per partition
+            row_group_size (int): number of rows per Parquet row group
+
+    Returns:
+            the manifest of the new snapshot as a dictionary
+    """
+    # query.sql ends with "bank_account_id = ", swap the equality for a range
+    query = QUERY_SQL.rstrip().rstrip('=')
+
+    version = str(time.time_ns())
+    version_dir = os.path.join(out_dir, version)
+    os.makedirs(version_dir)
+
+    try:
+        manifest = write_snapshot(version_dir, query, bucket_size,
+                                  row_group_size)
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    current = os.path.join(out_dir, 'CURRENT')
+    with open(current + '.tmp', 'w') as f:
+        f.write(version)
+    os.replace(current + '.tmp', current)
+
+    versions = sorted((entry for entry in os.listdir(out_dir)
+                       if entry.isdigit()), key=int)
+    for old in versions[:versions.index(version)][:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(out_dir, old), ignore_errors=True)
+    return manifest
+
+
+def write_snapshot(version_dir, query, bucket_size, row_group_size):
+    """
+    Write the partitions and manifest of a snapshot version for
+    export_snapshot().
+
+    Returns:
+            the manifest of the version as a dictionary
+    """
+    conn = psycopg2.connect(user=SAVER_USERNAME, password=SAVER_PASSWORD,
+                            host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
+    try:
+        bounds = fetch_dataframe("""
+        SELECT min(bank_account_id) AS lo, max(bank_account_id) AS hi
+        FROM public.plaid_main_transactions
+        """, conn)
+        lo, hi = bounds['lo'].iloc[0], bounds['hi'].iloc[0]
+
+        buckets = []
+        num_rows = 0
+        if lo is not None and not pd.isna(lo):
+            for bucket in range(int(lo) // bucket_size,
+                                int(hi) // bucket_size + 1):
+                start = bucket * bucket_size
+                end = start + bucket_size - 1
+                df = fetch_dataframe(query + f' BETWEEN {start} AND {end}',
+                                     conn)
+                if len(df) == 0:
+                    continue
+
+                df = df[SNAPSHOT_COLUMNS].sort_values(
+                    by=['bank_account_id', 'date', 'id'])
+                df['date'] = pd.to_datetime(df['date'])
+                table = pa.Table.from_pandas(df, preserve_index=False)
+
+                os.makedirs(bucket_path(version_dir, bucket))
+                pq.write_table(table,
+                               os.path.join(bucket_path(version_dir, bucket),
+                                            'part-0.parquet'),
+                               row_group_size=row_group_size)
+                buckets.append(bucket)
+                num_rows += len(df)
+    finally:
+        conn.close()
+
+    manifest = {
+        'created_at': dt.datetime.utcnow().isoformat(),
+        'bucket_size': bucket_size,
+        'buckets': buckets,
+        'num_rows': num_rows,
+        'columns': SNAPSHOT_COLUMNS,
+    }
+    with open(os.path.join(version_dir, '_snapshot.json'), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def read_snapshot(snapshot_dir=SNAPSHOT_DIR, columns=None, filters=None):
+    """
+    Read transactions from a snapshot into a dataframe.
+
+    Files are memory-mapped, and column selection and filters are pushed
+    down to Parquet, so only the matching columns and row groups are read.
+    Intended for batch jobs reading many accounts at once.
+
+    Parameters:
+            snapshot_dir (str): directory written by export_snapshot()
+            columns (list): columns to read. Defaults to every column
+            filters (list): pyarrow filters, for example
+                            [('bank_account_id', 'in', [1, 2])]
+
+    Returns:
+            dataframe of raw snapshot rows
+    """
+    table = pq.read_table(current_snapshot(snapshot_dir), columns=columns, filters=filters,
+                          memory_map=True, partitioning='hive')
+    df = table.to_pandas()
+    # drop the partition key added by the hive partitioning
+    if 'account_bucket' in df.columns and (columns is None or
+                                           'account_bucket' not in columns):
+        df.drop(columns=['account_bucket'], inplace=True)
+    return df
+
+
+def load_snapshot_data(bank_id, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Load a single account's transactions from a snapshot.
+
+    Only the account's partition is opened and the bank_account_id filter
+    is checked against row group statistics, so other accounts are skipped
+    without being decoded.
+
+    Parameters:
+            bank_id (int): bank account id
+            snapshot_dir (str): directory written by export_snapshot()
+
+    Returns:
+            dataframe in the same format as load_user_data()
+    """
+    snapshot_dir = current_snapshot(snapshot_dir)
+    manifest = read_manifest(snapshot_dir)
+    path = bucket_path(snapshot_dir, int(bank_id) // manifest['bucket_size'])
+
+    if not os.path.exists(path):
+        df = pd.DataFrame(columns=SNAPSHOT_COLUMNS)
+    else:
+        df = pq.read_table(path, columns=SNAPSHOT_COLUMNS,
+                           filters=[('bank_account_id', '=', int(bank_id))],
+                           memory_map=True).to_pandas()
+
+    return format_user_data(df)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Snapshot plaid_main_transactions into Parquet files.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    export = subparsers.add_parser('export')
+    export.add_argument('--out', default=SNAPSHOT_DIR)
+    export.add_argument('--bucket-size', type=int, default=BUCKET_SIZE)
+    export.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE)
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        manifest = export_snapshot(args.out, bucket_size=args.bucket_size,
+                                   row_group_size=args.row_group_size)
+        print(f"wrote {manifest['num_rows']} rows in "
+              f"{len(manifest['buckets'])} partitions to {args.out}")
+    else:
+        parser.print_help()
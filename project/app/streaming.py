@@ -0,0 +1,185 @@
+"""
+Chunked loading for very large bank accounts.
+
+Loading every transaction of a large account into one dataframe per request
+takes memory in proportion to the account's history. For accounts with at
+least SAVER_STREAMING_MIN_ROWS transactions, the chart and budget routes
+instead read query.sql through a named (server-side) cursor, a fixed number
+of rows at a time, and fold each chunk into running totals by date and
+category. Only one chunk of raw rows is held at a time.
+
+The totals are returned as a compact dataframe in the same format as
+load_user_data(), with one row per date, category and sign of the amount
+and a transaction_count column, so User builds the same charts and budgets
+from it as from the full history. Positive and negative amounts are summed
+separately so that User.expenses keeps exactly the expense transactions.
+"""
+import os
+import uuid
+
+import pandas as pd
+
+from app.helpers import (QUERY_SQL, connection, format_user_data,
+                         load_user_data)
+
+# accounts with at least this many transactions are loaded in chunks. 0
+# turns chunked loading off
+SAVER_STREAMING_MIN_ROWS = int(os.environ.get("SAVER_STREAMING_MIN_ROWS", 0))
+
+# number of rows fetched from the server-side cursor at a time
+CHUNK_SIZE = int(os.environ.get("SAVER_STREAMING_CHUNK_SIZE", 20000))
+
+# columns the totals are kept by, for the charts and for the merchant
+# budgets built by /future_budget
+CHART_KEYS = ['date', 'grandparent_category_name', 'parent_category_name']
+BUDGET_KEYS = CHART_KEYS + ['merchant_name']
+
+
+def count_transactions(bank_id):
+    """
+    Return the number of transactions of a bank account.
+    """
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+        SELECT count(*)
+        FROM public.plaid_main_transactions
+        WHERE bank_account_id = %s
+        """, (int(bank_id),))
+        return cursor.fetchone()[0]
+
+
+def stream_transaction_chunks(bank_id, chunk_size=CHUNK_SIZE):
+    """
+    Yield a bank account's transactions in chunks of at most chunk_size
+    rows, read through a server-side cursor.
+
+    Parameters:
+            bank_id (int): bank account id
+            chunk_size (int): number of rows per chunk
+
+    Yields:
+            dataframes in the same format as load_user_data()
+    """
+    with connection() as conn:
+        # a named cursor keeps the result set on the server. The statement
+        # can't be prepared, since DECLARE only takes a plain query
+        cursor = conn.cursor(name=f'transactions_{uuid.uuid4().hex}')
+        cursor.itersize = chunk_size
+        cursor.execute(QUERY_SQL + ' %s', (int(bank_id),))
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            columns = [column.name for column in cursor.description]
+            yield format_user_data(pd.DataFrame.from_records(rows,
+                                                             columns=columns))
+        cursor.close()
+
+
+class TransactionTotals():
+    """
+    Class used to fold chunks of transactions into running totals.
+
+    Attributes:
+        keys (list): columns the totals are kept by
+        totals (dataframe): cents and number of transactions for each key
+            and sign of the amount
+    """
+
+    def __init__(self, keys=CHART_KEYS):
+        """
+        Constructor for the TransactionTotals class.
+
+        Parameters:
+            keys (list): columns the totals are kept by
+        """
+        self.keys = list(keys)
+        self.totals = None
+
+    def add(self, chunk):
+        """
+        Add a chunk of transactions in the load_user_data() format.
+        """
+        if len(chunk) == 0:
+            return
+
+        # sum whole cents so that the order of the chunks doesn't matter
+        chunk = chunk[self.keys].assign(
+            positive=chunk['amount_dollars'] > 0,
+            amount_cents=(chunk['amount_dollars'] * 100).round()
+            .astype('int64'),
+            transaction_count=1)
+        grouped = self.group(chunk)
+
+        if self.totals is None:
+            self.totals = grouped
+        else:
+            self.totals = self.group(pd.concat([self.totals, grouped]))
+
+    def group(self, df):
+        """
+        Sum the cents and transaction counts of rows with the same key.
+        """
+        # missing merchants are kept as their own key
+        return df.groupby(self.keys + ['positive'], sort=False,
+                          dropna=False)[['amount_cents',
+                                         'transaction_count']].sum() \
+            .reset_index()
+
+    def to_frame(self):
+        """
+        Return the totals as a dataframe in the load_user_data() format,
+        with a transaction_count column, sorted by date.
+        """
+        if self.totals is None:
+            columns = self.keys + ['category_name', 'amount_dollars',
+                                   'transaction_count']
+            return pd.DataFrame(columns=columns)
+
+        df = self.totals.sort_values(by=self.keys + ['positive']) \
+            .reset_index(drop=True)
+        df['category_name'] = df['parent_category_name']
+        df['amount_dollars'] = df['amount_cents'] / 100
+        return df.drop(columns=['positive', 'amount_cents'])
+
+
+def load_user_totals(bank_id, keys=CHART_KEYS, chunk_size=CHUNK_SIZE):
+    """
+    Load a bank account's transactions in chunks and return their totals.
+
+    Parameters:
+            bank_id (int): bank account id
+            keys (list): columns the totals are kept by
+            chunk_size (int): number of rows per chunk
+
+    Returns:
+            dataframe of TransactionTotals.to_frame()
+    """
+    totals = TransactionTotals(keys)
+    for chunk in stream_transaction_chunks(bank_id, chunk_size):
+        totals.add(chunk)
+    return totals.to_frame()
+
+
+def load_chart_data(bank_id):
+    """
+    Load the transactions used by the spending and money flow charts,
+    folded into totals when the account is large.
+    """
+    if SAVER_STREAMING_MIN_ROWS and \
+            count_transactions(bank_id) >= SAVER_STREAMING_MIN_ROWS:
+        return load_user_totals(bank_id, CHART_KEYS)
+    return load_user_data(bank_id)
+
+
+def load_budget_data(bank_id):
+    """
+    Load the transactions used by the budget forecast, folded into totals
+    by merchant when the account is large.
+    """
+    if SAVER_STREAMING_MIN_ROWS and \
+            count_transactions(bank_id) >= SAVER_STREAMING_MIN_ROWS:
+        return load_user_totals(bank_id, BUDGET_KEYS)
+    return load_user_data(bank_id)
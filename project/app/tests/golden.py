@@ -0,0 +1,463 @@
+"""
+Golden-output harness for the User analytics in app/user.py.
+
+Runs every User method and the module functions they are built from over a
+fixed corpus of transaction frames, and compares the outputs numerically
+with the outputs recorded in app/tests/golden/. A rewrite of
+monthly_spending_totals(), predict_budget(), budget_modifier(), trimmer()
+or the chart builders is equivalent when every case still matches.
+
+The corpus is made of synthetic frames covering edge cases (January
+rollovers, months without spending, fewer than 10 transactions, a single
+category, folded totals) and anonymized frames captured from a database in
+app/tests/golden/frames/.
+
+Usage (from the project directory):
+
+    python -m app.tests.golden check
+    python -m app.tests.golden check --engine app.user_fast
+    python -m app.tests.golden record
+    python -m app.tests.golden capture 49 account_49
+
+An engine is a module with the same User class and functions as app.user.
+Record again only when a change of output is intended.
+"""
+import argparse
+import base64
+import contextlib
+import importlib
+import io
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), 'golden')
+FRAMES_DIR = os.path.join(GOLDEN_DIR, 'frames')
+
+# tolerances of the numeric comparison
+RTOL = 1e-6
+ATOL = 1e-6
+
+# category, parent category and typical amount of the synthetic expenses
+CATEGORIES = [
+    ('Food and Drink', 'Restaurants', 25),
+    ('Food and Drink', 'Groceries', 60),
+    ('Shops', 'Clothing', 45),
+    ('Shops', 'Digital Purchase', 15),
+    ('Travel', 'Gas Stations', 35),
+    ('Recreation', 'Gyms and Fitness Centers', 30),
+    ('Service', 'Telecommunication Services', 80),
+    ('Healthcare', 'Pharmacies', 20),
+]
+
+MERCHANTS = ['Starbucks', 'Target', 'Shell', 'Amazon', 'Walgreens',
+             'Planet Fitness', 'Verizon', 'Kroger', None]
+
+GOALS = [0, 25, 100, 10 ** 6]
+
+# savings goals as shares of the predicted budget's total, large enough for
+# budget_modifier() to take from more than half of the categories
+GOAL_SHARES = [0.5, 0.9]
+
+BUDGET_SETTINGS = [
+    {'cat_column': 'grandparent_category_name'},
+    {'cat_column': 'parent_category_name'},
+    {'cat_column': 'merchant_name', 'top_k': 5, 'top_share': 0.9},
+]
+
+CHART_PERIODS = ['week', 'month', 'all']
+
+
+def synthetic_frame(start, end, num_rows, seed, categories=CATEGORIES,
+                    income=True):
+    """
+    Random transactions between two dates in the load_user_data() format,
+    with paychecks and transfers mixed in when income is set.
+    """
+    rng = np.random.default_rng(seed)
+    days = (pd.Timestamp(end) - pd.Timestamp(start)).days + 1
+    picks = rng.integers(len(categories), size=num_rows)
+    df = pd.DataFrame({
+        'category_id': '0',
+        'date': pd.Timestamp(start) +
+        pd.to_timedelta(rng.integers(0, days, size=num_rows), unit='D'),
+        'grandparent_category_name': [categories[i][0] for i in picks],
+        'parent_category_name': [categories[i][1] for i in picks],
+        'merchant_name': rng.choice(np.array(MERCHANTS, dtype=object),
+                                    size=num_rows),
+        'amount_dollars': np.round(
+            [rng.gamma(2, categories[i][2] / 2) + 0.01 for i in picks], 2),
+    })
+
+    if income:
+        paydays = pd.date_range(start, end, freq='SMS')
+        extra = pd.DataFrame({
+            'category_id': '0',
+            'date': list(paydays) * 2,
+            'grandparent_category_name': ['Payroll'] * len(paydays) +
+            ['Transfers'] * len(paydays),
+            'parent_category_name': ['Payroll'] * len(paydays) +
+            ['Transfer'] * len(paydays),
+            'merchant_name': None,
+            'amount_dollars': list(-np.round(
+                rng.normal(900, 50, size=len(paydays)), 2)) +
+            list(np.round(rng.normal(150, 20, size=len(paydays)), 2)),
+        })
+        df = pd.concat([df, extra], ignore_index=True)
+
+    df['category_name'] = df['parent_category_name']
+    return df.sort_values(by=['date'], kind='stable').reset_index(drop=True)
+
+
+def empty_months_frame():
+    """Transactions with whole months, including a December, left out."""
+    df = synthetic_frame('2019-03-01', '2020-09-14', 1500, seed=3)
+    months = df['date'].dt.to_period('M').astype(str)
+    return df[~months.isin(['2019-12', '2020-03', '2020-04'])] \
+        .reset_index(drop=True)
+
+
+def folded_frame():
+    """Transactions folded into daily totals by app/streaming.py."""
+    from app.streaming import TransactionTotals, BUDGET_KEYS
+    totals = TransactionTotals(BUDGET_KEYS)
+    totals.add(synthetic_frame('2019-03-01', '2020-09-14', 1500, seed=4))
+    return totals.to_frame()
+
+
+def synthetic_cases():
+    """
+    Returns a dictionary of the synthetic frames by case name.
+    """
+    return {
+        'typical': synthetic_frame('2019-03-01', '2020-09-14', 1500, seed=0),
+        # the latest month is January, so the 12 months before it start in
+        # the previous year
+        'january_rollover': synthetic_frame('2019-06-01', '2021-01-06', 900,
+                                            seed=1),
+        'empty_months': empty_months_frame(),
+        'few_transactions': synthetic_frame('2020-07-03', '2020-08-20', 8,
+                                            seed=2, income=False),
+        'single_category': synthetic_frame('2019-10-01', '2020-09-30', 300,
+                                           seed=5, categories=CATEGORIES[:1],
+                                           income=False),
+        'short_history': synthetic_frame('2020-06-10', '2020-09-12', 200,
+                                         seed=6),
+        'folded': folded_frame(),
+    }
+
+
+def load_frame(path):
+    """
+    Read a frame saved by capture().
+    """
+    df = pd.read_csv(path, parse_dates=['date'], dtype={'category_id': str})
+    df['merchant_name'] = df['merchant_name'].astype(object) \
+        .where(df['merchant_name'].notna(), None)
+    return df
+
+
+def corpus():
+    """
+    Returns a dictionary of every frame of the corpus by case name.
+    """
+    cases = synthetic_cases()
+    if os.path.isdir(FRAMES_DIR):
+        for entry in sorted(os.listdir(FRAMES_DIR)):
+            if entry.endswith('.csv'):
+                cases[entry[:-len('.csv')]] = load_frame(
+                    os.path.join(FRAMES_DIR, entry))
+    return cases
+
+
+def anonymize(df, seed=0):
+    """
+    Anonymize a frame returned by load_user_data(): merchants are renamed
+    'Merchant 1', 'Merchant 2', ... in order of appearance, dates move back
+    a whole number of years (keeping months and weekdays' month layout) and
+    amounts are scaled by a random factor between 0.8 and 1.2 per row.
+    """
+    rng = np.random.default_rng(seed)
+    df = df[['category_id', 'date', 'grandparent_category_name',
+             'parent_category_name', 'merchant_name', 'amount_dollars',
+             'category_name']].sort_values(by=['date'], kind='stable')
+
+    names = {}
+    for name in df['merchant_name'].dropna():
+        names.setdefault(name, f'Merchant {len(names) + 1}')
+    df['merchant_name'] = df['merchant_name'].map(names)
+
+    df['date'] = df['date'] - pd.DateOffset(years=int(rng.integers(1, 6)))
+    df['amount_dollars'] = np.round(
+        df['amount_dollars'] * rng.uniform(0.8, 1.2, size=len(df)), 2)
+    return df.reset_index(drop=True)
+
+
+def capture(bank_id, name, seed=0):
+    """
+    Load a bank account's transactions, anonymize them and save them to the
+    corpus as frames/<name>.csv.
+    """
+    from app.helpers import load_user_data
+    os.makedirs(FRAMES_DIR, exist_ok=True)
+    path = os.path.join(FRAMES_DIR, f'{name}.csv')
+    anonymize(load_user_data(bank_id), seed).to_csv(path, index=False)
+    return path
+
+
+def normalize(value):
+    """
+    Convert an output to plain JSON values: frames and series to their
+    index, columns and values, numpy numbers to Python numbers (floats to
+    10 significant digits), NaN to None and plotly figures' binary arrays to
+    lists.
+    """
+    if isinstance(value, pd.DataFrame):
+        return {'index': [str(i) for i in value.index],
+                'columns': [str(c) for c in value.columns],
+                'values': normalize(value.values.tolist())}
+    if isinstance(value, pd.Series):
+        return {'index': [str(i) for i in value.index],
+                'values': normalize(value.tolist())}
+    if isinstance(value, np.ndarray):
+        return normalize(value.tolist())
+    if isinstance(value, dict):
+        if set(value) >= {'dtype', 'bdata'}:
+            return normalize(np.frombuffer(base64.b64decode(value['bdata']),
+                                           dtype=value['dtype']))
+        return {str(k): normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        # 10 significant digits, well within the comparison's tolerance
+        return None if math.isnan(value) else float(f'{value:.10g}')
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return str(pd.Timestamp(value))
+    return value
+
+
+def chart(fig_json):
+    """
+    Normalize a jsonified plotly figure, leaving out the static layout
+    template.
+    """
+    fig = json.loads(fig_json)
+    fig.get('layout', {}).pop('template', None)
+    return normalize(fig)
+
+
+def attempt(func, *args, **kwargs):
+    """
+    Call func, returning the normalized output or the name of the error it
+    raised, with anything it prints silenced.
+    """
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return normalize(func(*args, **kwargs))
+    except Exception as e:
+        return {'error': type(e).__name__}
+
+
+def run_case(df, engine):
+    """
+    Run the analytics of an engine over one frame.
+
+    Parameters:
+        df (dataframe): transactions in the load_user_data() format
+        engine (module): module providing User and the app.user functions
+
+    Returns:
+        dictionary of normalized outputs by name
+    """
+    outputs = {}
+    expenses = engine.User(df).expenses
+
+    for category in ('grandparent_category_name', 'parent_category_name'):
+        outputs[f'monthly_spending_totals/{category}'] = attempt(
+            engine.monthly_spending_totals, expenses, category=category)
+
+        def pruned():
+            pruned_df, pruned_categories = engine.prune_categories(
+                expenses, category=category, top_k=3)
+            return {'pruned': pruned_categories,
+                    'totals': engine.monthly_spending_totals(
+                        pruned_df, category=category)}
+        outputs[f'prune_categories/{category}'] = attempt(pruned)
+
+    def trimmed():
+        totals = engine.monthly_spending_totals(expenses)
+        return engine.trimmer(totals.mean().to_frame('mean'),
+                              threshold_1=0.05, save=True)
+    outputs['trimmer'] = attempt(trimmed)
+    outputs['dict_trimmer'] = attempt(
+        engine.dict_trimmer, {'Rent': 900, 'Food': 300, 'Gym': 25,
+                              'Books': 8, 'Games': 4}, save=True)
+
+    for settings in BUDGET_SETTINGS:
+        label = settings['cat_column']
+
+        def budget():
+            user = engine.User(df, **settings)
+            return {'budget': user.predict_budget(), 'misc': user.misc,
+                    'warning': user.warning, 'warnings': user.warning_list,
+                    'spending_by_month': user.spending_by_month}
+        outputs[f'predict_budget/{label}'] = attempt(budget)
+
+        for goal in GOALS:
+            def modified():
+                user = engine.User(df, **settings)
+                predicted = user.predict_budget()
+                if predicted is None:
+                    return None
+                return {'budget': user.budget_modifier(
+                            predicted, monthly_savings_goal=goal),
+                        'warning': user.warning,
+                        'warnings': user.warning_list}
+            outputs[f'budget_modifier/{label}/{goal}'] = attempt(modified)
+
+        for share in GOAL_SHARES:
+            def modified_share():
+                user = engine.User(df, **settings)
+                predicted = user.predict_budget()
+                if predicted is None:
+                    return None
+                goal = round(share * sum(predicted.values()))
+                return {'budget': user.budget_modifier(
+                            predicted, monthly_savings_goal=goal),
+                        'warning': user.warning,
+                        'warnings': user.warning_list}
+            outputs[f'budget_modifier/{label}/share_{share}'] = attempt(
+                modified_share)
+
+    user = engine.User(df)
+    for time_period in CHART_PERIODS:
+        outputs[f'categorical_spending/{time_period}'] = attempt(
+            lambda: chart(user.categorical_spending(time_period=time_period)))
+        outputs[f'bar_viz/{time_period}'] = attempt(
+            lambda: chart(user.bar_viz(time_period=time_period,
+                                       resolution='auto')))
+        outputs[f'money_flow/{time_period}'] = attempt(
+            lambda: chart(user.money_flow(time_period=time_period)))
+    outputs['money_flow/all/max_points'] = attempt(
+        lambda: chart(user.money_flow(time_period='all', max_points=20)))
+
+    fixed = ['Food and Drink', 'Shops', 'Travel']
+    outputs['current_month_spending'] = attempt(
+        user.current_month_spending, fixed, current=False)
+    outputs['current_month_spending/cutoff'] = attempt(
+        user.current_month_spending, fixed, current=False, date_cutoff=10)
+    return outputs
+
+
+def compare(expected, actual, path='', rtol=RTOL, atol=ATOL):
+    """
+    Compare normalized outputs, numbers within a tolerance.
+
+    Returns:
+        list of the paths where the outputs differ
+    """
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        if set(expected) != set(actual):
+            return [f'{path} keys {sorted(set(expected) ^ set(actual))}']
+        return [diff for key in expected
+                for diff in compare(expected[key], actual[key],
+                                    f'{path}/{key}', rtol, atol)]
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return [f'{path} length {len(expected)} != {len(actual)}']
+        return [diff for i, (e, a) in enumerate(zip(expected, actual))
+                for diff in compare(e, a, f'{path}[{i}]', rtol, atol)]
+    numbers = (int, float)
+    if isinstance(expected, numbers) and isinstance(actual, numbers) and \
+            not isinstance(expected, bool) and not isinstance(actual, bool):
+        if abs(expected - actual) <= atol + rtol * abs(expected):
+            return []
+        return [f'{path} {expected} != {actual}']
+    if expected != actual:
+        return [f'{path} {expected!r} != {actual!r}']
+    return []
+
+
+def golden_path(name):
+    """
+    Returns the file a case's golden outputs are recorded in.
+    """
+    return os.path.join(GOLDEN_DIR, f'{name}.json')
+
+
+def record(engine_name='app.user'):
+    """
+    Record the golden outputs of every case with an engine.
+    """
+    engine = importlib.import_module(engine_name)
+    for name, df in corpus().items():
+        outputs = run_case(df, engine)
+        # one output per line, so that diffs show which outputs changed
+        lines = [f'{json.dumps(key)}: '
+                 f'{json.dumps(outputs[key], separators=(",", ":"))}'
+                 for key in sorted(outputs)]
+        with open(golden_path(name), 'w') as f:
+            f.write('{\n' + ',\n'.join(lines) + '\n}\n')
+
+
+def check(engine_name='app.user', cases=None):
+    """
+    Compare an engine's outputs with the recorded golden outputs.
+
+    Returns:
+        dictionary of the differences by case name, empty when every case
+        matches
+    """
+    engine = importlib.import_module(engine_name)
+    differences = {}
+    for name, df in corpus().items():
+        if cases and name not in cases:
+            continue
+        with open(golden_path(name)) as f:
+            expected = json.load(f)
+        diffs = compare(expected, run_case(df, engine))
+        if diffs:
+            differences[name] = diffs
+    return differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Record or check the golden outputs of app/user.py.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    check_parser = subparsers.add_parser('check')
+    check_parser.add_argument('--engine', default='app.user')
+    check_parser.add_argument('cases', nargs='*')
+
+    record_parser = subparsers.add_parser('record')
+    record_parser.add_argument('--engine', default='app.user')
+
+    capture_parser = subparsers.add_parser('capture')
+    capture_parser.add_argument('bank_id', type=int)
+    capture_parser.add_argument('name')
+    capture_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == 'check':
+        differences = check(args.engine, args.cases)
+        for name, diffs in differences.items():
+            print(f'{name}: {len(diffs)} differences')
+            for diff in diffs[:20]:
+                print(f'  {diff}')
+        print('all cases match' if not differences else
+              f'{len(differences)} cases differ')
+        raise SystemExit(1 if differences else 0)
+    elif args.command == 'record':
+        record(args.engine)
+    elif args.command == 'capture':
+        print(capture(args.bank_id, args.name, args.seed))
+    else:
+        parser.print_help()
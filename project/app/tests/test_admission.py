@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.admission import AdmissionLane
+
+
+def test_full_queue_is_rejected():
+    """Requests beyond the limit and queue get a 503 with Retry-After."""
+    lane = AdmissionLane('test', limit=1, queue_size=1)
+
+    async def hold(seconds):
+        async with lane.admit():
+            await asyncio.sleep(seconds)
+            return 'done'
+
+    async def run():
+        return await asyncio.gather(hold(0.1), hold(0.1), hold(0.1),
+                                    return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert results[:2] == ['done', 'done']
+    assert isinstance(results[2], HTTPException)
+    assert results[2].status_code == 503
+    assert int(results[2].headers['Retry-After']) >= 1
+
+    stats = lane.stats()
+    assert (stats['admitted'], stats['rejected']) == (2, 1)
+    assert (stats['active'], stats['waiting']) == (0, 0)
+    # the second request waited for the first to finish
+    assert stats['wait_ms']['max'] >= 50
+
+
+def test_limit_is_respected():
+    """No more than `limit` requests run at once."""
+    lane = AdmissionLane('test', limit=2, queue_size=10)
+    running = []
+
+    async def hold():
+        async with lane.admit():
+            running.append(lane.active)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(*[hold() for _ in range(8)])
+
+    asyncio.run(run())
+    assert max(running) == 2
+    assert lane.stats()['admitted'] == 8
+    assert lane.stats()['rejected'] == 0
+
+
+def test_slot_is_released_on_error():
+    """A request that raises gives its slot back."""
+    lane = AdmissionLane('test', limit=1, queue_size=0)
+
+    async def fail():
+        async with lane.admit():
+            raise ValueError
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                await fail()
+
+    asyncio.run(run())
+    assert lane.active == 0
+    assert lane.admitted == 2
@@ -0,0 +1,183 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.anomalies import SpendingStats, AnomalyStore, decay_factor
+
+
+def history(n=60, seed=0):
+    """Purchases in two categories with a few spikes, plus a transfer."""
+    rng = np.random.default_rng(seed)
+    categories = np.where(rng.random(n) < 0.6, 'Food', 'Shops')
+    amounts = rng.normal(2500, 300, n).round()
+    amounts[[30, 45, 55]] = 20000
+    rows = pd.DataFrame({
+        'id': np.arange(1, n + 1),
+        'date': pd.date_range('2020-01-01', periods=n),
+        'amount_cents': amounts.astype(int),
+        'grandparent_category_name': categories,
+    })
+    transfer = pd.DataFrame({'id': [n + 1], 'date': [pd.Timestamp('2020-06-01')],
+                             'amount_cents': [900000],
+                             'grandparent_category_name': ['Transfers']})
+    return pd.concat([rows, transfer], ignore_index=True)
+
+
+@pytest.mark.parametrize('decay', [1.0, decay_factor(20)])
+def test_bootstrap_matches_incremental_updates(decay):
+    """The vectorized bootstrap gives the same state as one by one updates."""
+    rows = history()
+    bootstrapped = SpendingStats.bootstrap(1, rows, decay)
+    incremental = SpendingStats(1, decay)
+    for i in range(len(rows)):
+        incremental.apply(rows.iloc[i:i + 1])
+
+    assert incremental.categories == bootstrapped.categories
+    np.testing.assert_array_equal(incremental.counts, bootstrapped.counts)
+    for name in ('weights', 'means', 'm2s'):
+        np.testing.assert_allclose(getattr(incremental, name),
+                                   getattr(bootstrapped, name))
+    assert incremental.max_id == bootstrapped.max_id == 61
+    assert [a['transaction_id'] for a in incremental.alerts] == \
+        [a['transaction_id'] for a in bootstrapped.alerts]
+
+
+def test_spikes_are_flagged():
+    """Purchases far above their category's mean are anomalies, transfers
+    and purchases in categories without enough history aren't."""
+    stats = SpendingStats.bootstrap(1, history(), 1.0)
+    assert [a['transaction_id'] for a in stats.alerts] == [31, 46, 56]
+    latest = stats.alerts[-1]
+    assert latest['amount_dollars'] == 200.0
+    assert latest['message'].startswith(
+        f"This {latest['category']} purchase of $200.00 is ")
+    assert latest['message'].endswith(
+        f"above your usual ${latest['usual_dollars']:.2f}")
+
+    young = SpendingStats(1, 1.0)
+    for amount in [25.0, 24.0, 26.0, 25.0, 24.0, 26.0, 25.0, 24.0, 26.0]:
+        young.update('Food', amount)
+    assert young.update('Food', 200.0) is None
+    assert young.update('Food', 400.0) is not None
+
+
+def test_applied_transactions_are_ignored():
+    """Rows already applied, or older than the latest applied, are skipped."""
+    rows = history()
+    stats = SpendingStats.bootstrap(1, rows.iloc[:50], 1.0)
+    counts = stats.counts.sum()
+    assert stats.apply(rows.iloc[40:50]) == []
+    assert stats.counts.sum() == counts
+
+    new = stats.apply(pd.concat([rows.iloc[50:], rows.iloc[50:]]))
+    assert [a['transaction_id'] for a in new] == [56]
+    assert stats.counts.sum() == counts + 10
+
+
+def test_saved_statistics_round_trip(tmp_path):
+    """Statistics saved to the state directory load back unchanged."""
+    stats = SpendingStats.bootstrap(7, history(), decay_factor(20))
+    store = AnomalyStore(str(tmp_path), decay_factor(20))
+    store.save(stats)
+    assert [p.name for p in tmp_path.iterdir()] == ['7.json']
+
+    loaded = store.load(7)
+    assert loaded.to_dict() == stats.to_dict()
+    assert loaded.update('Food', 25.0) == stats.update('Food', 25.0)
+
+    # statistics built with another decay are rebuilt
+    assert AnomalyStore(str(tmp_path), 1.0).load(7) is None
+    assert AnomalyStore('', 1.0).load(7) is None
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """The transactions table, shared by the stores of several workers."""
+    db = {'rows': history().iloc[:50]}
+
+    def load_transaction_rows(bank_id, after_id=None):
+        rows = db['rows']
+        return rows if after_id is None else rows[rows['id'] > after_id]
+
+    monkeypatch.setattr('app.anomalies.load_transaction_rows',
+                        load_transaction_rows)
+    monkeypatch.setattr('app.anomalies.bank_account_exists', lambda _: True)
+    return db
+
+
+def test_workers_catch_up_before_serving(tmp_path, database):
+    """Transactions ingested by one worker are served by the others, and
+    a worker sent later ids doesn't skip the ones it wasn't sent."""
+    first = AnomalyStore(str(tmp_path), 1.0)
+    second = AnomalyStore(str(tmp_path), 1.0)
+    assert first.get(7).max_id == second.get(7).max_id == 50
+
+    database['rows'] = history()
+    assert [a['transaction_id'] for a in first.ingest(7, [61])] == [56]
+    assert first.get(7).max_id == 61
+    assert [a['transaction_id'] for a in second.alerts(7)] == [56, 46, 31]
+
+    expected = SpendingStats.bootstrap(7, history(), 1.0)
+    assert second.get(7).counts.sum() == expected.counts.sum()
+
+
+def test_older_statistics_are_not_saved(tmp_path, database):
+    """A worker behind the saved statistics doesn't replace them."""
+    store = AnomalyStore(str(tmp_path), 1.0)
+    behind = store.get(7)
+    store.save(SpendingStats.bootstrap(7, history(), 1.0))
+    store.save(behind)
+    assert store.load(7).max_id == 61
+
+    store.save(SpendingStats.bootstrap(7, history(), 1.0))
+    assert store.load(7).to_dict() == \
+        SpendingStats.bootstrap(7, history(), 1.0).to_dict()
+
+
+def test_invalidated_statistics_are_checked(monkeypatch, database):
+    """Within the max age the cached statistics are served, unless the
+    account was bumped."""
+    monkeypatch.setattr('app.anomalies.ANOMALY_MAX_AGE', 3600)
+    store = AnomalyStore('', 1.0)
+    assert store.get(7).max_id == 50
+
+    database['rows'] = history()
+    assert store.get(7).max_id == 50
+    store.invalidate(8)
+    assert store.get(7).max_id == 50
+    store.invalidate(7)
+    assert store.get(7).max_id == 61
+
+    database['rows'] = pd.concat([history(), history().iloc[:1].assign(id=62)])
+    store.invalidate(None)
+    assert store.get(7).max_id == 62
+
+
+def test_concurrent_first_requests_share_one_seed(monkeypatch, database):
+    """Requests for an account being seeded wait for that seed instead of
+    seeding it again."""
+    bootstraps = []
+
+    def slow_bank_account_exists(bank_id):
+        bootstraps.append(bank_id)
+        time.sleep(0.1)
+        return True
+
+    monkeypatch.setattr('app.anomalies.bank_account_exists',
+                        slow_bank_account_exists)
+    store = AnomalyStore('', 1.0)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        store.alerts(7))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert bootstraps == [7]
+    assert len(results) == 4
+    assert all(alerts == results[0] for alerts in results)
+    assert store.seeding == {}
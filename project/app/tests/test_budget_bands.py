@@ -0,0 +1,55 @@
+import numpy as np
+
+from app.api.predict import bands_response
+from app.tests.golden import synthetic_frame
+from app.user import User, exp_smoothing_level
+
+
+def predicted_user(seed=0, **settings):
+    df = synthetic_frame('2019-03-01', '2020-09-14', 1500, seed=seed)
+    user = User(df, **settings)
+    return user, user.predict_budget()
+
+
+def test_bands_are_seeded_and_ordered():
+    """The same history gives the same bands, with p10 <= p50 <= p90."""
+    user, budget = predicted_user()
+    bands = user.budget_bands(budget)
+    assert bands == user.budget_bands(budget)
+
+    assert list(bands['categories']) == list(budget)
+    for band in list(bands['categories'].values()) + [bands['total']]:
+        assert 0 <= band['p10'] <= band['p50'] <= band['p90']
+
+
+def test_bands_bootstrap_smoothing_errors():
+    """Simulations are the forecast plus past one month ahead errors."""
+    user, budget = predicted_user(cat_column='parent_category_name')
+    spending = user.budget_spending_by_month()
+    bands = user.budget_bands(budget, quantiles=(0, 100))
+
+    for category in budget:
+        values = spending[category].values
+        level = exp_smoothing_level(values)
+        errors = [values[t] - exp_smoothing_level(values[:t])
+                  for t in range(1, len(values))]
+        band = bands['categories'][category]
+        assert np.isclose(band['p0'], max(level + min(errors), 0), atol=0.01)
+        assert np.isclose(band['p100'], max(level + max(errors), 0),
+                          atol=0.01)
+        # the forecast is the budget, before rounding
+        assert abs(level - budget[category]) <= 0.5 + 1e-9 or \
+            category == 'Misc.'
+
+
+def test_bands_response():
+    """Bands are returned with the budget, and without on fatal warnings."""
+    user, budget = predicted_user()
+    response = bands_response(user, budget, 50)
+    assert set(response['budget']) == set(response['bands']['categories'])
+
+    df = synthetic_frame('2020-07-03', '2020-08-20', 8, seed=2, income=False)
+    user = User(df)
+    response = bands_response(user, user.predict_budget(), 50)
+    assert response['budget'] is None and response['bands'] is None
+    assert response['warning'] == 2
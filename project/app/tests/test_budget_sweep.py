@@ -0,0 +1,52 @@
+import pytest
+
+from app.api.predict import BudgetSweep, sweep_response
+from app.tests.golden import synthetic_frame, BUDGET_SETTINGS
+from app.user import User
+
+GOALS = list(range(0, 4000, 150)) + [10 ** 6]
+
+
+@pytest.mark.parametrize('settings', BUDGET_SETTINGS)
+def test_sweep_matches_budget_modifier(settings):
+    """Every goal gets the budget and warnings of budget_modifier()."""
+    df = synthetic_frame('2019-03-01', '2020-09-14', 1500, seed=0)
+    user = User(df, **settings)
+    predicted = user.predict_budget()
+    swept = user.budget_sweep(predicted, GOALS)
+
+    assert len(swept) == len(GOALS)
+    for goal, (budget, warning, warnings) in zip(GOALS, swept):
+        single = User(df, **settings)
+        expected = single.budget_modifier(single.predict_budget(),
+                                          monthly_savings_goal=goal)
+        assert budget == expected
+        assert warning == single.warning
+        assert warnings == single.warning_list
+
+    # the predicted budget and the user's warnings are left unchanged
+    assert predicted == User(df, **settings).predict_budget()
+    assert user.warning_list == []
+
+
+def test_sweep_response_on_fatal_forecast_warnings():
+    """Without enough history every goal gets no budget."""
+    df = synthetic_frame('2020-07-03', '2020-08-20', 8, seed=2, income=False)
+    user = User(df)
+    response = sweep_response(user, user.predict_budget(), [10, 20])
+    assert [r['monthly_savings_goal'] for r in response] == [10, 20]
+    assert all(r['budget'] is None and r['warning'] == 2 and r['warnings']
+               for r in response)
+
+
+def test_goal_range():
+    """A range of goals includes its maximum; too many goals are refused."""
+    sweep = BudgetSweep.construct(monthly_savings_goals=None, min_goal=0,
+                                  max_goal=100, step=25)
+    assert sweep.goals() == [0, 25, 50, 75, 100]
+    with pytest.raises(AssertionError):
+        BudgetSweep.goals_must_be_valid(
+            1, {'monthly_savings_goals': None, 'min_goal': 0,
+                'max_goal': 10 ** 6})
+    with pytest.raises(AssertionError):
+        BudgetSweep.goals_must_be_valid(None, {'monthly_savings_goals': []})
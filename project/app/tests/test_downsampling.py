@@ -0,0 +1,65 @@
+import contextlib
+import io
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.tests.test_streaming import make_transactions
+from app.user import User, lttb, choose_resolution, bucket_dates
+
+
+def test_lttb_keeps_ends_and_spikes():
+    """Downsampling keeps the first and last points and isolated spikes."""
+    x = np.arange(1000)
+    y = np.zeros(1000)
+    y[123] = 50
+    y[777] = -80
+
+    kept = lttb(x, y, 20)
+    assert len(kept) == 20
+    assert kept[0] == 0 and kept[-1] == 999
+    assert 123 in kept and 777 in kept
+    assert np.all(np.diff(kept) > 0)
+
+
+def test_lttb_short_series_is_unchanged():
+    """Series already under the target are returned whole."""
+    assert list(lttb(np.arange(5), np.arange(5), 10)) == [0, 1, 2, 3, 4]
+
+
+def test_resolution_follows_span():
+    """Longer spans get coarser bars."""
+    days = pd.Series(pd.date_range('2020-01-01', periods=60))
+    weeks = pd.Series(pd.date_range('2020-01-01', periods=365))
+    months = pd.Series(pd.date_range('2018-01-01', periods=1000))
+    assert choose_resolution(days) == 'day'
+    assert choose_resolution(weeks) == 'week'
+    assert choose_resolution(months) == 'month'
+
+
+def test_bucket_dates():
+    """Dates are moved to the start of their week or month."""
+    dates = pd.Series(pd.to_datetime(['2020-09-16', '2020-09-20']))
+    assert list(bucket_dates(dates, 'week')) == \
+        list(pd.to_datetime(['2020-09-14', '2020-09-14']))
+    assert list(bucket_dates(dates, 'month')) == \
+        list(pd.to_datetime(['2020-09-01', '2020-09-01']))
+
+
+@pytest.mark.parametrize('time_period,resolution,font_size', [
+    ('week', 'day', 16), ('month', 'day', 10), ('year', 'day', None),
+    ('year', 'week', 10), ('year', 'month', 16), ('all', 'day', None),
+    ('all', 'week', 10), ('all', 'month', 16)])
+def test_bar_labels(time_period, resolution, font_size):
+    """Long time periods only get total labels once bucketed."""
+    user = User(make_transactions(3000))
+    with contextlib.redirect_stdout(io.StringIO()):
+        layout = json.loads(user.bar_viz(time_period,
+                                         resolution=resolution))['layout']
+    labels = layout.get('annotations', [])
+    if font_size is None:
+        assert labels == []
+    else:
+        assert labels and {a['font']['size'] for a in labels} == {font_size}
@@ -0,0 +1,117 @@
+import asyncio
+import csv
+import io
+import json
+from contextlib import AsyncExitStack
+
+import pytest
+
+from app.admission import AdmissionLane
+from app.api.transactions import ExportResponse
+from app.export import EXPORT_COLUMNS, csv_chunks, ndjson_chunks, \
+    export_query, close_after
+
+ROW_CHUNKS = [
+    [(1, '2020-08-01', 12.3, 'Food', 'Restaurants', '13005000', 'Starbucks',
+      'STARBUCKS #123'),
+     (2, '2020-08-01', -900.0, 'Payroll', 'Payroll', '21009000', None,
+      None)],
+    [(3, '2020-08-02', 5.0, 'Shopping', 'Shops', '19000000', 'Target',
+      'Target, "T-1"')],
+]
+
+
+def test_csv_chunks():
+    """One text chunk per row chunk, the header first, amounts in dollars
+    with two decimals."""
+    chunks = list(csv_chunks(iter(ROW_CHUNKS)))
+    assert len(chunks) == 2
+    rows = list(csv.reader(io.StringIO(''.join(chunks))))
+    assert rows[0] == EXPORT_COLUMNS
+    assert rows[1][:3] == ['1', '2020-08-01', '12.30']
+    assert rows[2][2] == '-900.00' and rows[2][6] == ''
+    assert rows[3][7] == 'Target, "T-1"'
+
+    assert list(csv_chunks(iter([]))) == [','.join(EXPORT_COLUMNS) + '\r\n']
+
+
+def test_ndjson_chunks():
+    """One JSON object per line."""
+    chunks = list(ndjson_chunks(iter(ROW_CHUNKS)))
+    assert len(chunks) == 2
+    rows = [json.loads(line) for line in ''.join(chunks).splitlines()]
+    assert [row['transaction_id'] for row in rows] == [1, 2, 3]
+    assert rows[1]['merchant_name'] is None
+    assert rows[0]['amount_dollars'] == 12.3
+
+
+def test_export_query_filters():
+    """Date filters are only added when given."""
+    assert 'date >=' not in export_query()
+    assert 'date <' not in export_query()
+    assert '%(start)s' in export_query(start_date='2020-01-01')
+    assert export_query(end_date='2020-01-31').endswith(
+        'AND date < %(end)s ORDER BY date, id')
+
+
+def test_close_after_closes_rows():
+    """Stopping an export early closes the row chunks, and with them the
+    connection."""
+    closed = []
+
+    def row_chunks():
+        try:
+            yield from ROW_CHUNKS
+        finally:
+            closed.append(True)
+
+    rows = row_chunks()
+    chunks = close_after(csv_chunks(rows), rows)
+    next(chunks)
+    chunks.close()
+    assert closed == [True]
+
+
+@pytest.mark.parametrize('disconnect', [False, True])
+def test_export_response_releases_on_disconnect(disconnect):
+    """The chunks are closed and the lane slot freed when the response ends,
+    whether the download finished or the client went away."""
+    closed = []
+
+    def chunks():
+        try:
+            i = 0
+            # endless when the client disconnects
+            while disconnect or i < 5:
+                yield f'chunk {i}\n'
+                i += 1
+        finally:
+            closed.append(True)
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+        await asyncio.sleep(0)
+
+    async def receive():
+        # the client goes away once the download has started
+        while not disconnect or len(sent) < 3:
+            await asyncio.sleep(0.01)
+        return {'type': 'http.disconnect'}
+
+    async def run():
+        lane = AdmissionLane('export', limit=1, queue_size=0)
+        exit_stack = AsyncExitStack()
+        await exit_stack.enter_async_context(lane.admit())
+        assert lane.active == 1
+        response = ExportResponse(chunks(), exit_stack,
+                                  media_type='text/csv')
+        await asyncio.wait_for(response({'type': 'http'}, receive, send), 10)
+        return lane
+
+    lane = asyncio.run(run())
+    assert closed == [True]
+    assert lane.active == 0
+    if not disconnect:
+        assert b''.join(m.get('body', b'') for m in sent).count(b'chunk') == 5
@@ -0,0 +1,96 @@
+import datetime as dt
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from app.helpers import copy_to_dataframe, inline_params
+
+Column = namedtuple('Column', ['name', 'type_code'])
+
+COLUMNS = [Column('id', 20), Column('amount', 701), Column('merchant', 25),
+           Column('day', 1082), Column('created', 1114),
+           Column('updated', 1184), Column('pending', 16),
+           Column('flagged', 16)]
+
+# COPY ... TO STDOUT WITH CSV HEADER NULL '\N' output
+CSV = (b'id,amount,merchant,day,created,updated,pending,flagged\n'
+       b'1,12.5,007,2021-03-04,2021-03-04 10:00:00,'
+       b'2021-03-04 10:00:00+00,t,t\n'
+       b'2,\\N,\\N,2021-03-05,2021-03-05 11:30:00,'
+       b'2021-03-05 11:30:00+00,f,\\N\n')
+
+
+class FakeCursor():
+    """Cursor answering the zero-row query and the COPY of COLUMNS."""
+
+    def __init__(self, executed):
+        self.executed = executed
+        self.description = None
+
+    def execute(self, query):
+        self.executed.append(query)
+        self.description = COLUMNS
+
+    def copy_expert(self, query, buffer):
+        self.executed.append(query)
+        buffer.write(CSV)
+
+    def mogrify(self, query, values):
+        # quote like psycopg2, without a connection
+        return (query % {key: repr(value)
+                         for key, value in values.items()}).encode()
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+
+    def __init__(self):
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self.executed)
+
+
+def test_copy_to_dataframe_matches_column_types():
+    """CSV columns get the dtypes read_sql would give their Postgres types,
+    and only \\N is read as NULL."""
+    conn = FakeConnection()
+    df = copy_to_dataframe('SELECT * FROM t', conn)
+
+    assert conn.executed == [
+        'SELECT * FROM (SELECT * FROM t) AS q LIMIT 0',
+        "COPY (SELECT * FROM t) TO STDOUT WITH CSV HEADER NULL '\\N'"]
+    assert list(df.columns) == [column.name for column in COLUMNS]
+    assert df['id'].dtype == np.int64
+    assert df['amount'].dtype == np.float64
+    assert np.isnan(df['amount'][1])
+
+    # text looking like a number stays a string, NULL text is None
+    assert df['merchant'].tolist() == ['007', None]
+
+    assert df['day'].tolist() == [dt.date(2021, 3, 4), dt.date(2021, 3, 5)]
+    assert df['created'].dtype == 'datetime64[ns]'
+    assert df['created'][1] == pd.Timestamp('2021-03-05 11:30:00')
+    assert str(df['updated'].dt.tz) == 'UTC'
+
+    assert df['pending'].dtype == bool
+    assert df['pending'].tolist() == [True, False]
+    # booleans with NULLs are objects, as read_sql returns them
+    assert df['flagged'].dtype == object
+    assert df['flagged'][0] is True
+    assert pd.isna(df['flagged'][1])
+
+
+def test_inline_params_quotes_values_and_keeps_percent_signs():
+    """$n parameters are replaced by their quoted values, $1 and $10 are
+    told apart, and literal % signs survive the quoting."""
+    statement = ("SELECT * FROM t WHERE name LIKE 'a%' AND id = $1 "
+                 "AND day >= $2 AND n = $10")
+    params = [7, '2021-03-01'] + [0] * 7 + [42]
+
+    assert inline_params(FakeConnection(), statement, params) == (
+        "SELECT * FROM t WHERE name LIKE 'a%' AND id = 7 "
+        "AND day >= '2021-03-01' AND n = 42")
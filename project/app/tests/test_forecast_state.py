@@ -0,0 +1,151 @@
+import pandas as pd
+import pytest
+
+import app.forecast_state
+from app.forecast_state import (ForecastState, ForecastStateStore,
+                                build_state, advance_state, forecast_budget)
+from app.helpers import format_user_data
+from app.tests.test_streaming import make_transactions
+from app.user import User
+
+SETTINGS = {'cat_column': 'parent_category_name', 'top_k': None,
+            'top_share': None}
+
+PRUNED_SETTINGS = {'cat_column': 'merchant_name', 'top_k': 4,
+                   'top_share': 0.9}
+
+
+def state_before(df, cutoff, settings=SETTINGS):
+    """A state built from the transactions before the cutoff."""
+    old = df[df['date'] < cutoff]
+    user = User(old, **settings)
+    user.predict_budget()
+    return build_state(1, old, user, settings, max_id=0)
+
+
+@pytest.mark.parametrize('settings', [SETTINGS, PRUNED_SETTINGS])
+def test_advance_matches_full_refit(settings):
+    """Closing a month from the state gives the full refit's budget."""
+    df = make_transactions(3000)
+    state = state_before(df, pd.Timestamp('2020-08-10'), settings)
+    assert state.month == pd.Period('2020-07', 'M')
+
+    new = df[df['date'] >= state.next_month_start()]
+    user, budget, new_state = advance_state(state, new)
+    assert new_state.month == pd.Period('2020-08', 'M')
+
+    full_user = User(df, **settings)
+    assert budget == full_user.predict_budget()
+    assert user.num_expenses == full_user.num_expenses
+    assert user.misc == full_user.misc
+    pd.testing.assert_frame_equal(user.spending_by_month,
+                                  full_user.spending_by_month)
+    assert user.budget_modifier(dict(budget), 20) == \
+        full_user.budget_modifier(dict(budget), 20)
+
+
+def test_same_month_keeps_levels():
+    """Without a new closed month the state's forecast is returned as is."""
+    df = make_transactions(3000)
+    state = state_before(df, pd.Timestamp('2020-09-15'))
+
+    new = df[df['date'] >= state.next_month_start()]
+    _, budget, new_state = advance_state(state, new)
+    assert budget == User(df, **SETTINGS).predict_budget()
+    assert new_state.levels == state.levels
+
+
+def test_refit_when_window_moves_two_months():
+    df = make_transactions(3000)
+    state = state_before(df, pd.Timestamp('2020-07-10'))
+
+    new = df[df['date'] >= state.next_month_start()]
+    assert advance_state(state, new) is None
+
+
+def test_store_roundtrip(tmp_path):
+    df = make_transactions(3000)
+    state = state_before(df, pd.Timestamp('2020-08-10'))
+    store = ForecastStateStore(str(tmp_path))
+    store.save(state)
+
+    loaded = store.load(1, SETTINGS)
+    assert isinstance(loaded, ForecastState)
+    assert loaded.to_dict() == state.to_dict()
+    pd.testing.assert_frame_equal(loaded.window, state.window,
+                                  check_freq=False)
+
+    assert store.load(1, dict(SETTINGS, top_k=10)) is None
+    assert store.load(2, SETTINGS) is None
+
+
+class FakeDatabase():
+    """The statements forecast_budget() runs, over a dataframe of raw rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.refits = 0
+
+    def fetch_statement(self, name, params, strategy=None):
+        if name == 'max_transaction_id':
+            return pd.DataFrame({'max_id': [self.rows['id'].max()]})
+        assert name == 'window_checksum'
+        _, end, max_id = params
+        rows = self.rows[self.rows['date'] < end]
+        if max_id is not None:
+            rows = rows[rows['id'] <= max_id]
+        checksum = sum(hash(str(row)) for row in rows[
+            ['id', 'date', 'amount_cents', 'category_id',
+             'merchant_name']].itertuples(index=False))
+        return pd.DataFrame({'count': [len(rows)], 'checksum': [checksum]})
+
+    def load_transaction_rows(self, bank_id, since=None):
+        return self.rows[self.rows['date'] >= since]
+
+    def load_budget_data(self, bank_id):
+        self.refits += 1
+        return format_user_data(self.rows)
+
+
+def raw_rows(df):
+    """Transactions in the query.sql format, with ids."""
+    rows = df.reset_index(drop=True).assign(
+        id=range(1, len(df) + 1),
+        amount_cents=(df['amount_dollars'] * 100).round().astype(int))
+    return rows.drop(columns=['amount_dollars', 'category_name'])
+
+
+def test_changed_window_is_refit(tmp_path, monkeypatch):
+    """Rows added, deleted or amended inside the window since the state was
+    saved are picked up with a full refit, and otherwise the state is
+    advanced."""
+    df = make_transactions(3000)
+    rows = raw_rows(df[df['date'] < pd.Timestamp('2020-08-10')])
+    database = FakeDatabase(rows)
+    for name in ('fetch_statement', 'load_transaction_rows',
+                 'load_budget_data'):
+        monkeypatch.setattr(app.forecast_state, name,
+                            getattr(database, name))
+    store = ForecastStateStore(str(tmp_path))
+
+    def check(rows, refits):
+        database.rows = rows.sort_values('id').reset_index(drop=True)
+        _, budget = forecast_budget(1, store, **SETTINGS)
+        assert database.refits == refits
+        assert budget == User(format_user_data(database.rows),
+                              **SETTINGS).predict_budget()
+
+    check(rows, 1)
+    # a new month closes
+    later = raw_rows(df[df['date'] >= pd.Timestamp('2020-08-10')])
+    later['id'] += len(rows)
+    rows = pd.concat([rows, later])
+    check(rows, 1)
+
+    in_window = rows.index[(rows['date'] < pd.Timestamp('2020-08-01')) &
+                           (rows['amount_cents'] > 0)]
+    check(rows.drop(index=in_window[:5]), 2)
+    check(rows.drop(index=in_window[:5]), 2)
+    amended = rows.drop(index=in_window[:5])
+    amended.loc[in_window[5], 'amount_cents'] += 50000
+    check(amended, 3)
@@ -0,0 +1,28 @@
+import json
+
+import pytest
+
+import app.user
+from app.tests.golden import corpus, run_case, compare, golden_path
+
+CASES = corpus()
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_outputs_match_golden(name):
+    """app/user.py still gives the recorded outputs for every case."""
+    with open(golden_path(name)) as f:
+        expected = json.load(f)
+    assert compare(expected, run_case(CASES[name], app.user)) == []
+
+
+def test_compare_finds_changed_numbers():
+    """Differences beyond the tolerance are reported with their path."""
+    expected = {'budget': {'Food': 100.0, 'Shops': [1, 2.5]}}
+    assert compare(expected, {'budget': {'Food': 100.00000001,
+                                         'Shops': [1, 2.5]}}) == []
+    assert compare(expected, {'budget': {'Food': 100.5,
+                                         'Shops': [1, 2.5]}}) == \
+        ['/budget/Food 100.0 != 100.5']
+    assert compare(expected, {'budget': {'Food': 100.0, 'Shops': [1]}}) == \
+        ['/budget/Shops length 2 != 1']
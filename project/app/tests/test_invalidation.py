@@ -0,0 +1,170 @@
+import asyncio
+import time
+from contextlib import contextmanager
+
+import pytest
+
+import app.invalidation
+import app.singleflight
+from app.invalidation import (AccountVersions, AccountCache, apply_payload,
+                              listen_for_invalidations, poll_table)
+from app.singleflight import SingleFlight, load_account_value
+
+
+def test_bumps_invalidate_cached_values():
+    """Values are returned until their account, or every account, is bumped."""
+    versions = AccountVersions()
+    cache = AccountCache('test', versions, max_entries=10)
+    cache.put(1, 'all', 'one', versions.version(1))
+    cache.put(2, 'all', 'two', versions.version(2))
+    assert cache.get(1, 'all') == 'one'
+
+    versions.bump([1])
+    assert cache.get(1, 'all') is None
+    assert cache.get(2, 'all') == 'two'
+
+    versions.bump_all()
+    assert cache.get(2, 'all') is None
+    assert cache.stats() == {'size': 0, 'max_entries': 10, 'hits': 2,
+                             'misses': 2, 'evictions': 2}
+
+
+def test_values_loaded_before_a_bump_are_stale():
+    """A value put with the version read before a bump is never returned."""
+    versions = AccountVersions()
+    cache = AccountCache('test', versions, max_entries=10)
+    version = versions.version(1)
+    versions.bump([1])
+    cache.put(1, 'all', 'old', version)
+    assert cache.get(1, 'all') is None
+
+
+def test_cache_size_and_ttl():
+    """The least recently used values go first, and values expire."""
+    versions = AccountVersions()
+    cache = AccountCache('test', versions, max_entries=2)
+    for bank_id in (1, 2):
+        cache.put(bank_id, 'all', bank_id, versions.version(bank_id))
+    cache.get(1, 'all')
+    cache.put(3, 'all', 3, versions.version(3))
+    assert cache.get(2, 'all') is None
+    assert cache.get(1, 'all') == 1
+
+    cache = AccountCache('test', versions, max_entries=2, ttl=0.05)
+    cache.put(1, 'all', 1, versions.version(1))
+    time.sleep(0.1)
+    assert cache.get(1, 'all') is None
+
+    cache = AccountCache('test', versions, max_entries=0)
+    cache.put(1, 'all', 1, versions.version(1))
+    assert cache.get(1, 'all') is None
+
+
+def test_apply_payload():
+    """Notification payloads bump an account or every account."""
+    versions = AccountVersions()
+    bumped = []
+    versions.subscribe(bumped.append)
+    apply_payload('{"bank_account_id": 7, "id": 1001}', versions)
+    apply_payload('{"all": true}', versions)
+    assert bumped == [7, None]
+    assert versions.version(7) == (1, 1)
+
+    with pytest.raises(KeyError):
+        apply_payload('{"id": 1001}', versions)
+    with pytest.raises(ValueError):
+        apply_payload('not json', versions)
+
+
+def test_listener_groups_by_account_and_resyncs(monkeypatch):
+    """Notifications for the same account bump it once, and every account
+    is bumped after a reconnect."""
+    def listen_for_notifications(channels, stop_event, timeout,
+                                 on_reconnect):
+        yield ['{"bank_account_id": 7, "id": 1}',
+               '{"bank_account_id": 7, "id": 2}',
+               '{"bank_account_id": 8, "id": 3}', 'not json']
+        # the connection dropped and was reopened
+        on_reconnect()
+        yield ['{"bank_account_id": 7, "id": 4}']
+
+    monkeypatch.setattr(app.invalidation, 'listen_for_notifications',
+                        listen_for_notifications)
+    versions = AccountVersions()
+    bumped = []
+    versions.subscribe(bumped.append)
+    listen_for_invalidations(['new_transactions'], versions)
+    assert bumped == [7, 8, None, 7]
+
+
+class FakeCursor():
+    """Runs poll_table()'s two queries over a list of (id, account) rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, params=None):
+        if params is None:
+            self.result = [(max(row_id for row_id, _ in self.rows),)]
+        else:
+            self.result = [row for row in self.rows if row[0] > params[0]]
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+
+def test_poll_table_sees_late_commits(monkeypatch):
+    """Rows that commit below the watermark are bumped, once."""
+    rows = [(1, 10), (2, 10), (4, 20)]
+
+    @contextmanager
+    def connection():
+        conn = type('FakeConnection', (), {})()
+        conn.cursor = lambda: FakeCursor(rows)
+        yield conn
+
+    monkeypatch.setattr(app.invalidation, 'connection', connection)
+    versions = AccountVersions()
+    bumped = []
+    versions.subscribe(bumped.append)
+
+    watermark = poll_table('plaid_main_transactions', 'bank_account_id',
+                           None, versions, lookback=10)
+    assert bumped == []
+    # id 3 commits after id 4, along with new rows
+    rows.extend([(3, 30), (5, 10), (6, 10)])
+    watermark = poll_table('plaid_main_transactions', 'bank_account_id',
+                           watermark, versions, lookback=10)
+    assert sorted(bumped) == [10, 30]
+    assert watermark[0] == 6
+
+    poll_table('plaid_main_transactions', 'bank_account_id', watermark,
+               versions, lookback=10)
+    assert sorted(bumped) == [10, 30]
+
+
+def test_load_account_value(monkeypatch):
+    """Loads are cached, and a load racing a bump isn't kept as current."""
+    versions = AccountVersions()
+    cache = AccountCache('test', versions, max_entries=10)
+    monkeypatch.setattr(app.singleflight, 'account_versions', versions)
+    monkeypatch.setattr(app.singleflight, 'account_cache', cache)
+    flight = SingleFlight('test')
+    loads = []
+
+    def load(bank_id):
+        loads.append(bank_id)
+        if len(loads) == 1:
+            # new transactions land while the first load runs
+            versions.bump([bank_id])
+        return len(loads)
+
+    async def run():
+        return [await load_account_value(flight, ('all', 1), 1, load, 1)
+                for _ in range(3)]
+
+    assert asyncio.run(run()) == [1, 2, 2]
+    assert loads == [1, 1]
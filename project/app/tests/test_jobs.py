@@ -0,0 +1,149 @@
+import os
+import time
+
+from app.jobs import JobQueue, write_record
+
+
+def slow_square(x):
+    time.sleep(0.5)
+    return x * x
+
+
+def fail(x):
+    raise ValueError(x)
+
+
+def crash(x):
+    os._exit(1)
+
+
+def wait(job):
+    """Wait for a job and its done callback to finish."""
+    job.future.result(timeout=60)
+    time.sleep(0.05)
+
+
+def test_identical_jobs_are_deduplicated(tmp_path):
+    """Submissions with the key of a running job share that job."""
+    queue = JobQueue('test', workers=1, ttl=60, directory=str(tmp_path))
+    try:
+        first = queue.submit(('a', 3), slow_square, 3)
+        second = queue.submit(('a', 3), slow_square, 3)
+        other = queue.submit(('a', 4), slow_square, 4)
+        assert first is second
+        assert other is not first
+
+        wait(first)
+        wait(other)
+        assert queue.get(first.job_id).to_dict() == {
+            'job_id': first.job_id, 'status': 'done', 'result': 9}
+        assert queue.stats()['submitted'] == 2
+        assert queue.stats()['deduplicated'] == 1
+        assert queue.stats()['unfinished'] == 0
+
+        # a finished job is not reused
+        assert queue.submit(('a', 3), slow_square, 3) is not first
+    finally:
+        queue.shutdown()
+
+
+def test_failed_jobs_and_expiry(tmp_path):
+    """Errors are reported and finished jobs are forgotten after the ttl."""
+    queue = JobQueue('test', workers=1, ttl=0.2, directory=str(tmp_path))
+    try:
+        job = queue.submit('bad', fail, 'boom')
+        while not job.future.done():
+            time.sleep(0.05)
+        time.sleep(0.05)
+        response = queue.get(job.job_id).to_dict()
+        assert response['status'] == 'failed'
+        assert 'boom' in response['error']
+
+        time.sleep(0.3)
+        assert queue.get(job.job_id) is None
+    finally:
+        queue.shutdown()
+
+
+def test_jobs_are_shared_between_workers(tmp_path):
+    """A job started by one worker can be polled and joined from another."""
+    first = JobQueue('test', workers=1, ttl=60, directory=str(tmp_path))
+    second = JobQueue('test', workers=1, ttl=60, directory=str(tmp_path))
+    try:
+        job = first.submit(('a', 3), slow_square, 3)
+        shared = second.submit(('a', 3), slow_square, 3)
+        assert shared.job_id == job.job_id
+        assert shared.status() in ('queued', 'running')
+        assert second.stats()['deduplicated'] == 1
+        assert second.executor is None
+
+        wait(job)
+        assert second.get(job.job_id).to_dict() == {
+            'job_id': job.job_id, 'status': 'done', 'result': 9}
+
+        # the claim was released, so the next submission starts a new job
+        again = second.submit(('a', 3), slow_square, 3)
+        assert again.job_id != job.job_id
+        wait(again)
+        assert first.get(again.job_id).to_dict()['result'] == 9
+    finally:
+        first.shutdown()
+        second.shutdown()
+
+
+def test_lost_and_unknown_jobs(tmp_path):
+    """Jobs whose worker died are reported as failed, then forgotten, and
+    ids that can't name a record are unknown."""
+    queue = JobQueue('test', workers=1, ttl=60, directory=str(tmp_path))
+    now = time.time()
+    lost = 'a' * 32
+    write_record(queue.record_path(lost), {
+        'job_id': lost, 'status': 'running', 'submitted': now - 90})
+    response = queue.get(lost).to_dict()
+    assert response['status'] == 'failed'
+    assert 'lost' in response['error']
+
+    write_record(queue.record_path(lost), {
+        'job_id': lost, 'status': 'running', 'submitted': now - 150})
+    assert queue.get(lost) is None
+
+    assert queue.get('b' * 32) is None
+    assert queue.get('../../etc/passwd') is None
+
+
+def test_in_memory_jobs():
+    """Without a directory, jobs are only known to their own queue."""
+    first = JobQueue('test', workers=1, ttl=60, directory='')
+    second = JobQueue('test', workers=1, ttl=60, directory='')
+    try:
+        job = first.submit('a', slow_square, 2)
+        wait(job)
+        assert first.get(job.job_id).to_dict()['result'] == 4
+        assert second.get(job.job_id) is None
+    finally:
+        first.shutdown()
+
+
+def test_broken_pool_is_replaced(tmp_path):
+    """A dead worker process fails its job and the next submission, then a
+    new pool runs the jobs after that."""
+    queue = JobQueue('test', workers=1, ttl=60, directory=str(tmp_path))
+    try:
+        crashed = queue.submit('crash', crash, 1)
+        while not crashed.future.done():
+            time.sleep(0.05)
+        assert queue.get(crashed.job_id).status() == 'failed'
+
+        job = queue.submit('a', slow_square, 3)
+        time.sleep(0.05)
+        response = queue.get(job.job_id).to_dict()
+        assert response['status'] == 'failed'
+        assert 'BrokenProcessPool' in response['error']
+        assert queue.executor is None
+        assert queue.stats()['unfinished'] == 0
+
+        job = queue.submit('a', slow_square, 3)
+        wait(job)
+        assert queue.get(job.job_id).to_dict()['result'] == 9
+    finally:
+        queue.shutdown()
@@ -0,0 +1,33 @@
+import pytest
+
+from loadtest.run import (parse_mix, parse_accounts, summarize,
+                          find_regressions)
+
+
+def test_parse_mix_and_accounts():
+    """Mix weights and account ranges are parsed from the command line."""
+    assert parse_mix('spending=3,moneyflow') == {'spending': 3.0,
+                                                 'moneyflow': 1.0}
+    with pytest.raises(ValueError):
+        parse_mix('spending=1,unknown=2')
+    assert parse_accounts('1-3,7,10-11') == [1, 2, 3, 7, 10, 11]
+
+
+def test_summary_and_regressions():
+    """Latency percentiles are reported per endpoint and compared."""
+    results = [('spending', i / 1000, 200, 10, i) for i in range(1, 101)]
+    results.append(('dashboard', 0.5, 500, 0, 1))
+    summary = summarize(results, duration=10)
+
+    assert summary['spending']['requests'] == 100
+    assert summary['spending']['throughput_rps'] == 10
+    assert summary['spending']['latency_ms']['p50'] == pytest.approx(50.5)
+    assert summary['dashboard']['errors'] == 1
+    assert summary['total']['requests'] == 101
+
+    baseline = {'endpoints': summary}
+    slower = {'endpoints': summarize(
+        [(name, latency * 2, status, size, end)
+         for name, latency, status, size, end in results], duration=10)}
+    assert find_regressions(baseline, baseline) == []
+    assert len(find_regressions(slower, baseline, max_regression=0.5)) == 3
@@ -1,5 +1,9 @@
+import pandas as pd
 from fastapi.testclient import TestClient
 
+import app.helpers as app_helpers
+import app.singleflight as app_singleflight
+from app.helpers import PoolTimeout
 from app.main import app
 
 client = TestClient(app)
@@ -10,3 +14,50 @@ def test_docs():
     response = client.get('/')
     assert response.status_code == 200
     assert response.headers['content-type'].startswith('text/html')
+
+
+def test_unknown_accounts_are_rejected(monkeypatch):
+    """Account checks run in the route, and answer like validation errors."""
+    monkeypatch.setattr(app_helpers, 'bank_account_exists', lambda id: False)
+    response = client.post('/future_budget', json={
+        'bank_account_id': 7, 'monthly_savings_goal': 50})
+    assert response.status_code == 422
+    assert response.json()['detail'][0]['loc'] == ['body', 'bank_account_id']
+
+
+def test_pool_timeouts_are_503s(monkeypatch):
+    """Requests that can't get a database connection in time get a 503."""
+    def bank_account_exists(bank_id):
+        raise PoolTimeout('no database connection was free')
+
+    monkeypatch.setattr(app_helpers, 'bank_account_exists',
+                        bank_account_exists)
+    response = client.post('/spending', json={
+        'bank_account_id': 7, 'graph_type': 'pie', 'time_period': 'week'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_users_without_transactions_are_404s(monkeypatch):
+    """Users whose linked accounts have no transactions get a 404 rather
+    than failing in the chart or budget code."""
+    monkeypatch.setattr(app_helpers, 'load_user_bank_account_ids',
+                        lambda id: [7])
+    monkeypatch.setattr(app_singleflight, 'load_user_accounts_data',
+                        lambda id: pd.DataFrame())
+    for path, body in [
+            ('/user_moneyflow', {'time_period': 'month'}),
+            ('/user_spending', {'graph_type': 'bar', 'time_period': 'month'}),
+            ('/user_future_budget', {'monthly_savings_goal': 50})]:
+        response = client.post(path, json={'user_id': 3, **body})
+        assert response.status_code == 404, path
+        assert response.json()['detail'] == 'User ID, 3, has no transactions'
+
+
+def test_non_finite_peer_amounts_are_rejected():
+    """nan and inf amounts are validation errors rather than 500s."""
+    for amount in ['nan', 'inf', '-inf']:
+        response = client.get('/peer_percentile/Food',
+                              params={'amount': amount})
+        assert response.status_code == 422, amount
+        assert response.json()['detail'] == 'amount must be a finite number'
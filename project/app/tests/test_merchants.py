@@ -0,0 +1,109 @@
+import sys
+import threading
+
+import pandas as pd
+
+from app.merchants import MerchantIndex, normalize_merchant
+from app.reference import ReferenceData, publish
+
+
+def test_normalize_matches_query_sql():
+    """Normalization matches the regexp_replace query.sql used to apply."""
+    assert normalize_merchant('Starbucks #123') == 'Starbucks'
+    assert normalize_merchant("McDonald's F1234") == 'McDonald s F'
+    assert normalize_merchant('  Café  Olé!! 99 ') == 'Café Olé'
+    assert normalize_merchant('x' * 40) == 'x' * 25
+    assert normalize_merchant(None) is None
+
+
+def test_near_duplicates_share_a_merchant():
+    """Spellings of the same merchant map to one merchant, named after the
+    key when it is added in-process."""
+    index = MerchantIndex()
+    raw_names = pd.Series(['Starbucks #123', 'STARBUCKS 456',
+                           'Starbucks #9', 'Amazon.com*AB12',
+                           'AMAZON MKTPLACE PMTS', None])
+    canonical = index.canonicalize(raw_names)
+    assert list(canonical[:5]) == ['Starbucks', 'Starbucks', 'Starbucks',
+                                   'Amazon', 'Amazon']
+    assert pd.isna(canonical[5])
+
+    # unseen names join the merchant they belong to
+    assert list(index.canonicalize(pd.Series(['STARBUCKS STORE 77']))) == \
+        ['Starbucks']
+
+
+def test_new_merchant_names_dont_depend_on_the_batch():
+    """Workers seeing different spellings first name merchants the same."""
+    first, second = MerchantIndex(), MerchantIndex()
+    first.canonicalize(pd.Series(['STARBUCKS 456', 'STARBUCKS 9']))
+    second.canonicalize(pd.Series(['Starbucks #123']))
+    names = pd.Series(['Starbucks #123', 'STARBUCKS 456', 'STARBUCKS 9'])
+    assert list(first.canonicalize(names)) == \
+        list(second.canonicalize(names)) == ['Starbucks'] * 3
+
+
+def test_builds_use_the_most_common_spelling():
+    """Full builds name merchants after their most common spelling, ties
+    going to the alphabetically first one."""
+    index = MerchantIndex()
+    index.add_names(pd.Series({'Starbucks #123': 3, 'STARBUCKS 456': 2,
+                               'Amazon.com*AB12': 1,
+                               'AMAZON MKTPLACE PMTS': 1}), most_common=True)
+    assert index.names == {'Starbucks #123': 'Starbucks',
+                           'STARBUCKS 456': 'Starbucks',
+                           'Amazon.com*AB12': 'AMAZON MKTPLACE PMTS',
+                           'AMAZON MKTPLACE PMTS': 'AMAZON MKTPLACE PMTS'}
+
+
+def test_concurrent_canonicalize_across_refreshes():
+    """Names are never lost to a reset racing another thread's lookups."""
+    class Refreshing():
+        def get(self):
+            return None
+
+        def refresh(self):
+            return True
+
+    index = MerchantIndex(shared=Refreshing())
+    batches = [pd.Series([f'Merchant {chr(97 + i)}{chr(97 + j)} #{k}'
+                          for j in range(26) for k in range(3)])
+               for i in range(8)]
+    results = []
+
+    def run(batch):
+        for _ in range(20):
+            results.append(index.canonicalize(batch).isna().sum())
+
+    threads = [threading.Thread(target=run, args=(batch,))
+               for batch in batches]
+    # switch threads often, so that resets land between lookups
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert len(results) == 160 and sum(results) == 0
+
+
+def test_published_index_matches_dictionaries(tmp_path):
+    """The shared arrays map names like the index they were packed from."""
+    built = MerchantIndex()
+    raw_names = pd.Series(['Starbucks #123', 'STARBUCKS 456', 'Café Olé 3',
+                           'Amazon.com*AB12', 'AMAZON MKTPLACE PMTS'])
+    built.canonicalize(raw_names)
+    publish('merchant_index', built.pack(), str(tmp_path))
+
+    index = MerchantIndex.attach(str(tmp_path / 'missing.json'),
+                                 str(tmp_path))
+    assert index.names == {}
+    names = pd.Series(list(raw_names) + ['STARBUCKS STORE 77', None])
+    assert list(index.canonicalize(names)[:6]) == \
+        list(built.canonicalize(names)[:6])
+    # only the unseen name is kept in the process
+    assert index.names == {
+        'STARBUCKS STORE 77': built.names['Starbucks #123']}
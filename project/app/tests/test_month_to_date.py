@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+import datetime as dt
+
+import pandas as pd
+import psycopg2
+import pytest
+
+import app.helpers
+import app.month_to_date
+from app.helpers import listen_for_notifications
+from app.invalidation import AccountVersions
+from app.month_to_date import MonthToDateSpending, MonthToDateStore, \
+    listen_for_new_transactions
+from app.user import User
+
+
+def make_rows():
+    """Return a small set of query.sql rows spanning two months."""
+    return pd.DataFrame({
+        'id': [1, 2, 3, 4, 5, 6, 7],
+        'date': pd.to_datetime(['2020-08-30', '2020-09-01', '2020-09-02',
+                                '2020-09-02', '2020-09-10', '2020-09-12',
+                                '2020-09-14']),
+        'amount_cents': [1000, 2500, 1999, -50000, 700, 12000, 30],
+        'grandparent_category_name': ['Food', 'Food', 'Shopping', 'Payroll',
+                                      'Transfers', 'Shopping', 'Food'],
+        'parent_category_name': ['Restaurants', 'Restaurants', 'Shops',
+                                 'Payroll', 'Transfer', 'Shops',
+                                 'Restaurants'],
+    })
+
+
+def make_user(rows):
+    """Return a User built from the same rows."""
+    data = rows.copy()
+    data['amount_dollars'] = data['amount_cents'] / 100
+    return User(data)
+
+
+def test_matches_user_current_month_spending():
+    """Running totals match the full recompute, with and without a cutoff."""
+    rows = make_rows()
+    user = make_user(rows)
+    aggregator = MonthToDateSpending(2020, 9)
+    aggregator.apply(rows)
+
+    for fixed, cutoff in [(['Restaurants'], None), (['Rent'], 5),
+                          (['Misc.'], None), ([], 1)]:
+        expected = user.current_month_spending(fixed, current=False,
+                                               date_cutoff=cutoff)
+        assert aggregator.spending(fixed, date_cutoff=cutoff) == expected
+
+
+def test_apply_is_idempotent():
+    """Applying the same transactions twice only counts them once."""
+    rows = make_rows()
+    aggregator = MonthToDateSpending(2020, 9)
+    assert aggregator.apply(rows) == 4
+    assert aggregator.apply(rows.iloc[2:]) == 0
+    assert aggregator.totals == {'Restaurants': 2530, 'Shops': 13999}
+
+
+class FakeDatabase():
+    """query.sql rows of bank account 1, dated in the current month."""
+
+    def __init__(self):
+        today = dt.date.today()
+        self.rows = pd.DataFrame({
+            'id': [1, 2, 3],
+            'date': pd.to_datetime([today.replace(day=1)] * 3),
+            'amount_cents': [1000, 2500, -50000],
+            'grandparent_category_name': ['Food', 'Shopping', 'Payroll'],
+            'parent_category_name': ['Restaurants', 'Shops', 'Payroll'],
+        })
+        self.queries = 0
+
+    def add(self, transaction_id, cents, category='Restaurants'):
+        row = self.rows.iloc[:1].assign(id=transaction_id, amount_cents=cents,
+                                        parent_category_name=category)
+        self.rows = pd.concat([self.rows, row], ignore_index=True)
+
+    def fetch_statement(self, name, params):
+        assert name == 'max_transaction_id'
+        self.queries += 1
+        max_id = self.rows['id'].max() if params[0] == 1 else None
+        return pd.DataFrame({'max_id': [max_id]})
+
+    def load_transaction_rows(self, bank_id, since=None, after_id=None,
+                              transaction_ids=None):
+        self.queries += 1
+        if transaction_ids is not None:
+            return self.rows[self.rows['id'].isin(transaction_ids)]
+        return self.rows[self.rows['id'] > (after_id or 0)]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(app.month_to_date, 'fetch_statement',
+                        database.fetch_statement)
+    monkeypatch.setattr(app.month_to_date, 'load_transaction_rows',
+                        database.load_transaction_rows)
+    return database
+
+
+def test_store_catches_up_with_new_transactions(database):
+    """Every request reads the transactions added since the last one."""
+    store = MonthToDateStore()
+    assert store.spending(2, ['Restaurants']) is None
+    assert store.spending(1, ['Restaurants']) == \
+        {'Restaurants': 10.0, 'Shops': 25.0}
+
+    database.add(4, 500)
+    assert store.spending(1, ['Restaurants']) == \
+        {'Restaurants': 15.0, 'Shops': 25.0}
+    # transactions already read are not counted again
+    store.ingest(1, [4])
+    assert store.spending(1, ['Restaurants']) == \
+        {'Restaurants': 15.0, 'Shops': 25.0}
+
+
+def test_concurrent_first_requests_share_one_seed(database, monkeypatch):
+    """Requests for an account being seeded wait for that seed instead of
+    seeding it again."""
+    fetch_statement = database.fetch_statement
+
+    def slow_fetch_statement(name, params):
+        time.sleep(0.1)
+        return fetch_statement(name, params)
+
+    monkeypatch.setattr(app.month_to_date, 'fetch_statement',
+                        slow_fetch_statement)
+    store = MonthToDateStore()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        store.spending(1, ['Restaurants']))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [{'Restaurants': 10.0, 'Shops': 25.0}] * 4
+    assert database.queries == 2
+    assert store.seeding == {}
+
+
+def test_store_checks_after_max_age_or_bump(database, monkeypatch):
+    """Within the max age only a bump makes the store read new rows, and a
+    bump of every account seeds them again."""
+    monkeypatch.setattr(app.month_to_date, 'MONTH_TO_DATE_MAX_AGE', 3600)
+    store = MonthToDateStore()
+    versions = AccountVersions()
+    versions.subscribe(store.invalidate)
+    assert store.spending(1, ['Restaurants'])['Restaurants'] == 10.0
+
+    database.add(4, 500)
+    queries = database.queries
+    assert store.spending(1, ['Restaurants'])['Restaurants'] == 10.0
+    assert database.queries == queries
+
+    versions.bump([1])
+    assert store.spending(1, ['Restaurants'])['Restaurants'] == 15.0
+
+    # a deleted transaction is only dropped when the account is seeded
+    database.rows = database.rows[database.rows['id'] != 2]
+    versions.bump_all()
+    assert store.spending(1, ['Restaurants']) == {'Restaurants': 15.0}
+
+
+def test_listener_resyncs_stores_after_reconnecting(monkeypatch):
+    """Notifications are grouped by account, and every store is invalidated
+    once listening again after a dropped connection."""
+    calls = []
+
+    class Store():
+        def ingest(self, bank_id, ids):
+            calls.append(('ingest', bank_id, ids))
+
+        def invalidate(self, bank_id):
+            calls.append(('invalidate', bank_id))
+
+    def listen_for_notifications(channels, stop_event, timeout,
+                                 on_reconnect):
+        yield ['{"bank_account_id": 1, "id": 10}', 'not json',
+               '{"bank_account_id": 1, "id": 11}']
+        on_reconnect()
+        yield ['{"bank_account_id": 2, "id": 12}']
+
+    monkeypatch.setattr(app.month_to_date, 'listen_for_notifications',
+                        listen_for_notifications)
+    listen_for_new_transactions('new_transactions', [Store()])
+    assert calls == [('ingest', 1, [10, 11]), ('invalidate', None),
+                     ('ingest', 2, [12])]
+
+
+def test_listen_for_notifications_reconnects(monkeypatch):
+    """A dropped LISTEN connection is reopened, then on_reconnect runs."""
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'x')
+    stop_event = threading.Event()
+    connections = []
+
+    class Notify():
+        def __init__(self, payload):
+            self.payload = payload
+
+    class Connection():
+        def __init__(self, batches):
+            self.batches = batches
+            self.notifies = []
+            self.closed = False
+
+        def fileno(self):
+            return read_fd
+
+        def set_isolation_level(self, level):
+            pass
+
+        def cursor(self):
+            return self
+
+        def execute(self, statement):
+            assert statement == 'LISTEN "new_transactions";'
+
+        def poll(self):
+            if not self.batches:
+                raise psycopg2.OperationalError('server closed connection')
+            self.notifies = [Notify(p) for p in self.batches.pop(0)]
+
+        def close(self):
+            self.closed = True
+
+    attempts = iter([None, ['a', 'b'], None, ['c']])
+
+    def connect(**kwargs):
+        batch = next(attempts)
+        if batch is None:
+            raise psycopg2.OperationalError('could not connect')
+        connections.append(Connection([batch]))
+        return connections[-1]
+
+    monkeypatch.setattr(app.helpers.psycopg2, 'connect', connect)
+    reconnects = []
+    received = []
+    for payloads in listen_for_notifications(
+            ['new_transactions'], stop_event, timeout=0.01,
+            on_reconnect=lambda: reconnects.append(len(received)),
+            retry_seconds=0.01):
+        received.append(payloads)
+        if len(received) == 2:
+            stop_event.set()
+    os.close(read_fd)
+    os.close(write_fd)
+
+    assert received == [['a', 'b'], ['c']]
+    # after the failed first attempt, and after the dropped connection
+    assert reconnects == [0, 1]
+    assert all(conn.closed for conn in connections)
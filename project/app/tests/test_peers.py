@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+
+import app.peers
+from app.peers import (QuantileSketch, PeerBenchmarks, sketch_key,
+                       monthly_category_totals, pack_sketches,
+                       sketch_accounts, add_zero_spending)
+from app.reference import publish
+
+
+def test_sketch_quantiles_and_ranks():
+    """Quantiles are within the relative accuracy and ranks within a bucket."""
+    values = np.random.default_rng(0).lognormal(5, 1, size=20000)
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    sketch.add(values)
+
+    for q in [0.01, 0.25, 0.5, 0.75, 0.99]:
+        exact = np.quantile(values, q, method='lower')
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * exact
+
+    values.sort()
+    for amount in [20, 150, 1000]:
+        rank = sketch.rank(amount)
+        assert (values <= amount).mean() <= rank
+        assert rank <= (values <= amount * sketch.gamma).mean()
+
+
+def test_merged_chunks_match_one_sketch():
+    """Merging the sketches of chunks gives the sketch of all the values."""
+    values = np.random.default_rng(1).lognormal(4, 2, size=5000)
+    values[:100] = 0
+    whole = QuantileSketch()
+    whole.add(values)
+
+    merged = QuantileSketch()
+    for chunk in np.array_split(values, 7):
+        part = QuantileSketch()
+        part.add(chunk)
+        merged.merge(part)
+
+    assert merged.counts == whole.counts
+    assert (merged.zero_count, merged.count) == (100, 5000)
+    assert merged.rank(0) == 100 / 5000
+
+
+def test_latest_month_is_left_out():
+    """Totals skip each account's latest month and transfers."""
+    rows = pd.DataFrame({
+        'bank_account_id': [1, 1, 1, 1, 2],
+        'date': pd.to_datetime(['2020-07-03', '2020-07-20', '2020-08-01',
+                                '2020-07-05', '2020-06-10']),
+        'amount_cents': [1000, 500, 700, 300, 900],
+        'grandparent_category_name': ['Food', 'Food', 'Food', 'Transfers',
+                                      'Food'],
+        'parent_category_name': ['Restaurants', 'Groceries', 'Restaurants',
+                                 'Transfer', 'Restaurants'],
+    })
+    totals = monthly_category_totals(rows)['grandparent']
+    assert totals.to_dict() == {(1, '2020-07', 'Food'): 15.0}
+
+
+def test_accounts_without_spending_count_as_zero(monkeypatch):
+    """Percentiles are of every account active in the month, including
+    those that spent nothing in the category, across chunks."""
+    rows = pd.DataFrame({
+        'bank_account_id': [1, 1, 1, 2, 2, 3, 3],
+        'date': pd.to_datetime(['2020-06-03', '2020-07-03', '2020-08-01',
+                                '2020-07-05', '2020-08-10', '2020-05-02',
+                                '2020-08-02']),
+        'amount_cents': [1000, 2000, 700, 500, 900, 4000, 100],
+        'grandparent_category_name': ['Food', 'Food', 'Food', 'Shops',
+                                      'Shops', 'Food', 'Food'],
+        'parent_category_name': ['Restaurants'] * 3 + ['Clothing'] * 2 +
+                                ['Groceries'] * 2,
+    })
+    monkeypatch.setattr(
+        app.peers, 'fetch_statement',
+        lambda name, params: rows[rows['bank_account_id'].isin(params[0])])
+
+    sketches, active = {}, {}
+    for chunk in ([1, 2], [3]):
+        chunk_sketches, chunk_active = sketch_accounts(chunk)
+        for key, sketch in chunk_sketches.items():
+            sketches.setdefault(key, QuantileSketch()).merge(sketch)
+        for month, count in chunk_active.items():
+            active[month] = active.get(month, 0) + count
+    # account 2 is active from July, account 3 from May
+    assert active == {'2020-05': 1, '2020-06': 2, '2020-07': 3}
+
+    add_zero_spending(sketches, active)
+    july = sketches[sketch_key('grandparent', 'Food', '2020-07')]
+    assert (july.count, july.zero_count) == (3, 2)
+    assert july.rank(0) == 2 / 3
+    assert july.rank(20) == 1
+    assert sketches[sketch_key('grandparent', 'Food')].count == 6
+    assert sketches[sketch_key('grandparent', 'Shops')].zero_count == 5
+
+
+def test_benchmarks_match_sketch_ranks(tmp_path):
+    """Percentiles from the published arrays are the sketches' ranks."""
+    rng = np.random.default_rng(2)
+    sketches = {}
+    for month in ['2020-06', '2020-07']:
+        sketch = QuantileSketch()
+        sketch.add(np.append(rng.lognormal(5, 1, size=500), [0, 0]))
+        sketches[sketch_key('grandparent', 'Food', month)] = sketch
+    publish('peer_sketches', pack_sketches(sketches), str(tmp_path))
+
+    benchmarks = PeerBenchmarks(str(tmp_path))
+    for key, sketch in sketches.items():
+        month = key.split('|')[2]
+        for amount in [-1, 0, 0.5, 20, 150, 1000, 10 ** 6]:
+            percentile, count = benchmarks.percentile('grandparent', 'Food',
+                                                      amount, month)
+            assert count == 502
+            assert percentile == 100 * sketch.rank(amount)
+    assert benchmarks.percentile('grandparent', 'Travel', 70) is None
+
+
+def test_benchmarks_attach_new_versions(tmp_path):
+    """A rebuild is picked up without restarting."""
+    benchmarks = PeerBenchmarks(str(tmp_path))
+    assert benchmarks.percentile('grandparent', 'Food', 70) is None
+
+    for top in [100, 200]:
+        sketch = QuantileSketch()
+        sketch.add(np.arange(1, top + 1))
+        publish('peer_sketches',
+                pack_sketches({sketch_key('grandparent', 'Food'): sketch}),
+                str(tmp_path))
+        percentile, count = benchmarks.percentile('grandparent', 'Food', 70)
+        assert count == top
+        assert 70 * 100 / top <= percentile <= 72 * 100 / top
@@ -0,0 +1,83 @@
+import base64
+import json
+
+import numpy as np
+
+from app.api.viz import spending_chart, money_flow_chart
+from app.periods import PeriodTotals, spending_periods, money_flow_periods
+from app.tests.test_streaming import make_transactions
+from app.user import User, get_last_time_period
+
+TIME_PERIODS = ['day', 'week', 'month', 'year', 'all']
+
+
+def trace_values(chart, key, trace=0):
+    """Values of a trace property, decoding plotly's binary arrays."""
+    value = json.loads(chart)['data'][trace][key]
+    if isinstance(value, dict):
+        return np.frombuffer(base64.b64decode(value['bdata']),
+                             dtype=value['dtype'])
+    return np.asarray(value)
+
+
+def test_window_totals_match_get_last_time_period():
+    """Differencing cumulative sums gives each window's category totals."""
+    expenses = User(make_transactions(3000)).expenses
+    totals = PeriodTotals(expenses, 'grandparent_category_name')
+
+    for time_period in TIME_PERIODS:
+        window = get_last_time_period(expenses, time_period)
+        expected = window.groupby('grandparent_category_name')[
+            'amount_dollars'].sum()
+        got = totals.category_totals(time_period)['amount_dollars']
+        assert list(got.index) == list(expected.index)
+        np.testing.assert_allclose(got.values, expected.values)
+
+        daily = totals.daily_totals(time_period)
+        assert daily.index.min() == window['date'].min()
+        assert np.nansum(daily.values) / 100 == \
+            round(window['amount_dollars'].sum(), 2)
+
+
+def test_charts_match_single_period_charts():
+    """Every period's chart is the one /spending or /moneyflow returns."""
+    transactions = make_transactions(3000)
+    pies = spending_periods(transactions, 'pie', TIME_PERIODS, 'Greens_r',
+                            0.8)
+    bars = spending_periods(transactions, 'bar', TIME_PERIODS, 'Greens_r',
+                            0.8, 'auto')
+    lines = money_flow_periods(transactions, TIME_PERIODS, max_points=40)
+
+    for time_period in TIME_PERIODS:
+        pie = spending_chart(transactions, 'pie', time_period, 'Greens_r',
+                             0.8)
+        assert json.loads(pies[time_period])['layout'] == \
+            json.loads(pie)['layout']
+        assert list(trace_values(pies[time_period], 'labels')) == \
+            list(trace_values(pie, 'labels'))
+        np.testing.assert_allclose(trace_values(pies[time_period], 'values'),
+                                   trace_values(pie, 'values'))
+
+        bar = spending_chart(transactions, 'bar', time_period, 'Greens_r',
+                             0.8, 'auto')
+        layout = json.loads(bars[time_period])['layout']
+        expected = json.loads(bar)['layout']
+        labels = layout.pop('annotations', [])
+        expected_labels = expected.pop('annotations', [])
+        assert layout == expected
+        assert [(a['text'], a['x']) for a in labels] == \
+            [(a['text'], a['x']) for a in expected_labels]
+        np.testing.assert_allclose([a['y'] for a in labels],
+                                   [a['y'] for a in expected_labels])
+        for trace in range(len(json.loads(bar)['data'])):
+            np.testing.assert_allclose(
+                trace_values(bars[time_period], 'y', trace),
+                trace_values(bar, 'y', trace))
+
+        line = money_flow_chart(transactions, time_period, max_points=40)
+        assert json.loads(lines[time_period])['layout'] == \
+            json.loads(line)['layout']
+        assert list(trace_values(lines[time_period], 'x')) == \
+            list(trace_values(line, 'x'))
+        np.testing.assert_allclose(trace_values(lines[time_period], 'y'),
+                                   trace_values(line, 'y'))
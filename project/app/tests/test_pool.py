@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+import app.helpers
+from app.helpers import ConnectionPool, PoolTimeout
+
+
+class FakeConnection():
+    def __init__(self):
+        self.closed = 0
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    """Connections opened by the pool."""
+    opened = []
+
+    def connect(**kwargs):
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    monkeypatch.setattr(app.helpers.psycopg2, 'connect', connect)
+    return opened
+
+
+def test_returned_connections_are_kept_open(opened):
+    """Returned connections are reused, broken ones are replaced."""
+    pool = ConnectionPool(2, timeout=1)
+    first, second = pool.getconn(), pool.getconn()
+    pool.putconn(first)
+    pool.putconn(second)
+    assert not first.closed and not second.closed
+    assert {pool.getconn(), pool.getconn()} == {first, second}
+
+    pool.putconn(first, close=True)
+    assert first.closed
+    second.closed = 1
+    pool.putconn(second)
+    assert pool.getconn() not in (first, second)
+    assert len(opened) == 3
+
+
+def test_getconn_times_out(opened):
+    """Waiting for a free connection raises after the timeout, and a
+    connection returned in time is handed over."""
+    pool = ConnectionPool(1, timeout=0.1)
+    conn = pool.getconn()
+    started = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert time.monotonic() - started >= 0.1
+
+    pool.timeout = 5
+    threading.Timer(0.1, pool.putconn, (conn,)).start()
+    assert pool.getconn() is conn
@@ -0,0 +1,49 @@
+import contextlib
+import io
+
+import pytest
+
+from app.tests.golden import corpus
+from app.user import User, monthly_spending_totals, exp_smoothing_level, \
+    prune_categories
+
+CASES = corpus()
+
+
+def budget(df, **settings):
+    """predict_budget() of a User, without its printing."""
+    user = User(df, **settings)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return user, user.predict_budget()
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+@pytest.mark.parametrize('top_k', [3, 10])
+def test_retained_budgets_are_unchanged(name, top_k):
+    """Pruning only moves the long tail into Misc., every category kept
+    gets the budget it gets without pruning."""
+    for cat_column in ('merchant_name', 'parent_category_name'):
+        _, full = budget(CASES[name], cat_column=cat_column)
+        _, pruned = budget(CASES[name], cat_column=cat_column, top_k=top_k)
+        if full is None:
+            assert pruned is None
+            continue
+        retained = [cat for cat in pruned if cat != 'Misc.']
+        assert {cat: pruned[cat] for cat in retained} == \
+            {cat: full[cat] for cat in retained}
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_categories_ranked_by_forecast(name):
+    """The categories kept are the ones with the largest forecasts."""
+    user, _ = budget(CASES[name], cat_column='merchant_name')
+    totals = monthly_spending_totals(user.expenses,
+                                     num_months=user.past_months,
+                                     category='merchant_name')
+    levels = {cat: exp_smoothing_level(totals[cat].values)
+              for cat in totals.columns}
+    _, pruned = prune_categories(user.expenses, num_months=user.past_months,
+                                 category='merchant_name', top_k=3)
+    kept = sorted(set(levels) - set(pruned), key=levels.get, reverse=True)
+    assert len(kept) == min(3, len(levels))
+    assert all(levels[cat] <= levels[kept[-1]] for cat in pruned)
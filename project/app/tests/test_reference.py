@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+
+from app.reference import ReferenceData, publish, sorted_lookup, \
+    KEEP_VERSIONS
+
+
+def test_versions_swap_and_old_ones_are_removed(tmp_path):
+    directory = str(tmp_path)
+    data = ReferenceData('totals', directory)
+    assert data.get() is None
+
+    publish('totals', {'values': np.arange(3)}, directory)
+    first = data.get()['values']
+    assert not first.flags.writeable
+    assert list(first) == [0, 1, 2]
+    assert data.refresh() is False
+
+    for i in range(KEEP_VERSIONS + 2):
+        publish('totals', {'values': np.arange(4 + i)}, directory)
+    assert list(data.get()['values']) == list(range(KEEP_VERSIONS + 5))
+
+    # the first version was removed, but its mapping can still be read
+    versions = [entry for entry in os.listdir(tmp_path / 'totals')
+                if entry.isdigit()]
+    assert len(versions) == KEEP_VERSIONS + 1
+    assert list(first) == [0, 1, 2]
+
+
+def test_sorted_lookup():
+    values = np.array([b'abc', b'abd', b'zz'])
+    positions, found = sorted_lookup(values, [b'abd', b'abdx', b'a', b'zzz'])
+    assert list(found) == [True, False, False, False]
+    assert positions[0] == 1
+
+    _, found = sorted_lookup(values[:0], [b'abc'])
+    assert list(found) == [False]
@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.singleflight import BlockingSingleFlight, SingleFlight
+
+
+def test_concurrent_calls_share_one_fetch():
+    """Concurrent calls for the same key run the function once."""
+    flight = SingleFlight('test')
+    calls = []
+
+    def slow_fetch(key):
+        calls.append(key)
+        time.sleep(0.1)
+        return {'key': key}
+
+    async def run():
+        return await asyncio.gather(
+            *[flight.do(1, slow_fetch, 1) for _ in range(5)],
+            flight.do(2, slow_fetch, 2))
+
+    results = asyncio.run(run())
+    assert sorted(calls) == [1, 2]
+    assert all(result is results[0] for result in results[:5])
+    assert flight.stats() == {'calls': 6, 'fetches': 2, 'coalesced': 4,
+                              'in_flight': 0}
+
+
+def test_sequential_calls_fetch_again():
+    """Calls made after a fetch finishes start a new fetch."""
+    flight = SingleFlight('test')
+
+    async def run():
+        await flight.do(1, lambda: 'a')
+        await flight.do(1, lambda: 'b')
+
+    asyncio.run(run())
+    assert flight.fetches == 2
+    assert flight.coalesced == 0
+
+
+def test_threads_share_one_call():
+    """Concurrent calls from threads for the same key run the function once,
+    and later calls run it again."""
+    flight = BlockingSingleFlight()
+    calls = []
+    results = []
+
+    def slow_fetch(key):
+        calls.append(key)
+        time.sleep(0.1)
+        return {'key': key}
+
+    threads = [threading.Thread(
+        target=lambda: results.append(flight.do(1, slow_fetch, 1)))
+        for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+    assert all(result is results[0] for result in results)
+    assert flight.in_flight == {}
+    assert flight.do(1, slow_fetch, 1) is not results[0]
+
+
+def test_threads_share_the_exception():
+    """Callers waiting on a call that fails get its exception."""
+    flight = BlockingSingleFlight()
+    errors = []
+
+    def failing_fetch():
+        time.sleep(0.1)
+        raise ValueError('down')
+
+    def call():
+        try:
+            flight.do(1, failing_fetch)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 3
+    assert flight.in_flight == {}
+    with pytest.raises(ValueError):
+        flight.do(1, failing_fetch)
@@ -0,0 +1,147 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app.snapshot
+from app.helpers import format_user_data, load_user_data, \
+    load_user_data_window
+from app.snapshot import SNAPSHOT_COLUMNS, KEEP_VERSIONS, export_snapshot, \
+    read_snapshot, read_manifest, load_snapshot_data
+
+ACCOUNTS = [3, 12, 10007]
+
+
+def raw_rows(seed=0):
+    """query.sql rows of three accounts in two buckets, in no order."""
+    rng = np.random.default_rng(seed)
+    n = 90
+    rows = pd.DataFrame({
+        'id': np.arange(1, n + 1),
+        'bank_account_id': np.repeat(ACCOUNTS, n // 3),
+        'date': pd.Timestamp('2020-01-01') +
+        pd.to_timedelta(rng.integers(0, 200, n), unit='D'),
+        'amount_cents': rng.integers(-5000, 20000, n),
+        'merchant_address': None,
+        'category_id': rng.choice(['13005000', '21009000', '21001000'], n),
+        'merchant_name': rng.choice(['STARBUCKS #123', 'Target', None], n),
+    })
+    names = {'13005000': ('Food', 'Restaurants'),
+             '21009000': ('Payroll', 'Payroll'),
+             '21001000': ('Transfers', 'Transfer')}
+    rows['grandparent_category_name'] = rows['category_id'].map(
+        lambda c: names[c][0])
+    rows['parent_category_name'] = rows['category_id'].map(
+        lambda c: names[c][1])
+    return rows.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+class FakeConnection():
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, monkeypatch):
+    """A snapshot exported from raw_rows() instead of Postgres."""
+    rows = raw_rows()
+
+    def fetch_dataframe(query, conn):
+        if 'min(bank_account_id)' in query:
+            return pd.DataFrame({'lo': [rows['bank_account_id'].min()],
+                                 'hi': [rows['bank_account_id'].max()]})
+        start, end = [int(x) for x in
+                      query.split('BETWEEN')[1].split('AND')]
+        return rows[rows['bank_account_id'].between(start, end)]
+
+    monkeypatch.setattr(app.snapshot, 'fetch_dataframe', fetch_dataframe)
+    monkeypatch.setattr(app.snapshot.psycopg2, 'connect',
+                        lambda **kwargs: FakeConnection())
+    path = str(tmp_path / 'transactions')
+    manifest = export_snapshot(path, bucket_size=10000, row_group_size=10)
+    assert manifest['buckets'] == [0, 1]
+    assert manifest['num_rows'] == len(rows)
+    assert read_manifest(path)['buckets'] == [0, 1]
+    monkeypatch.setattr(app.snapshot, 'SNAPSHOT_DIR', path)
+    return path
+
+
+def postgres_frame(bank_id):
+    """What load_user_data() formats from Postgres, ordered by date."""
+    rows = raw_rows()
+    rows = rows[rows['bank_account_id'] == bank_id]
+    return format_user_data(rows.sort_values(by=['date', 'id'])
+                            .reset_index(drop=True))
+
+
+def by_date(df):
+    return df.sort_values(by=['date', 'amount_dollars']) \
+        .reset_index(drop=True)
+
+
+def test_read_snapshot(snapshot_dir):
+    """Every row is read back, with filters pushed down."""
+    df = read_snapshot(snapshot_dir)
+    assert list(df.columns) == SNAPSHOT_COLUMNS
+    assert sorted(df['id']) == list(range(1, 91))
+
+    df = read_snapshot(snapshot_dir, columns=['id', 'bank_account_id'],
+                       filters=[('bank_account_id', '=', 10007)])
+    assert set(df['bank_account_id']) == {10007} and len(df) == 30
+
+
+@pytest.mark.parametrize('bank_id', ACCOUNTS)
+def test_snapshot_matches_postgres_format(snapshot_dir, monkeypatch,
+                                          bank_id):
+    """The parquet backend returns the frames the postgres one would."""
+    monkeypatch.setattr(app.snapshot, 'load_snapshot_data',
+                        lambda bank_id: load_snapshot_data(bank_id,
+                                                           snapshot_dir))
+    expected = postgres_frame(bank_id)
+    pd.testing.assert_frame_equal(load_snapshot_data(bank_id, snapshot_dir),
+                                  expected)
+    pd.testing.assert_frame_equal(load_user_data(bank_id, 'parquet'),
+                                  expected)
+
+    for expenses_only in (False, True):
+        anchor = expected
+        if expenses_only:
+            anchor = expected[
+                (expected['grandparent_category_name'] != 'Transfers') &
+                (expected['amount_dollars'] > 0)]
+        cutoff = anchor['date'].max() - pd.Timedelta(days=30)
+        window = load_user_data_window(bank_id, 30, expenses_only,
+                                       backend='parquet')
+        assert window['date'].min() > cutoff
+        pd.testing.assert_frame_equal(
+            by_date(window), by_date(expected[expected['date'] > cutoff]))
+
+
+def test_missing_account(snapshot_dir):
+    """Accounts outside every bucket load as an empty frame."""
+    df = load_snapshot_data(25000, snapshot_dir)
+    assert len(df) == 0
+    assert 'amount_dollars' in df.columns
+
+
+def test_exports_repoint_current(snapshot_dir, monkeypatch):
+    """A new export is swapped in through CURRENT, a failed one leaves the
+    previous snapshot readable, and only recent versions are kept."""
+    first = read_manifest(snapshot_dir)['created_at']
+    for _ in range(KEEP_VERSIONS + 1):
+        export_snapshot(snapshot_dir, bucket_size=20000, row_group_size=10)
+    assert read_manifest(snapshot_dir)['buckets'] == [0]
+    assert read_manifest(snapshot_dir)['created_at'] != first
+    versions = [entry for entry in os.listdir(snapshot_dir)
+                if entry.isdigit()]
+    assert len(versions) == KEEP_VERSIONS + 1
+
+    def fetch_dataframe(query, conn):
+        raise ConnectionError('database went away')
+
+    monkeypatch.setattr(app.snapshot, 'fetch_dataframe', fetch_dataframe)
+    with pytest.raises(ConnectionError):
+        export_snapshot(snapshot_dir)
+    assert sorted(os.listdir(snapshot_dir)) == sorted(versions + ['CURRENT'])
+    assert len(read_snapshot(snapshot_dir)) == 90
@@ -0,0 +1,17 @@
+import re
+
+from app.helpers import STATEMENTS, QUERY_SQL
+
+
+def test_statement_parameters_match_types():
+    """Every prepared statement declares a type for each $n it uses."""
+    for name, (types, statement) in STATEMENTS.items():
+        used = {int(n) for n in re.findall(r'\$(\d+)', statement)}
+        assert used == set(range(1, len(types.split(',')) + 1)), name
+
+
+def test_transactions_statement_filters_on_account():
+    """query.sql is read once and completed with the account parameter."""
+    assert QUERY_SQL.rstrip().endswith('bank_account_id =')
+    assert re.search(r'bank_account_id =\s+\$1$',
+                     STATEMENTS['transactions'][1])
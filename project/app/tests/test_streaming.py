@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from app.streaming import TransactionTotals, BUDGET_KEYS
+from app.user import User, monthly_spending_totals
+
+
+def make_transactions(num_rows=2000, seed=0):
+    """Random transactions in the load_user_data() format."""
+    rng = np.random.default_rng(seed)
+    categories = [('Food', 'Restaurants'), ('Shopping', 'Clothing'),
+                  ('Transfers', 'Transfer'), ('Payroll', 'Payroll')]
+    picks = rng.integers(len(categories), size=num_rows)
+    df = pd.DataFrame({
+        'category_id': '0',
+        'date': pd.Timestamp('2020-09-15') -
+        pd.to_timedelta(rng.integers(0, 400, size=num_rows), unit='D'),
+        'grandparent_category_name': [categories[i][0] for i in picks],
+        'parent_category_name': [categories[i][1] for i in picks],
+        'merchant_name': rng.choice(['Starbucks', 'Target', None],
+                                    size=num_rows),
+        'amount_dollars': rng.integers(-5000, 20000, size=num_rows) / 100,
+    })
+    df['category_name'] = df['parent_category_name']
+    return df
+
+
+def test_totals_match_full_history():
+    """Folding chunks gives the same charts and budgets inputs."""
+    df = make_transactions()
+    totals = TransactionTotals(BUDGET_KEYS)
+    for start in range(0, len(df), 333):
+        totals.add(df.iloc[start:start + 333])
+    folded = totals.to_frame()
+
+    assert folded['transaction_count'].sum() == len(df)
+    assert len(folded) < len(df)
+
+    full_user = User(df, cat_column='merchant_name')
+    folded_user = User(folded, cat_column='merchant_name')
+    assert folded_user.num_expenses == full_user.num_expenses
+
+    pd.testing.assert_frame_equal(
+        monthly_spending_totals(full_user.expenses, category='merchant_name'),
+        monthly_spending_totals(folded_user.expenses,
+                                category='merchant_name'))
+
+    daily = full_user.data.groupby('date')['amount_dollars'].sum()
+    folded_daily = folded_user.data.groupby('date')['amount_dollars'].sum()
+    pd.testing.assert_series_equal(daily, folded_daily)
@@ -9,6 +9,19 @@ from math import ceil
 from datetime import timedelta
 from statsmodels.tsa.api import SimpleExpSmoothing, ExponentialSmoothing
 
+# number of days covered by each time_period accepted by get_last_time_period
+TIME_PERIOD_DAYS = {'day': 1, 'week': 7, 'month': 30, 'year': 365}
+
+# pandas period used for each bar_viz resolution
+RESOLUTION_PERIODS = {'day': 'D', 'week': 'W', 'month': 'M'}
+
+# smoothing level of the exponential smoothing used by predict_budget()
+SMOOTHING_LEVEL = 0.6
+
+# simulated months and percentiles of budget_bands()
+BAND_SIMULATIONS = 5000
+BAND_QUANTILES = (10, 50, 90)
+
 
 def get_last_time_period(transaction_df, time_period='week'):
     """
@@ -28,14 +41,8 @@ def get_last_time_period(transaction_df, time_period='week'):
     latest_time = transaction_df['date'].iloc[-1]
 
     # based on the time period, establish a cutoff in order to subset the data
-    if time_period == 'day':
-        cutoff = latest_time - timedelta(days=1)
-    elif time_period == 'month':
-        cutoff = latest_time - timedelta(days=30)
-    elif time_period == 'week':
-        cutoff = latest_time - timedelta(days=7)
-    elif time_period == 'year':
-        cutoff = latest_time - timedelta(days=365)
+    if time_period in TIME_PERIOD_DAYS:
+        cutoff = latest_time - timedelta(days=TIME_PERIOD_DAYS[time_period])
     elif time_period == 'all':
         return transaction_df
     else:
@@ -48,6 +55,136 @@ def get_last_time_period(transaction_df, time_period='week'):
     return subset
 
 
+def choose_resolution(dates, max_daily_days=92, max_weekly_days=731):
+    """
+    Given a series of dates, return the bar chart resolution ('day', 'week'
+    or 'month') for the span they cover: daily bars for up to max_daily_days,
+    weekly bars for up to max_weekly_days and monthly bars after that.
+    """
+    if len(dates) == 0:
+        return 'day'
+    span = (dates.max() - dates.min()).days
+    if span <= max_daily_days:
+        return 'day'
+    if span <= max_weekly_days:
+        return 'week'
+    return 'month'
+
+
+def bucket_dates(dates, resolution='day'):
+    """
+    Given a series of dates, return the first day of the day, week (starting
+    on Monday) or month each date falls in.
+    """
+    if resolution not in RESOLUTION_PERIODS:
+        raise ValueError(
+            f"resolution must be one of 'day, week, or month'. Got {resolution} instead.")
+    if resolution == 'day':
+        return dates.dt.normalize()
+    return dates.dt.to_period(RESOLUTION_PERIODS[resolution]).dt.start_time
+
+
+def lttb(x, y, num_points):
+    """
+    Downsample a line to num_points points with the Largest-Triangle-Three-
+    Buckets algorithm, which keeps the points that matter most to the line's
+    shape (peaks, dips and turns) rather than every n-th point.
+
+    The first and last points are always kept. The points in between are
+    split into num_points - 2 buckets and from each bucket the point forming
+    the largest triangle with the previously kept point and the average of
+    the next bucket is kept.
+
+    Parameters:
+        x (array): x values, sorted in increasing order
+        y (array): y values
+        num_points (int): number of points to keep, at least 3
+
+    Returns:
+        array of the indices of the kept points
+    """
+    n = len(x)
+    if num_points < 3:
+        raise ValueError(f'num_points must be at least 3. Got {num_points} instead.')
+    if n <= num_points:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    # bucket i holds the points from edges[i] up to edges[i + 1]
+    edges = np.linspace(1, n - 1, num_points - 1).astype(int)
+
+    kept = np.empty(num_points, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+    a = 0
+    for i in range(num_points - 2):
+        start, end = edges[i], edges[i + 1]
+
+        # the third corner is the average of the next bucket, or the last
+        # point for the final bucket
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+
+        # twice the area of the triangle formed with each point in the bucket
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) -
+                      (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+
+    return kept
+
+
+def drop_internal_transfers(transaction_df, max_days=3):
+    """
+    Given a dataframe of transactions from several of a user's bank accounts,
+    remove transfers between two of those accounts.
+
+    A transfer is internal when a "Transfers" transaction leaving one account
+    is matched by a "Transfers" transaction of the same amount arriving in a
+    different account within max_days days. Each transaction is matched at
+    most once, closest dates first. Both sides of a match are removed.
+
+    Parameters:
+        transaction_df (dataframe): transactions with bank_account_id, date,
+            amount_cents and grandparent_category_name columns
+        max_days (int): largest number of days between the two sides of a
+            transfer
+
+    Returns:
+        dataframe without the internal transfers
+    """
+    transfers = transaction_df[
+        transaction_df['grandparent_category_name'] == 'Transfers']
+    transfers = transfers[['bank_account_id', 'date', 'amount_cents']]
+
+    # money leaving an account is positive, money arriving is negative
+    outgoing = transfers[transfers['amount_cents'] > 0].reset_index()
+    incoming = transfers[transfers['amount_cents'] < 0].reset_index()
+    incoming['amount_cents'] = -incoming['amount_cents']
+
+    # candidate pairs: same amount, different accounts, close dates
+    pairs = outgoing.merge(incoming, on='amount_cents',
+                           suffixes=('_out', '_in'))
+    pairs = pairs[pairs['bank_account_id_out'] != pairs['bank_account_id_in']]
+    pairs['gap'] = (pairs['date_out'] - pairs['date_in']).abs()
+    pairs = pairs[pairs['gap'] <= timedelta(days=max_days)]
+    pairs = pairs.sort_values(by=['gap', 'index_out', 'index_in'])
+
+    # greedily keep the closest pairs that don't reuse a transaction
+    matched = set()
+    for out_index, in_index in zip(pairs['index_out'], pairs['index_in']):
+        if out_index not in matched and in_index not in matched:
+            matched.add(out_index)
+            matched.add(in_index)
+
+    return transaction_df.drop(index=list(matched))
+
+
 def monthly_spending_totals(user_expenses_df, num_months=12, category='grandparent_category_name'):
     """
     Given a dataframe of user transactions with category and date information,
@@ -155,6 +292,103 @@ def monthly_spending_totals(user_expenses_df, num_months=12, category='grandpare
     return prev
 
 
+def select_pruned_categories(spending, top_k=None, top_share=None):
+    """
+    Given a series of spending by category, return the categories outside
+    the top_k categories and/or the fewest categories that together make up
+    top_share of spending, see prune_categories().
+    """
+    values = spending.values
+
+    # partially sort so only the top_k categories are ordered
+    kept = np.arange(len(values))
+    if top_k is not None and top_k < len(values):
+        kept = np.argpartition(-values, top_k - 1)[:top_k]
+    kept = kept[np.argsort(-values[kept], kind='stable')]
+
+    if top_share is not None:
+        share = np.cumsum(values[kept]) / values.sum()
+        kept = kept[:np.searchsorted(share, top_share) + 1]
+
+    return list(spending.index.delete(kept))
+
+
+def exp_smoothing_level(values, smoothing_level=SMOOTHING_LEVEL):
+    """
+    Return the last smoothed level of a series, which is the one month
+    forecast of SimpleExpSmoothing(values).fit(smoothing_level,
+    optimized=False): the level starts at the first value and is updated
+    with each value in turn.
+    """
+    level = values[0]
+    for value in values:
+        level = smoothing_level * value + (1 - smoothing_level) * level
+    return level
+
+
+def exp_smoothing_levels(totals, smoothing_level=SMOOTHING_LEVEL):
+    """
+    Return exp_smoothing_level() of every column of a dataframe of monthly
+    totals (months as rows, oldest first) as a series, computed for all the
+    columns at once.
+    """
+    values = totals.values
+    if len(values) == 0:
+        return pd.Series(0.0, index=totals.columns)
+    level = values[0].astype(float)
+    for row in values:
+        level = smoothing_level * row + (1 - smoothing_level) * level
+    return pd.Series(level, index=totals.columns)
+
+
+def prune_categories(user_expenses_df, num_months=12, category='grandparent_category_name', top_k=None, top_share=None, min_frequency=1, name='Misc.'):
+    """
+    Given a dataframe of user transactions, relabel every category except the
+    top spending categories as a single "Misc." category, so that
+    monthly_spending_totals() builds one column for the long tail instead of
+    one per category.
+
+    Categories are ranked by their forecast, the exponentially smoothed
+    level of their monthly totals over the same months
+    monthly_spending_totals() uses, so recent spending weighs as much as it
+    does in predict_budget(). Keep at most top_k categories, and/or the
+    fewest categories that together make up top_share (between 0 and 1) of
+    the forecast spending. Pruned categories that were active in min_frequency months or
+    fewer are removed rather than relabeled, since
+    drop_low_frequency_categories() would drop them anyway.
+
+    Returns a tuple of the relabeled dataframe and the list of pruned
+    categories.
+    """
+    # first day of the latest month, and of the first month used for totals
+    latest = user_expenses_df['date'].max()
+    end = pd.Timestamp(year=latest.year, month=latest.month, day=1)
+    start = end - pd.DateOffset(months=num_months)
+    window = user_expenses_df[(user_expenses_df['date'] >= start) &
+                              (user_expenses_df['date'] < end)]
+
+    # monthly totals of each category, including months without spending
+    months = window['date'].dt.to_period('M')
+    totals = window.groupby([months, window[category]])['amount_dollars'] \
+        .sum().unstack(fill_value=0)
+    totals = totals.reindex(pd.period_range(start, periods=num_months,
+                                            freq='M'), fill_value=0)
+
+    pruned = select_pruned_categories(exp_smoothing_levels(totals),
+                                      top_k=top_k, top_share=top_share)
+    if len(pruned) == 0:
+        return user_expenses_df, []
+
+    # count the months each pruned category was active in
+    active = months.groupby(window[category]).nunique()
+    rare = [cat for cat in pruned if active[cat] <= min_frequency]
+
+    pruned_df = user_expenses_df[~user_expenses_df[category].isin(rare)].copy()
+    pruned_df.loc[pruned_df[category].isin(pruned), category] = name
+
+    return pruned_df, list(pruned)
+
+
 def trimmer(budget_df, threshold_1=10, threshold_2=0, trim_name='mean', name='Misc.', in_place=True, save=False):
     """
     Given a dataframe of average spending history, combine rows with a mean below a given threshold into a single row.
@@ -260,9 +494,10 @@ def dict_trimmer(budget, threshold_1=10, threshold_2=0, name='Misc.', in_place=T
             del budget[cat]
 
     # if trimmed_sum is greater than threshold_2, then we add a new row
-    # containing the sum of the means from the deleted rows
+    # containing the sum of the means from the deleted rows. If the budget
+    # already has a row with that name, add to it instead
     if trimmed_sum > threshold_2:
-        budget[name] = trimmed_sum
+        budget[name] = budget.get(name, 0) + trimmed_sum
 
     # If save=True, then return both the budget and the deleted categories
     if save:
@@ -289,6 +524,70 @@ def drop_low_frequency_categories(total_spending_by_month_df, min_frequency=1):
             total_spending_by_month_df.drop(columns=cat, inplace=True)
 
 
+def trim_month_spending(grouped_dict, fixed_categories):
+    """
+    Given a dictionary of spending totals by category for a month, combine
+    small categories that are not part of the user's budget into a "Misc."
+    category and make sure every budgeted category is listed.
+
+    Parameters:
+        grouped_dict (dictionary): total spending for each category
+        fixed_categories (list): categories that will be explicitly listed in
+            the output regardless of current spending amount
+
+    Returns:
+        Python dictionary of spending by category.
+    """
+    trimmed_budget = {}
+    total_budget = 0
+    moved = []
+    # loop through current expense categories
+    for category in grouped_dict:
+        total_budget += grouped_dict[category]
+
+        # if the category is not a fixed (budgeted) category
+        if category not in fixed_categories:
+            # add it to be empty dict to be trimmed
+            trimmed_budget[category] = grouped_dict[category]
+
+            # Track what categories are added. So when the 2
+            # dictionaries (fixed and unfixed) are combined, 
+            # we know not to count these twice.
+            moved.append(category)
+
+    # categories with amounts below this threshold will be combined into a "misc." category
+    threshold_1 = total_budget*0.03
+
+    # use trimmer to combine small categories into a misc. category
+    dict_trimmer(trimmed_budget, threshold_1=threshold_1, in_place=True)
+
+    # loop through grouped_dict and add it's entries to trimmed_budget.
+    for cat in grouped_dict:
+        # if the category was aleady added to trimmed budget, pass
+        if cat in moved:
+            pass
+        else:
+            # if the category was not moved, but exists in both
+            # dictionaries, then add them together
+            # this only happens when Misc. is a fixed category and the
+            # trimmer generates another Misc. category
+            if cat in trimmed_budget:
+                trimmed_budget[cat] += grouped_dict[cat]
+            # itherwise, we simply copy the entry into our trimmed_budget
+            else:
+                trimmed_budget[cat] = grouped_dict[cat]
+
+    # loop through fixed (budgeted) categories
+    for category in fixed_categories:
+        # if the user has not spent money in the category this month:
+        if category not in trimmed_budget:
+            # add it to the grouped_dict with $0 amount to show money
+            # hasn't been spent in that category yet
+            trimmed_budget[category] = 0
+
+    return trimmed_budget
+
+
 class User():
     """
     Class used to contain and analyze a user's transaction data
@@ -307,9 +606,17 @@ class User():
         warning (int): warning flag used to indicate that an error has been
             encountered during budget generation
         warning_list (list): list used to contain warning messaged
+        num_expenses (int): number of expense transactions
+        top_k (int): if set, predict_budget() only forecasts the top_k
+            spending categories and combines the rest into "Misc."
+        top_share (float): if set, predict_budget() only forecasts the
+            categories making up this share of spending and combines the rest
+            into "Misc."
+        spending_by_month (dataframe): monthly spending totals used by the
+            last call to predict_budget()
     """
 
-    def __init__(self, data, name=None, show=False, hole=0.8, cat_column='parent_category_name'):
+    def __init__(self, data, name=None, show=False, hole=0.8, cat_column='parent_category_name', top_k=None, top_share=None):
         """
         Constructor for the User class.
 
@@ -320,6 +627,11 @@ class User():
                 generated. Defaults to False
             hole (float): sets size of the donut hole for the
                 categorical_spending() charts
+            cat_column (str): category column used for budgets
+            top_k (int): number of categories to forecast, see
+                prune_categories()
+            top_share (float): share of spending to forecast, see
+                prune_categories()
         """
 
         self.name = name
@@ -330,6 +642,16 @@ class User():
             (self.data['grandparent_category_name'] != 'Transfers') &
             (self.data['amount_dollars'] > 0)
         ]
+
+        # totals folded by app/streaming.py have one row per date and
+        # category rather than per transaction, with the number of
+        # transactions in each
+        if 'transaction_count' in self.data.columns:
+            self.num_expenses = int(self.expenses['transaction_count'].sum())
+            self.data = self.data.drop(columns=['transaction_count'])
+            self.expenses = self.expenses.drop(columns=['transaction_count'])
+        else:
+            self.num_expenses = len(self.expenses)
         self.show = show
         self.past_months = 12
         self.hole = hole
@@ -337,6 +659,24 @@ class User():
         self.warning = 0
         self.warning_list = []
         self.cat_column = cat_column
+        self.top_k = top_k
+        self.top_share = top_share
+        self.spending_by_month = None
+
+    @classmethod
+    def from_snapshot(cls, bank_id, snapshot_dir=None, **kwargs):
+        """
+        Create a User from a Parquet snapshot instead of the database.
+
+        Parameters:
+            bank_id (int): bank account id
+            snapshot_dir (str): directory written by app/snapshot.py.
+                Defaults to the SAVER_SNAPSHOT_DIR environment variable
+            **kwargs: passed on to the User constructor
+        """
+        from app.snapshot import load_snapshot_data, SNAPSHOT_DIR
+        data = load_snapshot_data(bank_id, snapshot_dir or SNAPSHOT_DIR)
+        return cls(data, **kwargs)
 
     def get_user_data(self):
         """
@@ -378,6 +718,40 @@ class User():
         trimmer(user_expense_grouped, threshold_1=0.02,
                 trim_name='amount_dollars')
 
+        fig = self.pie_figure(user_expense_grouped, time_period,
+                              color_template)
+
+        if self.show:
+            fig.show()
+
+        return fig.to_json()
+
+    def pie_figure(self, user_expense_grouped, time_period, color_template,
+                   fig=None):
+        """
+        Returns the categorical_spending() pie chart figure of spending
+        already summed by category.
+
+        Parameters:
+            user_expense_grouped (dataframe): amount_dollars by category
+            time_period (str): time frame the spending covers
+            color_template (str): the plotly sequential color template to use
+            fig (Figure): a figure returned by an earlier call with the same
+                color_template. Only its data and title are replaced, which
+                is much faster than building a new figure
+        """
+        # add title based on current time period being viewed
+        if time_period == 'all':
+            title = "Spending by Category"
+        else:
+            title = f"Spending by Category for the Last {time_period.capitalize()}"
+
+        if fig is not None:
+            fig.update_traces(labels=user_expense_grouped.index,
+                              values=user_expense_grouped['amount_dollars'])
+            fig.layout.title.text = title
+            return fig
+
         # get list of colors from the plotly's color templates
         color_list = eval('px.colors.sequential.' + color_template)
 
@@ -395,17 +769,8 @@ class User():
         # add outline to graph objects
         fig.update_traces(marker=dict(line=dict(color='#626262', width=1.5)))
 
-        # add title based on current time period being viewed
-        if time_period == 'all':
-            fig.update_layout(
-                title={"text": f"Spending by Category", "x": 0.5, "y": 0.9},
-                font_size=16,)
-
-        else:
-            fig.update_layout(title={
-                              "text": f"Spending by Category for the Last {time_period.capitalize()}",
-                              "x": 0.5, "y": 0.9},
-                              font_size=16)
+        fig.update_layout(title={"text": title, "x": 0.5, "y": 0.9},
+                          font_size=16)
 
         # style the hover labels
         fig.update_layout(
@@ -440,18 +805,17 @@ class User():
                           plot_bgcolor='rgba(0, 0, 0, 0)',
                           paper_bgcolor='rgba(0, 0, 0, 0)')
 
-        if self.show:
-            fig.show()
+        return fig
 
-        return fig.to_json()
-
-    def money_flow(self, time_period='week'):
+    def money_flow(self, time_period='week', max_points=None):
         """
         Returns jsonified plotly object which is a line chart depicting net
         income over time for the User.
 
         Parameters:
             time_period (str): time frame used to define "recent"
+            max_points (int): if set, the daily series is downsampled to at
+                most this many points with lttb()
 
         Returns:
             Plotly express object of a line chart in json format
@@ -470,6 +834,48 @@ class User():
             user_transaction_subset['amount_dollars'].resample('D').sum())
         total_each_day['amount_flipped'] = total_each_day['amount_dollars']*-1
 
+        fig = self.money_flow_figure(total_each_day, time_period, max_points)
+
+        if self.show:
+            fig.show()
+
+        return fig.to_json()
+
+    def money_flow_figure(self, total_each_day, time_period, max_points=None,
+                          fig=None):
+        """
+        Returns the money_flow() line chart figure of daily totals.
+
+        Parameters:
+            total_each_day (dataframe): amount_flipped (net income) for each
+                day
+            time_period (str): time frame the totals cover
+            max_points (int): if set, the line is downsampled to at most this
+                many points with lttb()
+            fig (Figure): a figure returned by an earlier call. Only its data
+                and title are replaced, which is much faster than building a
+                new figure
+        """
+        # keep only the points that shape the line on long time periods
+        if max_points is not None:
+            kept = lttb(total_each_day.index.asi8,
+                        total_each_day['amount_flipped'].values, max_points)
+            total_each_day = total_each_day.iloc[kept]
+
+        # update title based on time period being viewed
+        if time_period == 'all':
+            title = "Money Flow"
+        else:
+            title = f"Daily Net Income for the Last {time_period.capitalize()}"
+
+        if fig is not None:
+            fig.update_traces(x=total_each_day.index,
+                              y=total_each_day['amount_flipped'],
+                              hovertext=round(
+                                  total_each_day['amount_flipped'], 2))
+            fig.layout.title.text = title
+            return fig
+
         # generate the plot figure
         fig = go.Figure(data=go.Scatter(x=total_each_day.index,
                                         y=total_each_day['amount_flipped'],
@@ -499,15 +905,7 @@ class User():
             type="line", line_color="salmon", line_width=3, opacity=0.5,
             line_dash="solid", x0=0, x1=1, xref="paper", y0=0, y1=0, yref="y")
 
-        # update title based on time period being viewed
-        if time_period == 'all':
-            fig.update_layout(
-                title={"text": f"Money Flow", "x": 0.5, "y": 0.9})
-
-        else:
-            fig.update_layout(title={
-                              "text": f"Daily Net Income for the Last {time_period.capitalize()}",
-                              "x": 0.5, "y": 0.9})
+        fig.update_layout(title={"text": title, "x": 0.5, "y": 0.9})
 
         # label and style the x and y axis
         fig.update_layout(
@@ -518,20 +916,25 @@ class User():
             plot_bgcolor='rgba(0, 0, 0, 0)',
             paper_bgcolor='rgba(0, 0, 0, 0)')
 
-        if self.show:
-            fig.show()
+        return fig
 
-        return fig.to_json()
-
-    def bar_viz(self, time_period='week', category="grandparent_category_name", color_template='Greens_r'):
+    def bar_viz(self, time_period='week', category="grandparent_category_name", color_template='Greens_r', resolution='day'):
         """
         Returns jsonified plotly object which is a bar chart of recent
         transactions for the User.
 
+        Each bar is labeled with its total for the week and month time
+        periods. The year and all time periods are only labeled when they
+        are bucketed into weeks or months, which keeps the number of labels
+        readable.
+
         Parameters:
             time_period (str): time frame used to define "recent"
             category (str): the level of spending category to use
             color_template (str): the plotly sequential color template to use
+            resolution (str): one bar per 'day', 'week' or 'month', or 'auto'
+                to pick one from the span of the time period with
+                choose_resolution()
 
         Returns:
             Plotly object of a bar chart in json format
@@ -541,11 +944,38 @@ class User():
 
         subset[category] = subset[category].astype(str)
 
-        # group the sum of a categorie's purchases by each day
+        # group long time periods into weekly or monthly bars
+        if resolution == 'auto':
+            resolution = choose_resolution(subset['date'])
+        subset['date'] = bucket_dates(subset['date'], resolution)
+
+        # group the sum of a categorie's purchases by each bucket
         subset = subset.groupby([category, 'date']).agg(
             {'amount_dollars': 'sum'})
         subset = subset.reset_index()
 
+        fig = self.bar_figure(subset, time_period, category, color_template,
+                              resolution)
+
+        if self.show:
+            fig.show()
+
+        return fig.to_json()
+
+    def bar_figure(self, subset, time_period, category, color_template,
+                   resolution):
+        """
+        Returns the bar_viz() bar chart figure of spending already summed by
+        category and date bucket.
+
+        Parameters:
+            subset (dataframe): the category, date and amount_dollars of
+                each bar, sorted by category and date
+            time_period (str): time frame the spending covers
+            category (str): the category column of subset
+            color_template (str): the plotly sequential color template to use
+            resolution (str): 'day', 'week' or 'month', the date buckets
+        """
         # rename columns for cleaner visualization
         subset.rename({category: 'Category', 'date': 'Date',
                        'amount_dollars': 'Spending ($)'}, axis=1, inplace=True)
@@ -567,84 +997,66 @@ class User():
         )
 
         # generate title based on time period
+        frequency = {'day': 'Daily', 'week': 'Weekly',
+                     'month': 'Monthly'}[resolution]
         if time_period == 'all':
-            fig.update_layout(title={'text': "Daily Spending by Category "})
+            title = f"{frequency} Spending by Category "
         else:
-            fig.update_layout(title={
-                              'text': f"Daily Spending by Category for the Last {time_period.capitalize()}"})
-
-        fig.update_layout(legend=dict(
-            yanchor="top",
-            y=1,
-            xanchor='left',
-            x=1
-        ))
-
-        # formatting global font size, and title position
-        fig.update_layout(font_size=15,
-                          plot_bgcolor='rgba(0, 0, 0, 0)',
-                          paper_bgcolor='rgba(0, 0, 0, 0)')
-
-        fig.update_layout(barmode='relative',)
-        fig.update(layout=dict(title=dict(x=0.45)))
-
-        # create annotations for $ total amounts
-        annotations = (subset.groupby(['Date']).sum()).to_dict()
-        annotations = dict(annotations['Spending ($)'])
+            title = f"{frequency} Spending by Category for the Last {time_period.capitalize()}"
+
+        # build the rest of the layout as plain data so that plotly only
+        # validates it once
+        layout = dict(
+            title=dict(text=title, x=0.45),
+            legend=dict(yanchor="top", y=1, xanchor='left', x=1),
+            font_size=15,
+            plot_bgcolor='rgba(0, 0, 0, 0)',
+            paper_bgcolor='rgba(0, 0, 0, 0)',
+            barmode='relative',
+        )
 
-        # add total $ amounts above bars depending on time period
-        if time_period == 'week':
+        # total $ amounts above bars, sized for the number of bars. Daily
+        # bars are only labeled for the week and month, longer time periods
+        # are labeled when bucketed into weeks or months
+        long_period = time_period in ('year', 'all')
+        if time_period == 'week' or (long_period and resolution == 'month'):
+            font_size = 16
+        elif time_period == 'month' or (long_period and resolution == 'week'):
+            font_size = 10
+        else:
+            font_size = None
 
-            for k, v in annotations.items():
-                fig.add_annotation(
-                    text=f'    <b>${round(v)}</b>',
-                    font_size=16,
-                    x=k,
-                    y=v,
-                    arrowcolor='rgba(0,0,0,0)',
-                )
+        if font_size is not None:
+            totals = subset.groupby('Date')['Spending ($)'].sum()
+            layout['annotations'] = [
+                dict(text=f'    <b>${round(v)}</b>', font_size=font_size,
+                     x=k, y=v, arrowcolor='rgba(0,0,0,0)')
+                for k, v in totals.items()]
 
-        if time_period == 'month':
+        fig.update_layout(**layout)
 
-            for k, v in annotations.items():
-                fig.add_annotation(
-                    text=f'    <b>${round(v)}</b>',
-                    font_size=10,
-                    x=k,
-                    y=v,
-                    arrowcolor='rgba(0,0,0,0)',
-                )
+        return fig
 
-        if self.show:
-            fig.show()
-
-        return fig.to_json()
-
-    def predict_budget(self):
+    def check_history(self, num_transactions, transaction_history):
         """
-        Returns a dictionary of spending predictions for the coming month.
+        Add warnings about a short transaction history to self.warning_list.
 
-        Uses exponential smoothing to forecast user spending.
-        Users with low or insufficient data will trigger warnings that will be
-        stored in self.warning_list.
-        Small spending categories will be combined into a miscellaneous
-        category.
-        The names of the combiend categories can be accessed via self.misc.
+        Parameters:
+            num_transactions (int): number of expense transactions
+            transaction_history (int): number of days between the first and
+                the latest expense
 
         Returns:
-            Python dictionary of spending predictions.
+            False if the history is too short to generate a budget
         """
 
-        # calculate number of transactions in user's expense data
-        num_transactions = len(self.expenses)
-
         # WARNING (Fatal)
         # if user has less than 10 transactions, return None + Warning.
         if num_transactions < 10:
             warning = "Insufficient transaction history. A minimum of 10 transactions is required before generating a budget."
             self.warning_list.append(warning)
             self.warning = 2
-            return None
+            return False
 
         # WARNING (Non-Fatal)
         # if user has less than 100 transactions, add a warning about poor
@@ -654,10 +1066,6 @@ class User():
             self.warning_list.append(warning)
             self.warning = 1
 
-        # calculate how many days does the user's transaction history cover
-        transaction_history = (
-            max(self.expenses['date']) - min(self.expenses['date'])).days
-
         # WARNING (Fatal)
         # if transaction history < 2 months of data (60 days), add a warning
         # about poor predictions
@@ -665,7 +1073,7 @@ class User():
             warning = "Your user history does not go back more than 2 months. It is likely this will negatively impact the quality of our budget recommendations."
             self.warning_list.append(warning)
             self.warning = 2
-            return None
+            return False
 
         # WARNING (Non-Fatal)
         # if transaction history < 6 months of data (180 days), add a warning
@@ -675,28 +1083,76 @@ class User():
             self.warning_list.append(warning)
             self.warning = 1
 
+        return True
+
+    def predict_budget(self):
+        """
+        Returns a dictionary of spending predictions for the coming month.
+
+        Uses exponential smoothing to forecast user spending.
+        Users with low or insufficient data will trigger warnings that will be
+        stored in self.warning_list.
+        Small spending categories will be combined into a miscellaneous
+        category.
+        The names of the combiend categories can be accessed via self.misc.
+
+        Returns:
+            Python dictionary of spending predictions.
+        """
+
+        # calculate number of transactions in user's expense data
+        num_transactions = self.num_expenses
+
+        # calculate how many days does the user's transaction history cover
+        transaction_history = (
+            max(self.expenses['date']) - min(self.expenses['date'])).days
+
+        if not self.check_history(num_transactions, transaction_history):
+            return None
+
+        # sets minimum # months which financial activity occured to 10%
+        min_frequency = int(self.past_months/10)
+
+        # combine the long tail of small categories into a misc. category
+        # before building the monthly totals, so that they are forecast once
+        # instead of once per category
+        expenses = self.expenses
+        if self.top_k is not None or self.top_share is not None:
+            expenses, _ = prune_categories(
+                expenses, num_months=self.past_months,
+                category=self.cat_column, top_k=self.top_k,
+                top_share=self.top_share, min_frequency=min_frequency)
+
         # get dataframe of average spending per category over last X months
         total_spending_by_month_df = monthly_spending_totals(
-            self.expenses, num_months=self.past_months, category=self.cat_column)
+            expenses, num_months=self.past_months, category=self.cat_column)
         
         print("")
         print(f'total_spending_by_month_df {total_spending_by_month_df.columns}')
 
-        # sets minimum # months which financial activity occured to 10%
-        min_frequency = int(self.past_months/10)
+        # keep the totals for budget_modifier()
+        self.spending_by_month = total_spending_by_month_df.copy()
+
         drop_low_frequency_categories(
             total_spending_by_month_df, min_frequency=min_frequency)
 
         # loop through spending categories and forecast spending for the
         # coming month
-        budget = {}
-        budget_amount = 0
+        forecasts = {}
         for cat in total_spending_by_month_df.columns:
             fit1 = SimpleExpSmoothing(np.asarray(total_spending_by_month_df[cat])).fit(
-                smoothing_level=0.6, optimized=False)
-            prediction = fit1.forecast(1)[0]
-            budget_amount += prediction
-            budget[cat] = round(prediction)
+                smoothing_level=SMOOTHING_LEVEL, optimized=False)
+            forecasts[cat] = fit1.forecast(1)[0]
+
+        return self.budget_from_forecasts(forecasts)
+
+    def budget_from_forecasts(self, forecasts):
+        """
+        Returns the budget dictionary for a dictionary of forecast spending
+        by category, as the last step of predict_budget().
+        """
+        budget = {cat: round(prediction)
+                  for cat, prediction in forecasts.items()}
 
         print(f'budget: {budget}')
 
@@ -752,32 +1208,8 @@ class User():
                 f"Your savings goal of {monthly_savings_goal} is more than 30% of your total budget of {total_budget}. Consider entering a lower savings goal.")
             self.warning = 1
 
-        # get dataframe of average spending per category over the
-        # last self.past_months
-        total_spending_by_month_df = monthly_spending_totals(
-            self.expenses, num_months=self.past_months, category=self.cat_column)
-
-        # create a new misc. category by combining the columns in self.misc
-        # (i.e. the columns combined by the trimmer in predict_budget)
-        print("")
-        print(f'total_spending_by_month_df: {total_spending_by_month_df.columns}')
-        print("")
-        print(f'self.misc: {self.misc}')
-        print("")
-        total_spending_by_month_df["Misc."] = total_spending_by_month_df[self.misc].transpose().sum()
-
-        # drop the columns that were combined into the "Misc." column
-        total_spending_by_month_df.drop(columns=self.misc, inplace=True)
-
-        # create a dictionary where each key is a standard deviation and each
-        # value is the corresponding category
-        standard_devs = {}
-
-        # for each category in our budget, calculate the standard deviation
-        # for its monthly spending
-        for cat in budget:
-            std = total_spending_by_month_df[cat].std()
-            standard_devs[std] = cat
+        # rank the categories by how discretionary they are
+        standard_devs = self.discretionary_stds(budget)
 
         # set the number of discretionary categories equal to half the number
         # of total categories rounded up to the nearest whole number
@@ -792,11 +1224,13 @@ class User():
 
         # if savings goal > total_disc, then we add more categories to the
         # list until we have enough
-        while monthly_savings_goal > total_disc:
+        while monthly_savings_goal > total_disc and \
+                num_discretionary < len(standard_devs):
             num_discretionary += 1
             top_stds = sorted(standard_devs.keys(), reverse=True)[
                 0:num_discretionary]
-            total_disc = [budget[standard_devs[score]] for score in top_stds]
+            total_disc = sum([budget[standard_devs[score]]
+                              for score in top_stds])
 
         """
         For the top std scores, we find the corresponding budget category, calculate a scaling factor, scale the monthly_savings_goal by that factor, and subtract the result from that category's budget.
@@ -810,6 +1244,182 @@ class User():
 
         return budget
 
+    def discretionary_stds(self, budget):
+        """
+        Returns a dictionary where each key is the standard deviation of a
+        budget category's monthly spending and each value is the category,
+        as used by budget_modifier() to find the discretionary categories.
+        """
+        total_spending_by_month_df = self.budget_spending_by_month()
+
+        # create a dictionary where each key is a standard deviation and each
+        # value is the corresponding category
+        standard_devs = {}
+
+        # for each category in our budget, calculate the standard deviation
+        # for its monthly spending
+        for cat in budget:
+            std = total_spending_by_month_df[cat].std()
+            standard_devs[std] = cat
+
+        return standard_devs
+
+    def budget_spending_by_month(self):
+        """
+        Returns the monthly spending totals by budget category, with the
+        categories combined by predict_budget() summed in a "Misc." column.
+        """
+        # get dataframe of average spending per category over the
+        # last self.past_months, reusing the totals from predict_budget()
+        if self.spending_by_month is not None:
+            total_spending_by_month_df = self.spending_by_month.copy()
+        else:
+            total_spending_by_month_df = monthly_spending_totals(
+                self.expenses, num_months=self.past_months, category=self.cat_column)
+
+        # create a new misc. category by combining the columns in self.misc
+        # (i.e. the columns combined by the trimmer in predict_budget)
+        print("")
+        print(f'total_spending_by_month_df: {total_spending_by_month_df.columns}')
+        print("")
+        print(f'self.misc: {self.misc}')
+        print("")
+        misc = total_spending_by_month_df[self.misc].transpose().sum()
+
+        # a "Misc." column made by prune_categories() that wasn't trimmed
+        # is part of the new misc. category as well
+        if 'Misc.' in total_spending_by_month_df.columns and 'Misc.' not in self.misc:
+            misc += total_spending_by_month_df['Misc.']
+
+        # drop the columns that were combined into the "Misc." column
+        total_spending_by_month_df.drop(columns=self.misc, inplace=True)
+        total_spending_by_month_df["Misc."] = misc
+
+        return total_spending_by_month_df
+
+    def budget_bands(self, budget, num_simulations=BAND_SIMULATIONS,
+                     quantiles=BAND_QUANTILES, seed=0):
+        """
+        Returns quantiles of next month's spending in each budget category,
+        simulated by bootstrapping the residuals of the exponential
+        smoothing.
+
+        This method requires predict_budget() to be executed first.
+        Each category's monthly totals are smoothed as in predict_budget(),
+        and its one month ahead errors over the past months are kept. Each
+        simulation adds the errors of one past month, drawn at random, to
+        the forecast of every category, so that categories that move
+        together in the past move together in the simulations. Spending
+        below 0 counts as 0.
+
+        Parameters:
+            budget (dictionary): output of predict_budget()
+            num_simulations (int): number of simulated months
+            quantiles (tuple): percentiles to return, between 0 and 100
+            seed (int): seed of the random draws, so that the same history
+                gives the same bands
+
+        Returns:
+            Python dictionary of the percentiles ('p10', 'p50', ...) of each
+            category under 'categories' and of the total under 'total'
+        """
+        spending = self.budget_spending_by_month()[list(budget)].values.T
+
+        # smooth every category at once: the level starts at the first
+        # month, and each month's error is its distance from the level
+        # forecast before it
+        level = spending[:, 0]
+        residuals = np.empty((spending.shape[0], spending.shape[1] - 1))
+        for month in range(1, spending.shape[1]):
+            residuals[:, month - 1] = spending[:, month] - level
+            level = SMOOTHING_LEVEL * spending[:, month] + \
+                (1 - SMOOTHING_LEVEL) * level
+
+        # categories x simulations
+        rng = np.random.default_rng(seed)
+        if residuals.shape[1]:
+            draws = rng.integers(residuals.shape[1], size=num_simulations)
+            simulations = level[:, None] + residuals[:, draws]
+        else:
+            simulations = np.repeat(level[:, None], num_simulations, axis=1)
+        np.maximum(simulations, 0, out=simulations)
+
+        def named(percentiles):
+            return {f'p{q:g}': round(float(value), 2)
+                    for q, value in zip(quantiles, percentiles)}
+
+        percentiles = np.percentile(simulations, quantiles, axis=1)
+        return {'categories': {category: named(percentiles[:, i])
+                               for i, category in enumerate(budget)},
+                'total': named(np.percentile(simulations.sum(axis=0),
+                                             quantiles))}
+
+    def budget_sweep(self, budget, monthly_savings_goals):
+        """
+        Returns the budget_modifier() result of every savings goal in a list,
+        ranking the categories once and allocating all the goals at once.
+
+        This method requires predict_budget() to be executed first, and
+        leaves budget, self.warning and self.warning_list unchanged.
+
+        Parameters:
+            budget (dictionary): output of predict_budget()
+            monthly_savings_goals (list): amounts of money to remove from
+                the budgeted amounts
+
+        Returns:
+            list with a tuple per savings goal of the modified budget (None
+            on fatal warnings), the warning level and the warning list
+        """
+        goals = np.asarray(monthly_savings_goals, dtype=float)
+        total_budget = 0
+        for category in budget:
+            total_budget += budget[category]
+
+        # categories from the most to the least discretionary, with the
+        # budgets of the top k and the sum of their std scores for each k
+        standard_devs = self.discretionary_stds(budget)
+        top_stds = sorted(standard_devs.keys(), reverse=True)
+        categories = [standard_devs[score] for score in top_stds]
+        total_disc = np.cumsum([budget[category] for category in categories])
+        std_sums = np.cumsum(top_stds)
+
+        # number of discretionary categories for each goal: at least half of
+        # the categories, and more until their budgets cover the goal
+        num_discretionary = ceil(len(budget)/2)
+        covered = total_disc[None, :] >= goals[:, None]
+        covered[:, :num_discretionary - 1] = False
+        counts = np.where(covered.any(axis=1), covered.argmax(axis=1) + 1,
+                          len(categories))
+        counts = np.maximum(counts, min(num_discretionary, len(categories)))
+
+        # savings taken from each category for each goal, with the top k
+        # std scores of the goal's k as the weights
+        scaling_factors = np.asarray(top_stds)[None, :] / \
+            std_sums[counts - 1][:, None]
+        scaled_savings_goals = np.rint(goals[:, None] * scaling_factors)
+        scaled_savings_goals[np.arange(len(categories))[None, :] >=
+                             counts[:, None]] = 0
+
+        results = []
+        for goal, savings in zip(monthly_savings_goals, scaled_savings_goals):
+            warning, warning_list = self.warning, list(self.warning_list)
+            if goal > total_budget:
+                warning_list.append(
+                    f"Your savings goal of {goal} is larger than your budget of {total_budget}. Please enter a lower savings goal.")
+                results.append((None, 2, warning_list))
+                continue
+            if goal > total_budget * 0.3:
+                warning_list.append(
+                    f"Your savings goal of {goal} is more than 30% of your total budget of {total_budget}. Consider entering a lower savings goal.")
+                warning = 1
+
+            modified = dict(budget)
+            for category, saving in zip(categories, savings):
+                modified[category] -= int(saving)
+            results.append((modified, warning, warning_list))
+        return results
+
     def current_month_spending(self, fixed_categories, current=True, date_cutoff=None):
         """
         Return a user's spending history for their most recent month containing
@@ -858,51 +1468,4 @@ class User():
         grouped_expenses = grouped_expenses.round({'amount_dollars': 2})
         grouped_dict = dict(grouped_expenses['amount_dollars'])
 
-        trimmed_budget = {}
-        total_budget = 0
-        moved = []
-        # loop through current expense categories
-        for category in grouped_dict:
-            total_budget += grouped_dict[category]
-
-            # if the category is not a fixed (budgeted) category
-            if category not in fixed_categories:
-                # add it to be empty dict to be trimmed
-                trimmed_budget[category] = grouped_dict[category]
-
-                # Track what categories are added. So when the 2
-                # dictionaries (fixed and unfixed) are combined, 
-                # we know not to count these twice.
-                moved.append(category)
-
-        # categories with amounts below this threshold will be combined into a "misc." category
-        threshold_1 = total_budget*0.03
-
-        # use trimmer to combine small categories into a misc. category
-        dict_trimmer(trimmed_budget, threshold_1=threshold_1, in_place=True)
-
-        # loop through grouped_dict and add it's entries to trimmed_budget.
-        for cat in grouped_dict:
-            # if the category was aleady added to trimmed budget, pass
-            if cat in moved:
-                pass
-            else:
-                # if the category was not moved, but exists in both
-                # dictionaries, then add them together
-                # this only happens when Misc. is a fixed category and the
-                # trimmer generates another Misc. category
-                if cat in trimmed_budget:
-                    trimmed_budget[cat] += grouped_dict[cat]
-                # itherwise, we simply copy the entry into our trimmed_budget
-                else:
-                    trimmed_budget[cat] = grouped_dict[cat]
-
-        # loop through fixed (budgeted) categories
-        for category in fixed_categories:
-            # if the user has not spent money in the category this month:
-            if category not in trimmed_budget:
-                # add it to the grouped_dict with $0 amount to show money
-                # hasn't been spent in that category yet
-                trimmed_budget[category] = 0
-
-        return trimmed_budget
+        return trim_month_spending(grouped_dict, fixed_categories)
@@ -0,0 +1,99 @@
+"""
+Benchmark the fetch strategies of app.helpers.fetch_dataframe().
+
+Runs query.sql over the first N transactions of the database for each row
+count, with every strategy, checks that the strategies return the same
+dataframe and reports the median time of each. The same rows are also
+fetched straight from plaid_main_transactions, which leaves out the time
+Postgres spends on query.sql's category CASE expressions and so shows the
+client-side difference between the strategies.
+
+Usage (from the project directory, with the database seeded by
+loadtest.seed):
+
+    python -m loadtest.fetch --rows 1000 10000 100000
+"""
+import argparse
+import itertools
+import json
+import time
+
+import psycopg2
+from pandas.testing import assert_frame_equal
+
+from app.helpers import (SAVER_USERNAME, SAVER_PASSWORD, SAVER_DB_HOST,
+                         SAVER_DB_NAME, QUERY_SQL, fetch_dataframe)
+
+STRATEGIES = ['read_sql', 'copy']
+
+
+def benchmark(row_counts, repeats=5):
+    """
+    Time each fetch strategy on query results of the given sizes.
+
+    Returns:
+        dictionary with, for each query and row count, the number of rows
+        fetched and the median seconds taken by each strategy
+    """
+    conn = psycopg2.connect(user=SAVER_USERNAME, password=SAVER_PASSWORD,
+                            host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
+
+    # query.sql ends with "bank_account_id = ", swap the equality for every
+    # account and keep the first rows
+    sources = {
+        'query.sql': QUERY_SQL.rstrip().rstrip('=') + ' IS NOT NULL',
+        'table': 'SELECT * FROM public.plaid_main_transactions',
+    }
+
+    results = {}
+    for (source, base), num_rows in itertools.product(sources.items(),
+                                                      row_counts):
+        query = f'{base} ORDER BY id LIMIT {int(num_rows)}'
+
+        frames = {}
+        timings = {}
+        for strategy in STRATEGIES:
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                frames[strategy] = fetch_dataframe(query, conn, strategy)
+                times.append(time.perf_counter() - start)
+            timings[strategy] = sorted(times)[len(times) // 2]
+
+        for strategy in STRATEGIES[1:]:
+            assert_frame_equal(frames[STRATEGIES[0]], frames[strategy])
+
+        results[f'{source} {num_rows}'] = {
+            'source': source,
+            'rows': len(frames[STRATEGIES[0]]),
+            'median_s': {strategy: round(timings[strategy], 4)
+                         for strategy in STRATEGIES},
+        }
+
+    conn.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare read_sql and COPY for loading transactions.')
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--out', help='also write the results as JSON')
+
+    args = parser.parse_args()
+    results = benchmark(args.rows, repeats=args.repeats)
+
+    print(f"{'source':<12}{'rows':>8}" +
+          ''.join(f'{strategy:>12}' for strategy in STRATEGIES) +
+          f"{'speedup':>10}")
+    for stats in results.values():
+        timings = stats['median_s']
+        print(f"{stats['source']:<12}{stats['rows']:>8}" +
+              ''.join(f'{timings[strategy]:>12}' for strategy in STRATEGIES) +
+              f"{timings['read_sql'] / timings['copy']:>9.1f}x")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,353 @@
+"""
+Load test the API with a configurable mix of requests.
+
+Workers send requests back to back for a fixed duration, each picking an
+endpoint by weight and a random bank account. By default the app is called
+in-process through its ASGI interface, which exercises the routes, the
+threadpool and the database without a server in between. With --url the
+requests go over HTTP to a running server instead.
+
+The report has the throughput and the p50/p95/p99 latency of every
+endpoint. It is printed and written as JSON, and when a baseline report is
+given the command exits with an error if any endpoint got slower than the
+allowed regression.
+
+Usage (from the project directory, with the database seeded by
+loadtest.seed):
+
+    python -m loadtest.run --duration 30 --concurrency 16 \\
+        --mix dashboard=1,spending=3,moneyflow=2,future_budget=1,current_month_spending=3 \\
+        --out loadtest_report.json
+    python -m loadtest.run --url http://localhost:7000 \\
+        --baseline loadtest_report.json --max-regression 0.2
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import datetime as dt
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+
+# request sent by each endpoint of the mix for a bank account
+ENDPOINTS = {
+    'dashboard': lambda bank_id, rng: (
+        'GET', f'/dashboard/{bank_id}', {}, None),
+    'spending': lambda bank_id, rng: (
+        'POST', '/spending', {}, {
+            'bank_account_id': bank_id,
+            'graph_type': rng.choice(['pie', 'bar']),
+            'time_period': rng.choice(['week', 'month', 'year', 'all'])}),
+    'moneyflow': lambda bank_id, rng: (
+        'POST', '/moneyflow', {}, {
+            'bank_account_id': bank_id,
+            'time_period': rng.choice(['week', 'month', 'year', 'all'])}),
+    'future_budget': lambda bank_id, rng: (
+        'POST', '/future_budget', {}, {
+            'bank_account_id': bank_id,
+            'monthly_savings_goal': rng.choice([0, 50, 200])}),
+    'current_month_spending': lambda bank_id, rng: (
+        'GET', f'/current_month_spending/{bank_id}',
+        {'categories': ['Restaurants', 'Food and Beverage Store',
+                        'Utilities']}, None),
+}
+
+DEFAULT_MIX = ('dashboard=1,spending=3,moneyflow=2,future_budget=1,'
+               'current_month_spending=3')
+
+
+def parse_mix(mix):
+    """
+    Parse a mix like "spending=3,moneyflow=1" into a dictionary of weights.
+    """
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f'unknown endpoint {name!r}, expected one of '
+                             f'{", ".join(ENDPOINTS)}')
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def parse_accounts(accounts):
+    """
+    Parse bank account ids like "1-200" or "3,7,12-15" into a list.
+    """
+    ids = []
+    for part in accounts.split(','):
+        lo, _, hi = part.partition('-')
+        ids.extend(range(int(lo), int(hi or lo) + 1))
+    return ids
+
+
+async def asgi_request(app, method, path, params, body):
+    """
+    Call an ASGI app directly and return the status code and response size.
+    """
+    data = json.dumps(body).encode() if body is not None else b''
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'root_path': '',
+        'query_string': urlencode(params, doseq=True).encode(),
+        'headers': [(b'host', b'loadtest'),
+                    (b'content-type', b'application/json'),
+                    (b'content-length', str(len(data)).encode())],
+        'client': ('127.0.0.1', 0),
+        'server': ('loadtest', 80),
+    }
+    response = {'status': None, 'size': 0}
+    finished = asyncio.Event()
+    sent_body = False
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {'type': 'http.request', 'body': data,
+                    'more_body': False}
+        await finished.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            response['size'] += len(message.get('body', b''))
+            if not message.get('more_body', False):
+                finished.set()
+
+    await app(scope, receive, send)
+    finished.set()
+    return response['status'], response['size']
+
+
+async def http_request(url, method, path, params, body):
+    """
+    Send one HTTP/1.1 request to a running server and return the status code
+    and response size.
+    """
+    parts = urlsplit(url)
+    data = json.dumps(body).encode() if body is not None else b''
+    query = urlencode(params, doseq=True)
+    target = parts.path.rstrip('/') + path + (f'?{query}' if query else '')
+
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, parts.port or 80)
+    writer.write((f'{method} {target} HTTP/1.1\r\n'
+                  f'Host: {parts.netloc}\r\n'
+                  f'Content-Type: application/json\r\n'
+                  f'Content-Length: {len(data)}\r\n'
+                  f'Connection: close\r\n\r\n').encode() + data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, payload = response.partition(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    return status, len(payload)
+
+
+async def worker(send_request, weights, accounts, deadline, warmup_end,
+                 results, rng):
+    """
+    Send requests back to back until the deadline, recording every request
+    that starts after the warmup.
+    """
+    names = list(weights)
+    cum_weights = np.cumsum([weights[name] for name in names]).tolist()
+
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, cum_weights=cum_weights)[0]
+        method, path, params, body = ENDPOINTS[name](rng.choice(accounts),
+                                                     rng)
+        start = time.perf_counter()
+        try:
+            status, size = await send_request(method, path, params, body)
+        except Exception as e:
+            status, size = type(e).__name__, 0
+        end = time.perf_counter()
+
+        if start >= warmup_end:
+            results.append((name, end - start, status, size, end))
+
+
+def summarize(results, duration):
+    """
+    Summarize the recorded requests by endpoint.
+
+    Returns:
+        dictionary with the requests, errors, throughput, mean response size
+        and latency percentiles (in milliseconds) of every endpoint, plus a
+        "total" entry across endpoints
+    """
+    by_endpoint = {}
+    for name, latency, status, size, _ in results:
+        by_endpoint.setdefault(name, []).append((latency, status, size))
+    by_endpoint['total'] = [(latency, status, size)
+                            for _, latency, status, size, _ in results]
+
+    summary = {}
+    for name in sorted(by_endpoint):
+        rows = by_endpoint[name]
+        if not rows:
+            continue
+        latencies = np.array([row[0] for row in rows]) * 1000
+        statuses = {}
+        for _, status, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary[name] = {
+            'requests': len(rows),
+            'errors': sum(count for status, count in statuses.items()
+                          if not status.startswith('2')),
+            'status_codes': statuses,
+            'throughput_rps': round(len(rows) / duration, 2),
+            'mean_response_bytes': int(np.mean([row[2] for row in rows])),
+            'latency_ms': {
+                'p50': round(p50, 2),
+                'p95': round(p95, 2),
+                'p99': round(p99, 2),
+                'mean': round(latencies.mean(), 2),
+                'max': round(latencies.max(), 2),
+            },
+        }
+    return summary
+
+
+def find_regressions(report, baseline, max_regression=0.2):
+    """
+    Compare a report to a baseline report.
+
+    An endpoint regressed when its p95 latency grew, or its throughput
+    dropped, by more than max_regression (a fraction of the baseline).
+
+    Returns:
+        list of messages describing each regression
+    """
+    regressions = []
+    for name, stats in report['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if before is None:
+            continue
+        p95, p95_before = stats['latency_ms']['p95'], before['latency_ms']['p95']
+        if p95 > p95_before * (1 + max_regression):
+            regressions.append(f'{name}: p95 {p95_before} ms -> {p95} ms')
+        rps, rps_before = stats['throughput_rps'], before['throughput_rps']
+        if rps < rps_before * (1 - max_regression):
+            regressions.append(f'{name}: throughput {rps_before} -> {rps} '
+                               'requests/s')
+    return regressions
+
+
+def print_report(report):
+    """
+    Print the endpoint summaries as a table.
+    """
+    print(f"{'endpoint':<24}{'requests':>9}{'errors':>8}{'req/s':>9}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in report['endpoints'].items():
+        latency = stats['latency_ms']
+        print(f"{name:<24}{stats['requests']:>9}{stats['errors']:>8}"
+              f"{stats['throughput_rps']:>9}{latency['p50']:>10}"
+              f"{latency['p95']:>10}{latency['p99']:>10}")
+
+
+async def run(weights, accounts, duration=30, warmup=5, concurrency=16,
+              url=None, random_seed=0):
+    """
+    Run the load test and return the report as a dictionary.
+
+    Parameters:
+        weights (dict): relative weight of each endpoint in ENDPOINTS
+        accounts (list): bank account ids to pick from
+        duration (float): seconds measured, after the warmup
+        warmup (float): seconds of requests sent first and not measured
+        concurrency (int): number of requests in flight at once
+        url (str): base url of a running server. The app is called
+            in-process when not set
+        random_seed (int): seed for picking endpoints and accounts
+    """
+    if url is None:
+        from app.main import app
+
+        async def send_request(method, path, params, body):
+            return await asgi_request(app, method, path, params, body)
+    else:
+        async def send_request(method, path, params, body):
+            return await http_request(url, method, path, params, body)
+
+    results = []
+    start = time.perf_counter()
+    warmup_end = start + warmup
+    deadline = warmup_end + duration
+    await asyncio.gather(*[
+        worker(send_request, weights, accounts, deadline, warmup_end,
+               results, random.Random(random_seed + i))
+        for i in range(concurrency)])
+
+    # requests still running at the deadline count towards the elapsed time
+    elapsed = max([result[4] for result in results] + [deadline]) - warmup_end
+
+    return {
+        'created_at': dt.datetime.utcnow().isoformat(),
+        'config': {
+            'target': url or 'in-process',
+            'mix': weights,
+            'num_accounts': len(accounts),
+            'duration_s': duration,
+            'warmup_s': warmup,
+            'concurrency': concurrency,
+        },
+        'elapsed_s': round(elapsed, 3),
+        'endpoints': summarize(results, elapsed),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load test the API and report latency per endpoint.')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='endpoint weights, e.g. "spending=3,moneyflow=1"')
+    parser.add_argument('--accounts', default='1-200',
+                        help='bank account ids, e.g. "1-200" or "3,7,12-15"')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--url', help='base url of a running server')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='loadtest_report.json')
+    parser.add_argument('--baseline', help='report to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='allowed p95/throughput change, as a fraction')
+
+    args = parser.parse_args()
+    report = asyncio.get_event_loop().run_until_complete(run(
+        parse_mix(args.mix), parse_accounts(args.accounts),
+        duration=args.duration, warmup=args.warmup,
+        concurrency=args.concurrency, url=args.url, random_seed=args.seed))
+
+    print_report(report)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'report written to {args.out}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(report, baseline,
+                                       args.max_regression)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
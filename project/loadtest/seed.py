@@ -0,0 +1,234 @@
+"""
+Synthetic data for load testing.
+
+Creates the tables the API reads (plaid_main_transactions, bank_accounts,
+plaid_financial_authentications and transactional_financial_health_scores)
+in the database the SAVER_* environment variables point to and fills them
+with generated users, bank accounts and transactions. The transactions end
+today, so /current_month_spending always has data for the current month.
+
+Never point this at the production database. Existing tables are only
+replaced with --reset, and without it the command refuses to add to a
+non-empty plaid_main_transactions table.
+
+Usage (from the project directory, with a throwaway Postgres):
+
+    docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=loadtest postgres:12
+    SAVER_USERNAME=postgres SAVER_PASSWORD=loadtest \\
+    SAVER_DB_HOST=localhost SAVER_DB_NAME=postgres \\
+        python -m loadtest.seed --accounts 200 --days 730
+"""
+import argparse
+import io
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from app.helpers import (SAVER_USERNAME, SAVER_PASSWORD, SAVER_DB_HOST,
+                         SAVER_DB_NAME)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plaid_main_transactions (
+    id serial PRIMARY KEY,
+    bank_account_id int,
+    date timestamp,
+    amount_cents bigint,
+    merchant_address text,
+    merchant_city text,
+    merchant_state text,
+    merchant_zip text,
+    category_id varchar,
+    purpose text,
+    merchant_name text
+);
+CREATE INDEX IF NOT EXISTS plaid_main_transactions_account_date
+    ON plaid_main_transactions (bank_account_id, date);
+CREATE TABLE IF NOT EXISTS plaid_financial_authentications (
+    id int PRIMARY KEY,
+    user_id int
+);
+CREATE TABLE IF NOT EXISTS bank_accounts (
+    id int PRIMARY KEY,
+    plaid_financial_authentication_id int,
+    current_balance_cents bigint,
+    account_subtype text
+);
+CREATE TABLE IF NOT EXISTS transactional_financial_health_scores (
+    id serial PRIMARY KEY,
+    user_id int,
+    spend_earn_ratio float,
+    run_date date
+);
+"""
+
+TABLES = ['plaid_main_transactions', 'plaid_financial_authentications',
+          'bank_accounts', 'transactional_financial_health_scores']
+
+# everyday spending: plaid category id, merchants, share of transactions and
+# median amount in cents
+SPENDING = [
+    ('13005032', ['Starbucks #{}', 'STARBUCKS {}', 'Chipotle {}',
+                  "McDonald's F{}", 'Panera Bread #{}'], 0.30, 1200),
+    ('19025000', ['Kroger #{}', 'Safeway {}', 'Trader Joe s #{}',
+                  'WHOLEFDS {}'], 0.20, 4500),
+    ('19012001', ['Target T-{}', 'Amazon.com*{}', 'AMAZON MKTPLACE PMTS',
+                  'Walmart Supercenter #{}', 'Old Navy {}'], 0.18, 3500),
+    ('22006001', ['Uber *Trip {}', 'Lyft {}', 'Shell Oil {}',
+                  'Chevron {}'], 0.15, 2000),
+    ('17001001', ['Netflix.com', 'Spotify USA', 'AMC {}'], 0.07, 1500),
+    ('14001001', ['CVS/PHARMACY #{}', 'Walgreens #{}'], 0.06, 2500),
+    ('10000000', ['Overdraft Fee', 'ATM Fee {}'], 0.04, 500),
+]
+
+PAYROLL = '21009000'
+RENT = '16002000'
+UTILITIES = '18068001'
+TRANSFER = '21001000'
+
+
+def generate_account(rng, bank_id, start, end, daily_transactions):
+    """
+    Generate the transactions of one bank account between start and end.
+
+    Every account gets a biweekly paycheck, monthly rent and utilities,
+    everyday spending at daily_transactions transactions per day on average
+    and an occasional transfer.
+
+    Returns:
+        dataframe with the bank_account_id, date, amount_cents, category_id
+        and merchant_name of each transaction
+    """
+    days = pd.date_range(start, end, freq='D')
+    rows = []
+
+    pay = int(rng.normal(120000, 40000))
+    for date in days[rng.integers(0, 14)::14]:
+        rows.append((date, -abs(int(rng.normal(pay, pay * 0.05))),
+                     PAYROLL, 'ACME PAYROLL'))
+
+    rent = int(rng.normal(90000, 20000))
+    for date in pd.date_range(start, end, freq='MS'):
+        rows.append((date, abs(rent), RENT, 'Property Management'))
+        rows.append((date + pd.Timedelta(days=int(rng.integers(5, 20))),
+                     int(rng.lognormal(np.log(9000), 0.3)), UTILITIES,
+                     'City Utilities'))
+
+    count = rng.poisson(daily_transactions * len(days))
+    shares = np.array([share for _, _, share, _ in SPENDING])
+    picks = rng.choice(len(SPENDING), size=count, p=shares / shares.sum())
+    dates = days[rng.integers(0, len(days), size=count)]
+    for pick, date in zip(picks, dates):
+        category_id, merchants, _, median = SPENDING[pick]
+        merchant = merchants[rng.integers(len(merchants))]
+        rows.append((date, int(rng.lognormal(np.log(median), 0.6)),
+                     category_id, merchant.format(rng.integers(1, 999))))
+
+    for date in days[rng.random(len(days)) < 0.02]:
+        amount = int(rng.lognormal(np.log(10000), 0.8))
+        rows.append((date, amount * rng.choice([-1, 1]), TRANSFER,
+                     'Online Transfer'))
+
+    df = pd.DataFrame(rows, columns=['date', 'amount_cents', 'category_id',
+                                     'merchant_name'])
+    df.insert(0, 'bank_account_id', bank_id)
+    return df
+
+
+def copy_rows(cursor, table, df):
+    """
+    Bulk load a dataframe into a table with COPY.
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(df.columns)}) FROM STDIN WITH CSV",
+        buffer)
+
+
+def seed(num_accounts=200, num_days=730, daily_transactions=2.0,
+         random_seed=0, reset=False):
+    """
+    Create and fill the tables used by the API with synthetic data.
+
+    Bank accounts are numbered from 1, and every user owns two consecutive
+    accounts so the user-level endpoints have something to combine. How
+    busy each account is varies, so some accounts are much larger than the
+    average.
+
+    Parameters:
+        num_accounts (int): number of bank accounts to generate
+        num_days (int): days of history, ending today
+        daily_transactions (float): average everyday transactions per day
+        random_seed (int): seed for the generator
+        reset (bool): drop the tables before creating them
+
+    Returns:
+        the number of transactions generated
+    """
+    rng = np.random.default_rng(random_seed)
+    end = dt.date.today()
+    start = end - dt.timedelta(days=num_days - 1)
+
+    conn = psycopg2.connect(user=SAVER_USERNAME, password=SAVER_PASSWORD,
+                            host=SAVER_DB_HOST, dbname=SAVER_DB_NAME)
+    cursor = conn.cursor()
+
+    if reset:
+        cursor.execute(f"DROP TABLE IF EXISTS {', '.join(TABLES)};")
+    cursor.execute(SCHEMA)
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM plaid_main_transactions);")
+    if cursor.fetchone()[0]:
+        conn.rollback()
+        conn.close()
+        raise RuntimeError('plaid_main_transactions already has rows, '
+                           'use --reset to replace them')
+
+    num_rows = 0
+    for bank_id in range(1, num_accounts + 1):
+        activity = daily_transactions * rng.lognormal(0, 0.5)
+        df = generate_account(rng, bank_id, start, end, activity)
+        copy_rows(cursor, 'plaid_main_transactions', df)
+        num_rows += len(df)
+
+    ids = np.arange(1, num_accounts + 1)
+    user_ids = (ids + 1) // 2
+    copy_rows(cursor, 'plaid_financial_authentications',
+              pd.DataFrame({'id': ids, 'user_id': user_ids}))
+    copy_rows(cursor, 'bank_accounts', pd.DataFrame({
+        'id': ids,
+        'plaid_financial_authentication_id': ids,
+        'current_balance_cents': rng.integers(0, 500000, size=num_accounts),
+        'account_subtype': np.where(ids % 2 == 1, 'checking', 'savings'),
+    }))
+    users = np.unique(user_ids)
+    copy_rows(cursor, 'transactional_financial_health_scores', pd.DataFrame({
+        'user_id': users,
+        'spend_earn_ratio': rng.uniform(0.5, 1.5, size=len(users)).round(3),
+        'run_date': end.replace(day=1),
+    }))
+
+    cursor.execute("ANALYZE;")
+    conn.commit()
+    conn.close()
+
+    return num_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fill a throwaway database with synthetic transactions.')
+    parser.add_argument('--accounts', type=int, default=200)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--daily-transactions', type=float, default=2.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reset', action='store_true',
+                        help='drop and recreate the tables first')
+
+    args = parser.parse_args()
+    num_rows = seed(args.accounts, args.days, args.daily_transactions,
+                    random_seed=args.seed, reset=args.reset)
+    print(f'wrote {num_rows} transactions for {args.accounts} bank accounts '
+          f'to {SAVER_DB_NAME} on {SAVER_DB_HOST}')